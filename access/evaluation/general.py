@@ -5,27 +5,158 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+from functools import lru_cache
+import os
+import time
+
+from easse.bleu import corpus_bleu
 from easse.cli import evaluate_system_output
+from easse.fkgl import corpus_fkgl
+from easse.quality_estimation import corpus_quality_estimation
+from easse.sari import corpus_sari
+from easse.utils.resources import get_orig_sents, get_refs_sents
+import numpy as np
 
-from access.preprocess import lowercase_file, to_lrb_rrb_file
+from access.preprocess import compose_line_methods, lowercase, to_lrb_rrb
 from access.resources.paths import get_data_filepath
-from access.utils.helpers import mute, get_temp_filepath
+from access.utils.helpers import mute, get_temp_filepath, read_lines, write_lines
 '''A simplifier is a method with signature: simplifier(complex_filepath, output_pred_filepath)'''
 
 
-def get_prediction_on_turkcorpus(simplifier, phase):
+# Predictions are lowercased and parentheses are escaped to match the legacy turkcorpus references
+normalize_prediction = compose_line_methods(lowercase, to_lrb_rrb)
+# The in-memory evaluation must give the same scores as easse's evaluate_system_output()
+PARITY_TOLERANCE = 1e-6
+_parity_checked_phases = set()
+
+
+def get_prediction_on_turkcorpus(simplifier, phase, indexes=None):
+    '''Only the source sentences at indexes are simplified when provided (e.g. for low fidelity evaluations)'''
     source_filepath = get_data_filepath('turkcorpus', phase, 'complex')
+    if indexes is not None:
+        complex_sentences = read_lines(source_filepath)
+        source_filepath = get_temp_filepath()
+        write_lines([complex_sentences[i] for i in indexes], source_filepath)
     pred_filepath = get_temp_filepath()
-    with mute():
-        simplifier(source_filepath, pred_filepath)
+    try:
+        with mute():
+            simplifier(source_filepath, pred_filepath)
+    finally:
+        if indexes is not None:
+            os.remove(source_filepath)
     return pred_filepath
 
 
+def get_predictions_on_turkcorpus(simplifier, phase, indexes=None):
+    '''Simplifiers write to a file, it is read back and deleted right away'''
+    pred_filepath = get_prediction_on_turkcorpus(simplifier, phase, indexes=indexes)
+    try:
+        return read_lines(pred_filepath)
+    finally:
+        os.remove(pred_filepath)
+
+
+@lru_cache(maxsize=4)
+def get_turkcorpus_orig_and_refs_sents(phase):
+    test_set = f'turkcorpus_{phase}_legacy'
+    return get_orig_sents(test_set), get_refs_sents(test_set)
+
+
+def evaluate_predictions_on_turkcorpus(predictions, phase, quality_estimation=True, tokenizer='13a', lowercase=True,
+                                       indexes=None):
+    '''In-memory counterpart of easse's evaluate_system_output() with metrics bleu, sari_legacy and fkgl
+
+    With indexes, predictions are those of these samples only and the scores are those of this subset.
+    '''
+    orig_sents, refs_sents = get_turkcorpus_orig_and_refs_sents(phase)
+    if indexes is not None:
+        orig_sents = [orig_sents[i] for i in indexes]
+        refs_sents = [[ref_sents[i] for i in indexes] for ref_sents in refs_sents]
+    sys_sents = [normalize_prediction(prediction) for prediction in predictions]
+    assert len(sys_sents) == len(orig_sents), f'Expected {len(orig_sents)} predictions, got {len(sys_sents)}'
+    scores = {
+        'bleu': corpus_bleu(sys_sents, refs_sents, force=True, tokenizer=tokenizer, lowercase=lowercase),
+        'sari_legacy': corpus_sari(orig_sents, sys_sents, refs_sents, tokenizer=tokenizer, lowercase=lowercase,
+                                   legacy=True),
+        'fkgl': corpus_fkgl(sys_sents, tokenizer=tokenizer),
+    }
+    if quality_estimation:
+        scores['quality_estimation'] = corpus_quality_estimation(orig_sents, sys_sents, tokenizer=tokenizer,
+                                                                 lowercase=lowercase)
+    return scores
+
+
+def evaluate_predictions_with_easse_cli(predictions, phase, quality_estimation=True):
+    '''Reference scores, from easse's evaluate_system_output() on a predictions file'''
+    pred_filepath = get_temp_filepath()
+    write_lines([normalize_prediction(prediction) for prediction in predictions], pred_filepath)
+    try:
+        return evaluate_system_output(f'turkcorpus_{phase}_legacy',
+                                      sys_sents_path=str(pred_filepath),
+                                      metrics=['bleu', 'sari_legacy', 'fkgl'],
+                                      quality_estimation=quality_estimation)
+    finally:
+        os.remove(pred_filepath)
+
+
+def flatten_scores(scores, prefix=''):
+    flat_scores = {}
+    for key, value in scores.items():
+        if isinstance(value, dict):
+            flat_scores.update(flatten_scores(value, prefix=f'{prefix}{key}.'))
+        else:
+            flat_scores[f'{prefix}{key}'] = value
+    return flat_scores
+
+
+def get_score_differences(scores, reference_scores):
+    scores, reference_scores = flatten_scores(scores), flatten_scores(reference_scores)
+    assert scores.keys() == reference_scores.keys(), f'Different metrics: {scores.keys()} != {reference_scores.keys()}'
+    return {key: scores[key] - reference_scores[key] for key in reference_scores}
+
+
+def check_evaluation_parity(predictions, phase, quality_estimation=True):
+    '''Raise if evaluate_predictions_on_turkcorpus() drifts from evaluate_system_output(), returns the scores'''
+    scores = evaluate_predictions_on_turkcorpus(predictions, phase, quality_estimation=quality_estimation)
+    reference_scores = evaluate_predictions_with_easse_cli(predictions, phase, quality_estimation=quality_estimation)
+    differences = get_score_differences(scores, reference_scores)
+    assert all(abs(difference) <= PARITY_TOLERANCE for difference in differences.values()), \
+        f'In-memory turkcorpus evaluation differs from evaluate_system_output(): {differences}'
+    return scores
+
+
 def evaluate_simplifier_on_turkcorpus(simplifier, phase):
-    pred_filepath = get_prediction_on_turkcorpus(simplifier, phase)
-    pred_filepath = lowercase_file(pred_filepath)
-    pred_filepath = to_lrb_rrb_file(pred_filepath)
-    return evaluate_system_output(f'turkcorpus_{phase}_legacy',
-                                  sys_sents_path=pred_filepath,
-                                  metrics=['bleu', 'sari_legacy', 'fkgl'],
-                                  quality_estimation=True)
+    '''The first evaluation of each phase in a process is checked against evaluate_system_output()'''
+    predictions = get_predictions_on_turkcorpus(simplifier, phase)
+    if phase not in _parity_checked_phases:
+        scores = check_evaluation_parity(predictions, phase)
+        _parity_checked_phases.add(phase)
+        return scores
+    return evaluate_predictions_on_turkcorpus(predictions, phase)
+
+
+def evaluate_sentences_simplifier_on_turkcorpus(sentences_simplifier, phase, n_latency_sentences=100):
+    '''Scores and speed of a sentences simplifier (see access.simplifiers.get_fairseq_sentences_simplifier)
+
+    Latency is measured on the first n_latency_sentences simplified one at a time, throughput on the whole set.
+    '''
+    complex_sentences = read_lines(get_data_filepath('turkcorpus', phase, 'complex'))
+    latencies = []
+    for complex_sentence in complex_sentences[:n_latency_sentences]:
+        start_time = time.time()
+        with mute():
+            sentences_simplifier([complex_sentence])
+        latencies.append(time.time() - start_time)
+    start_time = time.time()
+    with mute():
+        predictions = sentences_simplifier(complex_sentences)
+    sentences_per_second = len(complex_sentences) / (time.time() - start_time)
+    scores = evaluate_predictions_on_turkcorpus(predictions, phase, quality_estimation=False)
+    return {
+        'latency_p50_ms': np.percentile(latencies, 50) * 1000,
+        'latency_p95_ms': np.percentile(latencies, 95) * 1000,
+        'sentences_per_second': sentences_per_second,
+        'sari_legacy': scores['sari_legacy'],
+        'bleu': scores['bleu'],
+        'fkgl': scores['fkgl'],
+    }
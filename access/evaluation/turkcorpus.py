@@ -0,0 +1,212 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from collections import Counter
+from functools import lru_cache
+import math
+
+from easse.fkgl import corpus_fkgl
+from easse.utils.preprocessing import normalize
+import numpy as np
+
+from access.evaluation.general import (get_predictions_on_turkcorpus, get_turkcorpus_orig_and_refs_sents,
+                                       evaluate_predictions_on_turkcorpus, normalize_prediction, PARITY_TOLERANCE)
+from access.utils.helpers import read_lines
+'''Turkcorpus evaluation with the reference side precomputed once
+
+Reference and source n-gram counts are computed when the evaluator is created, each evaluation then only extracts the
+n-grams of the predictions. Per-sentence statistics are memoized so that predictions that did not change between two
+calls (frequent during the parametrization search) are not scored again. Metrics follow easse's sari_legacy
+(sentence-level SARI of Xu et al. 2016, averaged over the corpus) and bleu (sacrebleu with exp smoothing).
+Being a reimplementation, the first evaluation of each phase in a process is checked against easse and raises if the
+scores differ.
+'''
+
+NGRAM_ORDER = 4
+ALL_METRICS = ('bleu', 'sari_legacy', 'fkgl')
+
+
+def extract_ngrams(sentence, max_order=NGRAM_ORDER):
+    tokens = sentence.split()
+    return [Counter(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)) for n in range(1, max_order + 1)]
+
+
+def multiply_counter(counter, value):
+    return Counter({key: count * value for key, count in counter.items()})
+
+
+def safe_f1(precision, recall):
+    if precision > 0 or recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0
+
+
+class SentenceReference:
+    '''Source and reference side of the SARI and BLEU statistics of a single sample'''
+    def __init__(self, orig_sent, ref_sents):
+        self.n_refs = len(ref_sents)
+        refs_ngrams = [extract_ngrams(ref_sent) for ref_sent in ref_sents]
+        # SARI: reference n-grams are counted over all references
+        self.orig_ngrams = extract_ngrams(orig_sent)
+        self.orig_ngrams_rep = [multiply_counter(ngrams, self.n_refs) for ngrams in self.orig_ngrams]
+        self.refs_ngrams = [sum((ref_ngrams[n] for ref_ngrams in refs_ngrams), Counter()) for n in range(NGRAM_ORDER)]
+        self.keep_all = [orig & refs for orig, refs in zip(self.orig_ngrams_rep, self.refs_ngrams)]
+        self.orig_ngram_sets = [set(ngrams) for ngrams in self.orig_ngrams]
+        self.refs_ngram_sets = [set(ngrams) for ngrams in self.refs_ngrams]
+        self.add_all = [refs - orig for orig, refs in zip(self.orig_ngram_sets, self.refs_ngram_sets)]
+        # BLEU: n-gram counts are clipped by their maximum count in a single reference
+        self.max_refs_ngrams = [Counter() for _ in range(NGRAM_ORDER)]
+        for ref_ngrams in refs_ngrams:
+            for n in range(NGRAM_ORDER):
+                self.max_refs_ngrams[n] |= ref_ngrams[n]
+        self.ref_lengths = [len(ref_sent.split()) for ref_sent in ref_sents]
+
+    def get_closest_ref_length(self, sys_length):
+        return min(self.ref_lengths, key=lambda ref_length: (abs(sys_length - ref_length), ref_length))
+
+    def get_sari(self, sys_ngrams):
+        keep_scores, del_scores, add_scores = [], [], []
+        for n in range(NGRAM_ORDER):
+            sys_ngrams_rep = multiply_counter(sys_ngrams[n], self.n_refs)
+            # Keep
+            keep = self.orig_ngrams_rep[n] & sys_ngrams_rep
+            keep_good = keep & self.refs_ngrams[n]
+            keep_precision = keep_recall = 0
+            if len(keep) > 0:
+                keep_precision = sum(keep_good[ngram] / keep[ngram] for ngram in keep_good) / len(keep)
+            if len(self.keep_all[n]) > 0:
+                keep_recall = sum(keep_good[ngram] / self.keep_all[n][ngram]
+                                  for ngram in keep_good) / len(self.keep_all[n])
+            keep_scores.append(safe_f1(keep_precision, keep_recall))
+            # Deletion, only the precision is used
+            deletion = self.orig_ngrams_rep[n] - sys_ngrams_rep
+            del_good = deletion - self.refs_ngrams[n]
+            del_precision = 0
+            if len(deletion) > 0:
+                del_precision = sum(del_good[ngram] / deletion[ngram] for ngram in del_good) / len(deletion)
+            del_scores.append(del_precision)
+            # Addition
+            addition = set(sys_ngrams[n]) - self.orig_ngram_sets[n]
+            n_add_good = len(addition & self.refs_ngram_sets[n])
+            add_precision = n_add_good / len(addition) if len(addition) > 0 else 0
+            add_recall = n_add_good / len(self.add_all[n]) if len(self.add_all[n]) > 0 else 0
+            add_scores.append(safe_f1(add_precision, add_recall))
+        return (np.mean(keep_scores) + np.mean(del_scores) + np.mean(add_scores)) / 3
+
+    def get_bleu_stats(self, sys_sent, sys_ngrams):
+        '''[correct_1, ..., correct_4, total_1, ..., total_4, sys_length, ref_length]'''
+        sys_length = len(sys_sent.split())
+        correct = [sum(min(count, self.max_refs_ngrams[n][ngram]) for ngram, count in sys_ngrams[n].items())
+                   for n in range(NGRAM_ORDER)]
+        total = [max(sys_length - n, 0) for n in range(NGRAM_ORDER)]
+        return correct + total + [sys_length, self.get_closest_ref_length(sys_length)]
+
+
+def compute_bleu(bleu_stats):
+    '''Same as sacrebleu.compute_bleu() with smooth_method='exp' and no effective order'''
+    correct, total = bleu_stats[:NGRAM_ORDER], bleu_stats[NGRAM_ORDER:2 * NGRAM_ORDER]
+    sys_length, ref_length = bleu_stats[-2:]
+    precisions = [0] * NGRAM_ORDER
+    smooth_mteval = 1.
+    for n in range(NGRAM_ORDER):
+        if total[n] == 0:
+            break
+        if correct[n] == 0:
+            smooth_mteval *= 2
+            precisions[n] = 100. / (smooth_mteval * total[n])
+        else:
+            precisions[n] = 100. * correct[n] / total[n]
+    brevity_penalty = 1.
+    if sys_length < ref_length:
+        brevity_penalty = math.exp(1 - ref_length / sys_length) if sys_length > 0 else 0.
+    log_precisions = [math.log(precision) if precision > 0 else -9999999999 for precision in precisions]
+    return brevity_penalty * math.exp(sum(log_precisions) / NGRAM_ORDER)
+
+
+class TurkcorpusEvaluator:
+    '''Evaluate predictions on turkcorpus_{phase}_legacy, scores match evaluate_simplifier_on_turkcorpus()'''
+    def __init__(self, phase, lowercase=True, tokenizer='13a'):
+        self.phase = phase
+        self.lowercase = lowercase
+        self.tokenizer = tokenizer
+        # As in easse's legacy SARI, source sentences are used as is while predictions and references are normalized
+        orig_sents, refs_sents = get_turkcorpus_orig_and_refs_sents(phase)
+        refs_sents = [[normalize(sent, lowercase, tokenizer) for sent in ref_sents] for ref_sents in refs_sents]
+        self.references = [
+            SentenceReference(orig_sent, ref_sents) for orig_sent, *ref_sents in zip(orig_sents, *refs_sents)
+        ]
+        self.sari_cache = {}
+        self.bleu_stats_cache = {}
+        self.parity_checked = False
+
+    def __len__(self):
+        return len(self.references)
+
+    def get_sentence_stats(self, i, sys_sent, metrics):
+        key = (i, sys_sent)
+        missing_sari = 'sari_legacy' in metrics and key not in self.sari_cache
+        missing_bleu = 'bleu' in metrics and key not in self.bleu_stats_cache
+        if missing_sari or missing_bleu:
+            normalized_sys_sent = normalize(sys_sent, self.lowercase, self.tokenizer)
+            sys_ngrams = extract_ngrams(normalized_sys_sent)
+            if missing_sari:
+                self.sari_cache[key] = self.references[i].get_sari(sys_ngrams)
+            if missing_bleu:
+                self.bleu_stats_cache[key] = self.references[i].get_bleu_stats(normalized_sys_sent, sys_ngrams)
+        return self.sari_cache.get(key), self.bleu_stats_cache.get(key)
+
+    def evaluate(self, sys_sents, metrics=ALL_METRICS, indexes=None):
+        '''Only the requested metrics are computed, skipping e.g. fkgl speeds up the search loop
+
+        With indexes, sys_sents are the predictions of these samples only and the scores are those of this subset.
+        '''
+        if indexes is None:
+            indexes = range(len(self))
+        assert len(sys_sents) == len(indexes), f'Expected {len(indexes)} predictions, got {len(sys_sents)}'
+        assert set(metrics) <= set(ALL_METRICS), f'Supported metrics: {ALL_METRICS}'
+        sys_sents = [normalize_prediction(sys_sent) for sys_sent in sys_sents]
+        sentence_stats = [self.get_sentence_stats(i, sys_sent, metrics) for i, sys_sent in zip(indexes, sys_sents)]
+        scores = {}
+        if 'bleu' in metrics:
+            scores['bleu'] = compute_bleu(np.sum([bleu_stats for _, bleu_stats in sentence_stats], axis=0).tolist())
+        if 'sari_legacy' in metrics:
+            scores['sari_legacy'] = 100. * np.mean([sari for sari, _ in sentence_stats])
+        if 'fkgl' in metrics:
+            scores['fkgl'] = corpus_fkgl(sys_sents, tokenizer=self.tokenizer)
+        return scores
+
+    def evaluate_file(self, pred_filepath, metrics=ALL_METRICS):
+        return self.evaluate(read_lines(pred_filepath), metrics=metrics)
+
+    def evaluate_simplifier(self, simplifier, metrics=ALL_METRICS, indexes=None):
+        sys_sents = get_predictions_on_turkcorpus(simplifier, self.phase, indexes=indexes)
+        if not self.parity_checked:
+            self.assert_parity(sys_sents, indexes=indexes)
+        return self.evaluate(sys_sents, metrics=metrics, indexes=indexes)
+
+    def check_parity(self, sys_sents, indexes=None):
+        '''Differences with easse on the same predictions, should all be 0'''
+        easse_scores = evaluate_predictions_on_turkcorpus(sys_sents, self.phase, quality_estimation=False,
+                                                          tokenizer=self.tokenizer, lowercase=self.lowercase,
+                                                          indexes=indexes)
+        scores = self.evaluate(sys_sents, indexes=indexes)
+        return {metric: scores[metric] - easse_scores[metric] for metric in ALL_METRICS}
+
+    def assert_parity(self, sys_sents, indexes=None):
+        differences = self.check_parity(sys_sents, indexes=indexes)
+        assert all(abs(difference) <= PARITY_TOLERANCE for difference in differences.values()), \
+            f'TurkcorpusEvaluator differs from easse: {differences}'
+        self.parity_checked = True
+
+
+@lru_cache(maxsize=2)
+def get_turkcorpus_evaluator(phase):
+    return TurkcorpusEvaluator(phase)
+
+
+def fast_evaluate_simplifier_on_turkcorpus(simplifier, phase, metrics=ALL_METRICS, indexes=None):
+    return get_turkcorpus_evaluator(phase).evaluate_simplifier(simplifier, metrics=metrics, indexes=indexes)
@@ -0,0 +1,100 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import multiprocessing
+import os
+from pathlib import Path
+'''SARI validation of checkpoint snapshots in a worker process, while training goes on
+
+Enabled with args.async_sari_validation. At each validation point the trainer saves a snapshot of its full state
+(checkpoint_snapshot_{num_updates}.pt) and submits it. A worker process decodes turkcorpus valid with it, the same way
+as the inline sari_validate() (beam 2). The results come back tagged with their number of updates. The trainer polls
+for them and applies them in submission order: it updates best SARI and early stopping, and promotes the snapshot to
+checkpoint_best.pt or checkpoint_last.pt without serializing it again. Early stopping therefore takes effect a few
+updates late.
+'''
+
+SNAPSHOT_NAME_TEMPLATE = 'checkpoint_snapshot_{num_updates}.pt'
+
+
+def compute_checkpoint_scores(exp_dir, checkpoint_path, preprocessors_dir, cpu=False, num_threads=None):
+    '''Runs in the worker process, the scores are those of easse.report.get_all_scores()'''
+    from easse.report import get_all_scores
+    from access.preprocessors import load_preprocessors
+    from access.resources.paths import get_data_filepath
+    from access.simplifiers import get_fairseq_sentences_simplifier
+    from access.utils.helpers import mute, read_lines
+    simplifier = get_fairseq_sentences_simplifier(exp_dir,
+                                                  preprocessors=load_preprocessors(preprocessors_dir),
+                                                  use_prediction_store=False,
+                                                  checkpoint_paths=[checkpoint_path],
+                                                  beam=2,
+                                                  cpu=cpu,
+                                                  num_threads=num_threads)
+    complex_sentences = read_lines(get_data_filepath('turkcorpus', 'valid', 'complex'))
+    with mute():
+        predictions = simplifier(complex_sentences)
+    refs_sents = [read_lines(get_data_filepath('turkcorpus', 'valid', 'simple.turk', i)) for i in range(8)]
+    return get_all_scores(complex_sentences, predictions, refs_sents)
+
+
+class AsyncSariValidator:
+    def __init__(self, args, max_pending=2, num_threads=None):
+        assert args.distributed_world_size == 1, 'Asynchronous SARI validation only supports single process training'
+        self.save_dir = Path(args.save_dir)
+        # Dictionaries are copied in the experiment directory, the preprocessors are those of the dataset
+        self.exp_dir = self.save_dir.parent
+        self.preprocessors_dir = Path(eval(str(args.data))[0]).parent
+        self.cpu = args.cpu
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self.pending = []  # [(num_updates, snapshot_path, async_result), ...] in submission order
+        # CUDA cannot be used in forked processes
+        self.pool = multiprocessing.get_context('spawn').Pool(1)
+
+    def get_snapshot_path(self, num_updates):
+        return self.save_dir / SNAPSHOT_NAME_TEMPLATE.format(num_updates=num_updates)
+
+    def submit(self, num_updates, snapshot_path):
+        '''Waits for the oldest validations when max_pending of them are still running'''
+        results = []
+        if len(self.pending) >= self.max_pending:
+            results = self.poll(n_wait=len(self.pending) - self.max_pending + 1)
+        async_result = self.pool.apply_async(
+            compute_checkpoint_scores,
+            (str(self.exp_dir), str(snapshot_path), str(self.preprocessors_dir), self.cpu, self.num_threads))
+        self.pending.append((num_updates, snapshot_path, async_result))
+        return results
+
+    def poll(self, n_wait=0):
+        '''[(num_updates, snapshot_path, scores), ...] of the finished validations, waiting for the n_wait oldest'''
+        results = []
+        while len(self.pending) > 0 and (len(results) < n_wait or self.pending[0][2].ready()):
+            num_updates, snapshot_path, async_result = self.pending.pop(0)
+            # Errors of the worker are raised here
+            results.append((num_updates, snapshot_path, async_result.get()))
+        return results
+
+    def close(self):
+        '''Results of the validations still running'''
+        try:
+            return self.poll(n_wait=len(self.pending))
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def terminate(self):
+        '''Stop the worker without waiting, e.g. when training failed, and remove the snapshots never validated'''
+        self.pool.terminate()
+        for _, snapshot_path, _ in self.pending:
+            remove_snapshot(snapshot_path)
+        self.pending = []
+
+
+def remove_snapshot(snapshot_path):
+    if os.path.lexists(snapshot_path):
+        os.remove(snapshot_path)
@@ -14,13 +14,18 @@ import shutil
 import tempfile
 import time
 
-from fairseq import options
+from fairseq import options, tasks, utils
 from fairseq_cli import preprocess, generate
+from fairseq_cli.interactive import make_batches
+import torch
 from access.fairseq import train
+from access.fairseq.checkpoints import create_slim_checkpoint, get_inference_checkpoint_path
 
 from access.resources.paths import get_dataset_dir, EXP_DIR
-from access.utils.helpers import (log_stdout, lock_directory, create_directory_or_skip, yield_lines,
-                                  write_lines)
+from access.utils.metrics import STAGE_SECONDS, BATCH_SIZE, MEMORY_BYTES
+from access.utils.profiling import profile_stage
+from access.utils.artifacts import build_artifact
+from access.utils.helpers import log_stdout, yield_lines, write_lines
 
 
 def get_fairseq_exp_dir(job_id=None):
@@ -33,28 +38,29 @@ def get_fairseq_exp_dir(job_id=None):
 
 def fairseq_preprocess(dataset):
     dataset_dir = get_dataset_dir(dataset)
-    with lock_directory(dataset_dir):
-        preprocessed_dir = dataset_dir / 'fairseq_preprocessed'
-        with create_directory_or_skip(preprocessed_dir):
-            preprocessing_parser = options.get_preprocessing_parser()
-            preprocess_args = preprocessing_parser.parse_args([
-                '--source-lang',
-                'complex',
-                '--target-lang',
-                'simple',
-                '--trainpref',
-                os.path.join(dataset_dir, f'{dataset}.train'),
-                '--validpref',
-                os.path.join(dataset_dir, f'{dataset}.valid'),
-                '--testpref',
-                os.path.join(dataset_dir, f'{dataset}.test'),
-                '--destdir',
-                str(preprocessed_dir),
-                '--output-format',
-                'raw',
-            ])
+
+    def build(preprocessed_dir):
+        preprocessing_parser = options.get_preprocessing_parser()
+        preprocess_args = preprocessing_parser.parse_args([
+            '--source-lang',
+            'complex',
+            '--target-lang',
+            'simple',
+            '--trainpref',
+            os.path.join(dataset_dir, f'{dataset}.train'),
+            '--validpref',
+            os.path.join(dataset_dir, f'{dataset}.valid'),
+            '--testpref',
+            os.path.join(dataset_dir, f'{dataset}.test'),
+            '--destdir',
+            str(preprocessed_dir),
+            '--output-format',
+            'raw',
+        ])
+        with profile_stage('fairseq_preprocess'):
             preprocess.main(preprocess_args)
-        return preprocessed_dir
+
+    return build_artifact(dataset_dir / 'fairseq_preprocessed', build)
 
 
 def fairseq_train(
@@ -80,7 +86,9 @@ def fairseq_train(
         optimizer='nag',
         validations_before_sari_early_stopping=10,
         fp16=False,
-        resume_from_checkpoint=None):  # For fine-tuning existing model
+        resume_from_checkpoint=None,  # For fine-tuning existing model
+        keep_interval_updates=5,  # Last update checkpoints kept, to be averaged (see scripts/average_checkpoints.py)
+        async_sari_validation=False):  # Validate in a worker process while training goes on (single GPU only)
     exp_dir = Path(exp_dir)
     with log_stdout(exp_dir / 'fairseq_train.stdout'):
         preprocessed_dir = Path(preprocessed_dir)
@@ -105,6 +113,8 @@ def fairseq_train(
             criterion,
             '--save-interval-updates',
             2567,
+            '--keep-interval-updates',
+            keep_interval_updates,
             '--validations-before-sari-early-stopping',
             validations_before_sari_early_stopping,
             '--arch',
@@ -164,7 +174,13 @@ def fairseq_train(
             args.append('--reset-optimizer')  # Optionally reset the optimizer to avoid issues
         args = [str(arg) for arg in args]
         train_args = options.parse_args_and_arch(train_parser, args)
+        # Not a fairseq option, see access.fairseq.async_validation
+        train_args.async_sari_validation = async_sari_validation
+        # Not a profiling stage as a whole: it would run all of training under the profiler, only its startup stages
+        # (see train.main) are profiled
         train.main(train_args)
+        if (exp_dir / 'checkpoints/checkpoint_best.pt').exists():
+            create_slim_checkpoint(exp_dir)
 
 
 def _fairseq_generate(complex_filepath,
@@ -258,7 +274,7 @@ def fairseq_generate(complex_filepath,
                      sampling=False,
                      batch_size=128):
     exp_dir = Path(exp_dir)
-    checkpoint_path = exp_dir / 'checkpoints/checkpoint_best.pt'
+    checkpoint_path = get_inference_checkpoint_path(exp_dir)
     assert checkpoint_path.exists(), f'Generation failed, no checkpoint at {checkpoint_path}'
     complex_dictionary_path = exp_dir / 'dict.complex.txt'
     simple_dictionary_path = exp_dir / 'dict.simple.txt'
@@ -273,3 +289,286 @@ def fairseq_generate(complex_filepath,
                       diverse_beam_strength=diverse_beam_strength,
                       sampling=sampling,
                       batch_size=batch_size)
+
+
+def set_torch_threads(num_threads=None, num_interop_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            print(f'Could not set num_interop_threads={num_interop_threads}: {e}')
+
+
+def get_quantized_model_path(checkpoint_path):
+    checkpoint_path = Path(checkpoint_path)
+    return checkpoint_path.parent / f'{checkpoint_path.stem}.int8.pt'
+
+
+def has_quantize_dynamic():
+    return hasattr(torch, 'quantization') and hasattr(torch.quantization, 'quantize_dynamic')
+
+
+def quantize_model(model):
+    '''Dynamic int8 quantization of the linear layers, for CPU inference
+
+    torch>=1.3 has torch.quantization, the pinned torch 1.2 only has the fbgemm modules of torch.jit.quantized.
+    '''
+    if has_quantize_dynamic():
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    assert torch.fbgemm_is_cpu_supported(), 'int8 kernels (fbgemm) require a CPU with AVX2'
+    return torch.jit.quantized.quantize_linear_modules(model)
+
+
+def load_quantized_model(checkpoint_path, load_model, build_model):
+    '''The quantized state dict is cached next to the checkpoint and rebuilt when the checkpoint is more recent
+
+    load_model() returns the fp32 model and its args, build_model(model_args) an untrained model of the same
+    architecture in which the cached state dict is loaded. The torch 1.2 modules keep their quantization scales as
+    constants, outside of the state dict, they are quantized at each load instead.
+    '''
+    if not has_quantize_dynamic():
+        model, _ = load_model()
+        return quantize_model(model)
+    quantized_model_path = get_quantized_model_path(checkpoint_path)
+    if quantized_model_path.exists() and quantized_model_path.stat().st_mtime >= Path(checkpoint_path).stat().st_mtime:
+        # Four times smaller to read than the fp32 checkpoint
+        quantized_state = torch.load(quantized_model_path, map_location='cpu')
+        # Caches of earlier versions pickled the whole module, they are rebuilt
+        if isinstance(quantized_state, dict):
+            model = quantize_model(build_model(quantized_state['args']))
+            model.load_state_dict(quantized_state['model'])
+            return model
+    model, model_args = load_model()
+    model = quantize_model(model)
+    tmp_quantized_model_path = f'{quantized_model_path}.tmp'
+    torch.save({'args': model_args, 'model': model.state_dict()}, tmp_quantized_model_path)
+    os.replace(tmp_quantized_model_path, quantized_model_path)
+    return model
+
+
+LENGTH_RATIO_PATTERN = re.compile(r'<LENGTHRATIO_([0-9.]+)>')
+# Tokens allowed on top of the length derived from the <LENGTHRATIO_x> control token
+MAX_LEN_MARGIN = 10
+# (max number of source tokens, fraction of the beam size), short sentences have few plausible rewrites
+ADAPTIVE_BEAM_BUCKETS = [(8, 0.25), (16, 0.5), (float('inf'), 1)]
+
+
+def get_length_ratio(encoded_sentence):
+    match = LENGTH_RATIO_PATTERN.search(encoded_sentence)
+    return float(match.groups()[0]) if match else None
+
+
+def get_adaptive_beam_size(beam, n_tokens, min_beam=1):
+    for max_n_tokens, beam_ratio in ADAPTIVE_BEAM_BUCKETS:
+        if n_tokens <= max_n_tokens:
+            return max(int(beam * beam_ratio), min_beam)
+
+
+def _load_fairseq_generator(checkpoint_paths,
+                            data_dir,
+                            beam=5,
+                            hypothesis_num=1,
+                            lenpen=1.,
+                            diverse_beam_groups=None,
+                            diverse_beam_strength=0.5,
+                            sampling=False,
+                            batch_size=128,
+                            cpu=False,
+                            quantize=False,
+                            num_threads=None,
+                            num_interop_threads=None,
+                            max_len_slack=None,
+                            adaptive_beam=False):
+    '''Load the models once and return a method that generates predictions for a list of encoded sentences
+
+    data_dir must contain dict.{complex,simple}.txt
+    quantize=True runs the linear layers in int8 on CPU, see load_quantized_model()
+    max_len_slack caps the length of each prediction to max_len_slack * x * source_length + MAX_LEN_MARGIN where x is
+    the <LENGTHRATIO_x> target of the sentence (1.5 is a reasonable value), instead of fairseq's default of 200 tokens.
+    adaptive_beam=True uses smaller beams for short sentences, see ADAPTIVE_BEAM_BUCKETS (BeamableMM is then disabled).
+    Sentences are decoded in groups sharing the same length cap and beam size. fairseq already stops the beam search
+    of a sentence as soon as beam hypotheses are finalized (stop_early) and drops finished sentences from the batch.
+    '''
+    assert not adaptive_beam or (diverse_beam_groups is None and not sampling), \
+        'adaptive_beam is only supported with regular beam search'
+    set_torch_threads(num_threads, num_interop_threads)
+    generate_parser = options.get_generation_parser(interactive=True)
+    args = [
+        data_dir,
+        '--path',
+        ':'.join([str(path) for path in checkpoint_paths]),
+        '--source-lang',
+        'complex',
+        '--target-lang',
+        'simple',
+        '--beam',
+        beam,
+        '--nbest',
+        hypothesis_num,
+        '--lenpen',
+        lenpen,
+        '--diverse-beam-groups',
+        diverse_beam_groups if diverse_beam_groups is not None else -1,
+        '--diverse-beam-strength',
+        diverse_beam_strength,
+        '--max-sentences',
+        batch_size,
+        # We don't want to reload pretrained embeddings
+        '--model-overrides',
+        {
+            'encoder_embed_path': None,
+            'decoder_embed_path': None
+        },
+    ]
+    if sampling:
+        args.extend([
+            '--sampling',
+            '--sampling-topk',
+            10,
+        ])
+    if cpu or quantize:
+        # Quantized kernels only run on CPU
+        args.append('--cpu')
+    args = [str(arg) for arg in args]
+    generate_args = options.parse_args_and_arch(generate_parser, args)
+    use_cuda = torch.cuda.is_available() and not generate_args.cpu
+    task = tasks.setup_task(generate_args)
+
+    # BeamableMM (fconv) is built for a single beam size, groups decoded with a smaller adaptive beam can't use it
+    beamable_mm_beam_size = None if generate_args.no_beamable_mm or adaptive_beam else generate_args.beam
+
+    def make_generation_fast(model):
+        model.make_generation_fast_(beamable_mm_beam_size=beamable_mm_beam_size)
+        return model
+
+    def load_model(checkpoint_path):
+        [model], model_args = utils.load_ensemble_for_inference([checkpoint_path],
+                                                                task,
+                                                                model_arg_overrides=eval(generate_args.model_overrides))
+        return make_generation_fast(model), model_args
+
+    def build_model(model_args):
+        return make_generation_fast(task.build_model(model_args))
+
+    models = []
+    for checkpoint_path in generate_args.path.split(':'):
+        if quantize:
+            model = load_quantized_model(checkpoint_path, lambda: load_model(checkpoint_path), build_model)
+        else:
+            model, _ = load_model(checkpoint_path)
+        if use_cuda:
+            model.cuda()
+        models.append(model)
+    generator = task.build_generator(generate_args)
+    max_positions = utils.resolve_max_positions(task.max_positions(), *[model.max_positions() for model in models])
+    model_bytes = sum(tensor.numel() * tensor.element_size() for model in models
+                      for tensor in model.state_dict().values() if torch.is_tensor(tensor))
+    MEMORY_BYTES.set(model_bytes, kind='model_parameters')
+    # Time spent in the encoders, the rest of inference_step() is the decoder and the beam search
+    encoder_timer = {'start_time': None, 'seconds': 0.}
+
+    def start_encoder_timer(module, inputs):
+        encoder_timer['start_time'] = time.perf_counter()
+
+    def stop_encoder_timer(module, inputs, outputs):
+        encoder_timer['seconds'] += time.perf_counter() - encoder_timer['start_time']
+
+    for model in models:
+        model.encoder.register_forward_pre_hook(start_encoder_timer)
+        model.encoder.register_forward_hook(stop_encoder_timer)
+
+    def get_decoding_params(sentence):
+        max_len_a, max_len_b, beam_size = generate_args.max_len_a, generate_args.max_len_b, generate_args.beam
+        length_ratio = get_length_ratio(sentence) if max_len_slack is not None else None
+        if length_ratio is not None:
+            max_len_a, max_len_b = max_len_slack * length_ratio, MAX_LEN_MARGIN
+        if adaptive_beam:
+            beam_size = get_adaptive_beam_size(generate_args.beam, len(sentence.split()), min_beam=hypothesis_num)
+        return max_len_a, max_len_b, beam_size
+
+    def generate_sentences(sentences):
+        if len(sentences) == 0:
+            return []
+        predictions = [None] * len(sentences)
+        groups = defaultdict(list)
+        for i, sentence in enumerate(sentences):
+            groups[get_decoding_params(sentence)].append(i)
+        for (max_len_a, max_len_b, beam_size), indexes in groups.items():
+            generator.max_len_a, generator.max_len_b, generator.beam_size = max_len_a, max_len_b, beam_size
+            group_sentences = [sentences[i] for i in indexes]
+            for batch in make_batches(group_sentences, generate_args, task, max_positions):
+                src_tokens = batch.src_tokens
+                src_lengths = batch.src_lengths
+                if use_cuda:
+                    src_tokens = src_tokens.cuda()
+                    src_lengths = src_lengths.cuda()
+                sample = {
+                    'net_input': {
+                        'src_tokens': src_tokens,
+                        'src_lengths': src_lengths,
+                    },
+                }
+                BATCH_SIZE.observe(len(batch.ids))
+                encoder_timer['seconds'] = 0.
+                start_time = time.perf_counter()
+                translations = task.inference_step(generator, models, sample)
+                duration = time.perf_counter() - start_time
+                STAGE_SECONDS.observe(encoder_timer['seconds'], stage='model_encode')
+                STAGE_SECONDS.observe(duration - encoder_timer['seconds'], stage='model_decode')
+                for sample_id, hypos in zip(batch.ids.tolist(), translations):
+                    _, predictions[indexes[sample_id]], _ = utils.post_process_prediction(
+                        hypo_tokens=hypos[hypothesis_num - 1]['tokens'].int().cpu(),
+                        src_str=None,
+                        alignment=None,
+                        align_dict=None,
+                        tgt_dict=task.target_dictionary,
+                        remove_bpe=generate_args.remove_bpe,
+                    )
+        return predictions
+
+    return generate_sentences
+
+
+def load_fairseq_generator(exp_dir,
+                           checkpoint_paths=None,
+                           beam=1,
+                           hypothesis_num=1,
+                           lenpen=1.,
+                           diverse_beam_groups=None,
+                           diverse_beam_strength=0.5,
+                           sampling=False,
+                           batch_size=128,
+                           cpu=False,
+                           quantize=False,
+                           num_threads=None,
+                           num_interop_threads=None,
+                           max_len_slack=None,
+                           adaptive_beam=False):
+    '''In-process counterpart of fairseq_generate, the model is loaded only once
+
+    Several checkpoint_paths (sharing the dictionaries of exp_dir) are decoded as an ensemble: fairseq encodes each
+    source once per member before expanding it to the beam, and the beam search is shared by all members.
+    '''
+    exp_dir = Path(exp_dir)
+    if checkpoint_paths is None:
+        checkpoint_paths = [get_inference_checkpoint_path(exp_dir)]
+    for checkpoint_path in checkpoint_paths:
+        assert Path(checkpoint_path).exists(), f'Generation failed, no checkpoint at {checkpoint_path}'
+    return _load_fairseq_generator(checkpoint_paths,
+                                   exp_dir,
+                                   beam=beam,
+                                   hypothesis_num=hypothesis_num,
+                                   lenpen=lenpen,
+                                   diverse_beam_groups=diverse_beam_groups,
+                                   diverse_beam_strength=diverse_beam_strength,
+                                   sampling=sampling,
+                                   batch_size=batch_size,
+                                   cpu=cpu,
+                                   quantize=quantize,
+                                   num_threads=num_threads,
+                                   num_interop_threads=num_interop_threads,
+                                   max_len_slack=max_len_slack,
+                                   adaptive_beam=adaptive_beam)
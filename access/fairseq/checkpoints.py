@@ -0,0 +1,109 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from pathlib import Path
+'''Slim inference checkpoints: model weights only (no optimizer state), optionally averaged and stored in fp16
+
+Slim checkpoints keep the layout of regular fairseq checkpoints so that fairseq loads them as is, fp16 weights are
+cast back to the dtype of the model parameters by load_state_dict().
+fairseq and torch are imported in the functions that need them, resolving the inference checkpoint path does not.
+'''
+
+SLIM_CHECKPOINT_NAME = 'checkpoint_slim.pt'
+
+
+def get_last_checkpoint_paths(checkpoints_dir, n_checkpoints):
+    '''Most recent checkpoints first, update checkpoints are preferred over epoch checkpoints'''
+    from fairseq import utils
+    for pattern in [r'checkpoint_\d+_(\d+)\.pt', r'checkpoint(\d+)\.pt']:
+        checkpoint_paths = utils.checkpoint_paths(str(checkpoints_dir), pattern=pattern)
+        if len(checkpoint_paths) > 0:
+            return checkpoint_paths[:n_checkpoints]
+    return []
+
+
+def load_checkpoint_state(checkpoint_path):
+    import torch
+    return torch.load(checkpoint_path, map_location='cpu')
+
+
+def average_checkpoints(checkpoint_paths):
+    '''Average the model weights, other entries are taken from the last checkpoint
+
+    Checkpoints are loaded one at a time so that memory does not grow with the number of checkpoints.
+    '''
+    assert len(checkpoint_paths) > 0
+    summed_params = None
+    for checkpoint_path in checkpoint_paths:
+        state = load_checkpoint_state(checkpoint_path)
+        params = state['model']
+        if summed_params is None:
+            summed_params = {key: param.clone().double() if param.is_floating_point() else param.clone()
+                             for key, param in params.items()}
+            continue
+        assert params.keys() == summed_params.keys(), f'Checkpoint {checkpoint_path} does not match the others'
+        for key, param in params.items():
+            if param.is_floating_point():
+                summed_params[key] += param.double()
+    state['model'] = {
+        key: (param / len(checkpoint_paths)).to(state['model'][key].dtype) if param.is_floating_point() else param
+        for key, param in summed_params.items()
+    }
+    return state
+
+
+def slim_checkpoint_state(state, fp16=True):
+    state['last_optimizer_state'] = None
+    for optimizer_history in state.get('optimizer_history', []):
+        optimizer_history.pop('optimizer', None)
+    if fp16:
+        state['model'] = {key: param.half() if param.is_floating_point() else param
+                          for key, param in state['model'].items()}
+    return state
+
+
+def save_slim_checkpoint(checkpoint_paths, output_path, fp16=True):
+    '''Average checkpoint_paths (a single path is just slimmed) into a weights only checkpoint'''
+    if len(checkpoint_paths) == 1:
+        state = load_checkpoint_state(checkpoint_paths[0])
+    else:
+        state = average_checkpoints(checkpoint_paths)
+    state = slim_checkpoint_state(state, fp16=fp16)
+    state.setdefault('extra_state', {})['slim_checkpoint_sources'] = [Path(path).name for path in checkpoint_paths]
+    import torch
+    tmp_output_path = f'{output_path}.tmp'
+    torch.save(state, tmp_output_path)
+    os.replace(tmp_output_path, output_path)
+    return output_path
+
+
+def get_inference_checkpoint_path(exp_dir):
+    '''The slim checkpoint is used by default, unless checkpoint_best.pt was saved after it'''
+    checkpoints_dir = Path(exp_dir) / 'checkpoints'
+    best_checkpoint_path = checkpoints_dir / 'checkpoint_best.pt'
+    slim_checkpoint_path = checkpoints_dir / SLIM_CHECKPOINT_NAME
+    if not slim_checkpoint_path.exists():
+        return best_checkpoint_path
+    if best_checkpoint_path.exists() and best_checkpoint_path.stat().st_mtime > slim_checkpoint_path.stat().st_mtime:
+        print(f'Ignoring {slim_checkpoint_path}, it is older than {best_checkpoint_path}')
+        return best_checkpoint_path
+    return slim_checkpoint_path
+
+
+def create_slim_checkpoint(exp_dir, n_checkpoints=1, fp16=True):
+    '''Slim checkpoint_best.pt (n_checkpoints=1) or average the last n_checkpoints into the default slim checkpoint'''
+    checkpoints_dir = Path(exp_dir) / 'checkpoints'
+    if n_checkpoints == 1:
+        checkpoint_paths = [checkpoints_dir / 'checkpoint_best.pt']
+    else:
+        checkpoint_paths = get_last_checkpoint_paths(checkpoints_dir, n_checkpoints)
+    assert len(checkpoint_paths) > 0 and all(Path(path).exists() for path in checkpoint_paths), \
+        f'No checkpoint to slim in {checkpoints_dir}'
+    if len(checkpoint_paths) < n_checkpoints:
+        print(f'Only {len(checkpoint_paths)} checkpoints available, averaging them')
+    return save_slim_checkpoint(checkpoint_paths, checkpoints_dir / SLIM_CHECKPOINT_NAME, fp16=fp16)
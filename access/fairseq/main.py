@@ -7,24 +7,34 @@
 
 from collections import defaultdict
 from functools import lru_cache
+import os
 import shutil, json
 
 from nevergrad.instrumentation import Instrumentation
 from nevergrad.optimization import optimizerlib
+import numpy as np
 import re
 
-from access.evaluation.general import evaluate_simplifier_on_turkcorpus
+from access.evaluation.general import (evaluate_simplifier_on_turkcorpus, evaluate_predictions_on_turkcorpus,
+                                       get_predictions_on_turkcorpus, get_turkcorpus_orig_and_refs_sents)
+from access.evaluation.turkcorpus import fast_evaluate_simplifier_on_turkcorpus
 from access.evaluation.utils import combine_metrics
 from access.fairseq.base import (fairseq_preprocess, fairseq_train, fairseq_generate, get_fairseq_exp_dir,
                                  )
+from access.fairseq.checkpoints import (get_last_checkpoint_paths, save_slim_checkpoint, get_inference_checkpoint_path,
+                                       SLIM_CHECKPOINT_NAME)
+from access.parametrization_store import (ParametrizationStore, get_parametrization_store_path, get_checkpoint_hash,
+                                          get_best_points)
 from access.resources.datasets import has_lines_in_common
 from access.preprocessors import get_preprocessors, get_preprocessor_by_name
 from access.resources.datasets import create_preprocessed_dataset
 from access.resources.paths import get_data_filepath, get_dataset_dir
-from access.simplifiers import get_fairseq_simplifier, get_preprocessed_simplifier
+from access.simplifiers import (get_fairseq_simplifier, get_preprocessed_simplifier, get_fairseq_sentences_simplifier,
+                                get_file_simplifier)
 from access.utils.training import (print_method_name, print_args, print_result, print_running_time,
                                    )
 from access.utils.helpers import get_allowed_kwargs
+from access.utils.profiling import profiling, profile_stage
 
 from access.resources.paths import BEST_MODEL_DIR
 from pathlib import Path
@@ -62,15 +72,93 @@ def get_simplifier(exp_dir, preprocessors_kwargs, generate_kwargs):
     return get_preprocessed_simplifier(simplifier, preprocessors=preprocessors)
 
 
-def find_best_parametrization(exp_dir, metrics_coefs, preprocessors_kwargs, parametrization_budget=64):
+def get_successive_halving_rungs(n_candidates, n_items, min_items_prop=1 / 16, reduction_factor=4):
+    '''[(n_candidates, n_items), ...] from all candidates on a few items to a few finalists on all items'''
+    rungs = []
+    items_prop = min_items_prop
+    while items_prop < 1 and n_candidates > 1:
+        rungs.append((n_candidates, max(int(n_items * items_prop), 1)))
+        n_candidates = max(n_candidates // reduction_factor, 1)
+        items_prop *= reduction_factor
+    rungs.append((n_candidates, n_items))
+    return rungs
+
+
+def successive_halving(candidates, evaluate, n_items, min_items_prop=1 / 16, reduction_factor=4, seed=0):
+    '''Multi-fidelity search: evaluate all candidates on a small random subset of the items, promote the best
+    1/reduction_factor of them to a reduction_factor times larger subset, and so on until the finalists get all items
+
+    evaluate(candidate, indexes) returns a loss (lower is better), indexes is None for the full set. Subsets are nested
+    so that per item results (e.g. memoized predictions) of a promoted candidate are reused. Returns the best finalist.
+    '''
+    shuffled_indexes = np.random.RandomState(seed).permutation(n_items)
+    for n_candidates, n_rung_items in get_successive_halving_rungs(len(candidates), n_items, min_items_prop,
+                                                                   reduction_factor):
+        indexes = tuple(sorted(shuffled_indexes[:n_rung_items].tolist())) if n_rung_items < n_items else None
+        candidates = candidates[:n_candidates]
+        losses = [evaluate(candidate, indexes) for candidate in candidates]
+        order = np.argsort(losses, kind='stable')
+        candidates = [candidates[i] for i in order]
+        print(f'successive_halving n_candidates={n_candidates} n_items={n_rung_items} best_loss={losses[order[0]]:.4f}')
+    return candidates[0]
+
+
+def is_valid_point(instru, instru_kwargs):
+    '''Points of another search can have other constants or values outside of the current variables'''
+    try:
+        instru.arguments_to_data(**instru_kwargs)
+    except (AssertionError, ValueError, KeyError, TypeError):
+        return False
+    return True
+
+
+def find_best_parametrization(exp_dir,
+                              metrics_coefs,
+                              preprocessors_kwargs,
+                              parametrization_budget=64,
+                              multi_fidelity=False,
+                              min_items_prop=1 / 16,
+                              reduction_factor=4,
+                              warm_start_exp_dirs=(),
+                              n_warm_start_points=8,
+                              warm_start_budget_prop=0.25,
+                              seed=0,
+                              fast_evaluation=False):
+    '''multi_fidelity=True only evaluates the finalists of a successive halving on the full turkcorpus valid set
+
+    fast_evaluation=True scores trials with access.evaluation.turkcorpus instead of easse, checked against easse on the
+    first trial.
+
+    Trials are persisted in exp_dir (see access.parametrization_store), a killed search resumes where it stopped.
+    When trials of other checkpoints exist (in exp_dir, e.g. before a fine-tuning, or in warm_start_exp_dirs, e.g. the
+    parent model), their n_warm_start_points best points are evaluated first and only warm_start_budget_prop of the
+    budget is used.
+    '''
+    store = ParametrizationStore(get_parametrization_store_path(exp_dir))
+    model_key = get_checkpoint_hash(get_inference_checkpoint_path(exp_dir))
+
+    def get_loss(scores):
+        return combine_metrics(scores['bleu'], scores['sari_legacy'], scores['fkgl'], metrics_coefs)
+
     @lru_cache()
-    def evaluate_parametrization(**instru_kwargs):
-        # Note that we use default generate kwargs instead of provided one because they are faster
-        preprocessors_kwargs = instru_kwargs_to_preprocessors_kwargs(instru_kwargs)
-        simplifier = get_simplifier(exp_dir, preprocessors_kwargs=preprocessors_kwargs, generate_kwargs={})
-        scores = evaluate_simplifier_on_turkcorpus(simplifier, phase='valid')
+    def evaluate_parametrization(indexes=None, **instru_kwargs):
+        scores = store.get(model_key, instru_kwargs, indexes)
+        if scores is None:
+            # Note that we use default generate kwargs instead of provided one because they are faster
+            preprocessors_kwargs = instru_kwargs_to_preprocessors_kwargs(instru_kwargs)
+            simplifier = get_simplifier(exp_dir, preprocessors_kwargs=preprocessors_kwargs, generate_kwargs={})
+            if fast_evaluation:
+                # Reference statistics are computed once for the whole search
+                scores = fast_evaluate_simplifier_on_turkcorpus(simplifier, phase='valid', indexes=indexes)
+            else:
+                scores = evaluate_predictions_on_turkcorpus(
+                    get_predictions_on_turkcorpus(simplifier, phase='valid', indexes=indexes),
+                    phase='valid',
+                    quality_estimation=False,
+                    indexes=indexes)
+            store.put(model_key, instru_kwargs, scores, indexes)
         print(scores)
-        return combine_metrics(scores['bleu'], scores['sari_legacy'], scores['fkgl'], metrics_coefs)
+        return get_loss(scores)
 
     def preprocessors_kwargs_to_instru_kwargs(preprocessors_kwargs):
         instru_kwargs = {}
@@ -98,11 +186,83 @@ def find_best_parametrization(exp_dir, metrics_coefs, preprocessors_kwargs, para
         return preprocessors_kwargs
     # No need to search a lot when there is only a few parameters
     parametrization_budget = min(32**instru.dimension, parametrization_budget)
+    warm_start_stores = [store] + [
+        ParametrizationStore(get_parametrization_store_path(warm_start_exp_dir))
+        for warm_start_exp_dir in warm_start_exp_dirs
+    ]
+    warm_start_points = [
+        point for point in get_best_points(warm_start_stores, get_loss, n_warm_start_points,
+                                           exclude_model_key=model_key) if is_valid_point(instru, point)
+    ]
+    if len(warm_start_points) > 0:
+        parametrization_budget = max(int(parametrization_budget * warm_start_budget_prop), len(warm_start_points))
+        print(f'Warm starting from {len(warm_start_points)} points, parametrization_budget={parametrization_budget}')
+    # Seeded so that a resumed search samples the same points as the killed one
+    instru.random_state = np.random.RandomState(seed)
     optimizer = optimizerlib.ScrHammersleySearch(instrumentation=instru, budget=parametrization_budget, num_workers=1)
-    recommendation = optimizer.optimize(evaluate_parametrization, verbosity=0)
+    # Suggestions are asked last in first out, the best point is evaluated first
+    for point in reversed(warm_start_points):
+        optimizer.suggest(**point)
+    if multi_fidelity:
+        # The Hammersley points do not depend on previous evaluations, they can all be sampled upfront
+        candidates = [optimizer.ask() for _ in range(parametrization_budget)]
+        # Predictions are memoized per sentence in the prediction store, promoted candidates only decode new sentences
+        recommendation = successive_halving(
+            candidates,
+            lambda candidate, indexes: evaluate_parametrization(indexes=indexes, **candidate.kwargs),
+            n_items=len(get_turkcorpus_orig_and_refs_sents('valid')[0]),
+            min_items_prop=min_items_prop,
+            reduction_factor=reduction_factor)
+    else:
+        recommendation = optimizer.optimize(evaluate_parametrization, verbosity=0)
     return instru_kwargs_to_preprocessors_kwargs(recommendation.kwargs)
 
 
+def select_ensemble_or_averaged_model(exp_dir, preprocessors_kwargs, n_checkpoints=5, max_sari_drop=0.5,
+                                      generate_kwargs=None):
+    '''Decode with an ensemble of the last n_checkpoints, or with their average when it is almost as good
+
+    Both are compared on turkcorpus valid. The averaged model is a single model, hence n_checkpoints times cheaper to
+    decode. When it is selected it becomes the default slim checkpoint of exp_dir. Returns the checkpoint paths to use.
+    '''
+    if generate_kwargs is None:
+        generate_kwargs = {}
+    checkpoints_dir = Path(exp_dir) / 'checkpoints'
+    # Update checkpoints are kept by training with keep_interval_updates > 0 (see access.fairseq.base.fairseq_train)
+    checkpoint_paths = get_last_checkpoint_paths(checkpoints_dir, n_checkpoints)
+    if len(checkpoint_paths) == 0:
+        print(f'No update checkpoint in {checkpoints_dir}, nothing to ensemble')
+        checkpoint_paths = [checkpoints_dir / 'checkpoint_best.pt']
+    assert all(Path(path).exists() for path in checkpoint_paths), f'No checkpoint in {checkpoints_dir}'
+    if len(checkpoint_paths) == 1:
+        return checkpoint_paths
+    if len(checkpoint_paths) < n_checkpoints:
+        print(f'Only {len(checkpoint_paths)} update checkpoints available')
+    averaged_checkpoint_path = save_slim_checkpoint(checkpoint_paths,
+                                                    checkpoints_dir / f'checkpoint_average{len(checkpoint_paths)}.pt')
+
+    def evaluate_checkpoints(checkpoint_paths):
+        simplifier = get_fairseq_sentences_simplifier(exp_dir,
+                                                      preprocessors=get_preprocessors(preprocessors_kwargs),
+                                                      checkpoint_paths=checkpoint_paths,
+                                                      **generate_kwargs)
+        return evaluate_simplifier_on_turkcorpus(get_file_simplifier(simplifier), phase='valid')['sari_legacy']
+
+    try:
+        ensemble_sari = evaluate_checkpoints(checkpoint_paths)
+        averaged_sari = evaluate_checkpoints([averaged_checkpoint_path])
+    except BaseException:
+        os.remove(averaged_checkpoint_path)
+        raise
+    print(f'ensemble_sari={ensemble_sari:.2f} averaged_sari={averaged_sari:.2f} n_checkpoints={len(checkpoint_paths)}')
+    if averaged_sari < ensemble_sari - max_sari_drop:
+        # The ensemble is kept, the averaged checkpoint is not used anywhere
+        os.remove(averaged_checkpoint_path)
+        return checkpoint_paths
+    os.replace(averaged_checkpoint_path, checkpoints_dir / SLIM_CHECKPOINT_NAME)
+    return [checkpoints_dir / SLIM_CHECKPOINT_NAME]
+
+
 def check_and_resolve_args(kwargs):
     if kwargs.get('diverse_beam_groups_ratio', None) is not None:
         diverse_beam_groups = max(int(kwargs['beam'] * kwargs['diverse_beam_groups_ratio']), 1)
@@ -118,11 +278,12 @@ def check_and_resolve_args(kwargs):
 @print_args
 @print_result
 @print_running_time
-def fairseq_train_and_evaluate(dataset, metrics_coefs=[1, 1, 1], parametrization_budget=64, **kwargs):
+def fairseq_train_and_evaluate(dataset, metrics_coefs=[1, 1, 1], parametrization_budget=64, profile=None, **kwargs):
     print("Starting MLFlow run...")
 
     # MLFlow: set tracking URI and experiment
-    mlflow.set_tracking_uri("http://34.118.112.8:3003")
+    # MLFLOW_TRACKING_URI overrides the server, e.g. with a local file store (file:///tmp/mlruns) for tests
+    mlflow.set_tracking_uri(os.environ.get('MLFLOW_TRACKING_URI', "http://34.118.112.8:3003"))
     mlflow.set_experiment("fairseq_access")
     
     with mlflow.start_run():
@@ -131,16 +292,19 @@ def fairseq_train_and_evaluate(dataset, metrics_coefs=[1, 1, 1], parametrization
         exp_dir = prepare_exp_dir()        
         preprocessors_kwargs = kwargs.get('preprocessors_kwargs', {})
         preprocessors = get_preprocessors(preprocessors_kwargs)
-        if len(preprocessors) > 0:
-            dataset = create_preprocessed_dataset(dataset, preprocessors, n_jobs=1)
-            shutil.copy(get_dataset_dir(dataset) / 'preprocessors.pickle', exp_dir)
-        preprocessed_dir = fairseq_preprocess(dataset)
-        train_kwargs = get_allowed_kwargs(fairseq_train, preprocessed_dir, exp_dir, **kwargs)
+        # Profiling is opt-in (profile=True or ACCESS_PROFILING=1), the report is written to exp_dir/profiling.json
+        with profiling(exp_dir, enabled=profile):
+            if len(preprocessors) > 0:
+                with profile_stage('create_preprocessed_dataset'):
+                    dataset = create_preprocessed_dataset(dataset, preprocessors, n_jobs=1)
+                shutil.copy(get_dataset_dir(dataset) / 'preprocessors.pickle', exp_dir)
+            preprocessed_dir = fairseq_preprocess(dataset)
+            train_kwargs = get_allowed_kwargs(fairseq_train, preprocessed_dir, exp_dir, **kwargs)
 
-        # MLFlow: log dictionaries and preprocessors
-        mlflow.log_artifact(exp_dir)
+            # MLFlow: log dictionaries and preprocessors
+            mlflow.log_artifact(exp_dir)
 
-        fairseq_train(preprocessed_dir, exp_dir=exp_dir, **train_kwargs)
+            fairseq_train(preprocessed_dir, exp_dir=exp_dir, **train_kwargs)
         # Evaluation
         generate_kwargs = get_allowed_kwargs(fairseq_generate, 'complex_filepath', 'pred_filepath', exp_dir, **kwargs)
         # recommended_preprocessors_kwargs = find_best_parametrization(exp_dir, metrics_coefs, preprocessors_kwargs,
@@ -14,6 +14,7 @@ import itertools
 import os
 import math
 import random
+import shutil
 
 import torch
 import mlflow
@@ -24,6 +25,10 @@ from fairseq.trainer import Trainer
 from fairseq.meters import AverageMeter, StopwatchMeter, TimeMeter
 from fairseq.utils import import_user_module
 
+from access.fairseq.async_validation import AsyncSariValidator, remove_snapshot
+from access.utils.profiling import profile_stage
+from access.utils.uploads import BackgroundUploader, NoUploader, mlflow_upload
+
 print("Imported fairseq.train")
 
 
@@ -44,7 +49,8 @@ def main(args, init_distributed=False):
     task = tasks.setup_task(args)
 
     # Load dataset splits
-    load_dataset_splits(task, ['train', 'valid'])
+    with profile_stage('train_load_datasets'):
+        load_dataset_splits(task, ['train', 'valid'])
 
     # Initialize distributed training (after data loading)
     if init_distributed:
@@ -53,8 +59,9 @@ def main(args, init_distributed=False):
         print('| initialized host {} as rank {}'.format(socket.gethostname(), args.distributed_rank))
 
     # Build model and criterion
-    model = task.build_model(args)
-    criterion = task.build_criterion(args)
+    with profile_stage('train_build_model'):
+        model = task.build_model(args)
+        criterion = task.build_criterion(args)
     print(model)
     print('| model {}, criterion {}'.format(args.arch, criterion.__class__.__name__))
     print('| num. model params: {} (num. trained: {})'.format(
@@ -81,64 +88,88 @@ def main(args, init_distributed=False):
     ))
 
     # Initialize dataloader
-    epoch_itr = task.get_batch_iterator(
-        dataset=task.dataset(args.train_subset),
-        max_tokens=args.max_tokens,
-        max_sentences=args.max_sentences,
-        max_positions=max_positions,
-        ignore_invalid_inputs=True,
-        required_batch_size_multiple=args.required_batch_size_multiple,
-        seed=args.seed,
-        num_shards=args.distributed_world_size,
-        shard_id=args.distributed_rank,
-        num_workers=args.num_workers,
-    )
+    with profile_stage('train_batch_iterator'):
+        epoch_itr = task.get_batch_iterator(
+            dataset=task.dataset(args.train_subset),
+            max_tokens=args.max_tokens,
+            max_sentences=args.max_sentences,
+            max_positions=max_positions,
+            ignore_invalid_inputs=True,
+            required_batch_size_multiple=args.required_batch_size_multiple,
+            seed=args.seed,
+            num_shards=args.distributed_world_size,
+            shard_id=args.distributed_rank,
+            num_workers=args.num_workers,
+        )
 
     # Load the latest checkpoint if one is available
-    if not load_checkpoint(args, trainer, epoch_itr):
-        trainer.dummy_train_step([dummy_batch])
-
-    # Train until the learning rate gets too small
-    max_epoch = args.max_epoch or math.inf
-    max_update = args.max_update or math.inf
-    lr = trainer.get_lr()
-    train_meter = StopwatchMeter()
-    train_meter.start()
-    valid_losses = [None]
-    valid_subsets = args.valid_subset.split(',')
-    while lr > args.min_lr and epoch_itr.epoch < max_epoch and trainer.get_num_updates() < max_update:
-        # train for one epoch
-        print('Args dir:', args.save_dir)
-        train(args, trainer, task, epoch_itr)
-        if getattr(trainer, 'early_stopping', False):
-            break
-
-        if epoch_itr.epoch % args.validate_interval == 0:
-            valid_losses = sari_validate(args, trainer, task, epoch_itr, valid_subsets)
-            sari = -valid_losses[0]
-            # MLFlow: Log validation loss and SARI
-            mlflow.log_metric('validation_loss', valid_losses[0], step=epoch_itr.epoch)
-            mlflow.log_metric('SARI', sari, step=epoch_itr.epoch)
-        if getattr(trainer, 'early_stopping', False):
-            break
-
-        # only use first validation loss to update the learning rate
-        lr = trainer.lr_step(epoch_itr.epoch, valid_losses[0])
-
-        # save checkpoint
-        if epoch_itr.epoch % args.save_interval == 0:
-            if sari > 35:
-                save_checkpoint(args, trainer, epoch_itr, valid_losses[0])
-                # MLFlow: Log checkpoints
-                mlflow.log_artifact(args.save_dir + '/checkpoint_best.pt')
-                mlflow.log_artifact(args.save_dir + '/checkpoint_last.pt')
+    with profile_stage('train_load_checkpoint'):
+        if not load_checkpoint(args, trainer, epoch_itr):
+            trainer.dummy_train_step([dummy_batch])
+
+    # Checkpoints are uploaded to MLflow in the background while training goes on
+    active_run = mlflow.active_run()
+    if active_run is not None:
+        uploader = BackgroundUploader(mlflow_upload(active_run.info.run_id),
+                                      staging_dir=os.path.join(args.save_dir, '.uploads'))
+    else:
+        print('Warning: No active mlflow run, checkpoints will not be uploaded')
+        uploader = NoUploader()
+    # SARI validation runs in a worker process while training goes on, see access.fairseq.async_validation
+    validator = AsyncSariValidator(args) if getattr(args, 'async_sari_validation', False) else None
+    training_succeeded = False
+    try:
+        # Train until the learning rate gets too small
+        max_epoch = args.max_epoch or math.inf
+        max_update = args.max_update or math.inf
+        lr = trainer.get_lr()
+        train_meter = StopwatchMeter()
+        train_meter.start()
+        valid_losses = [None]
+        valid_subsets = args.valid_subset.split(',')
+        while lr > args.min_lr and epoch_itr.epoch < max_epoch and trainer.get_num_updates() < max_update:
+            # train for one epoch
+            print('Args dir:', args.save_dir)
+            train(args, trainer, task, epoch_itr, uploader, validator)
+            if getattr(trainer, 'early_stopping', False):
+                break
+
+            if epoch_itr.epoch % args.validate_interval == 0 and validator is not None:
+                # Losses of the validations that finished meanwhile, if any
+                valid_losses = submit_sari_validation(args, trainer, epoch_itr, validator, uploader) or valid_losses
+            elif epoch_itr.epoch % args.validate_interval == 0:
+                valid_losses = sari_validate(args, trainer, task, epoch_itr, valid_subsets)
+                sari = -valid_losses[0]
+                # MLFlow: Log validation loss and SARI
+                mlflow.log_metric('validation_loss', valid_losses[0], step=epoch_itr.epoch)
+                mlflow.log_metric('SARI', sari, step=epoch_itr.epoch)
+            if getattr(trainer, 'early_stopping', False):
+                break
+
+            # only use first validation loss to update the learning rate
+            lr = trainer.lr_step(epoch_itr.epoch, valid_losses[0])
+
+            # save checkpoint, asynchronous validations save their own snapshots
+            if epoch_itr.epoch % args.save_interval == 0 and validator is None:
+                if sari > 35:
+                    # MLFlow: Log checkpoints, uploaded in the background
+                    for checkpoint_path in save_checkpoint(args, trainer, epoch_itr, valid_losses[0]):
+                        uploader.submit(checkpoint_path)
+        if validator is not None:
+            apply_sari_results(args, trainer, epoch_itr, uploader, validator.close())
+        training_succeeded = True
+    finally:
+        if validator is not None:
+            validator.terminate()
+        # Failed uploads are only raised once training is over, and never in place of an error of the training
+        uploader.close(raise_errors=training_succeeded)
     train_meter.stop()
     # MLFlow: Log training time
     mlflow.log_metric('training_time_seconds', train_meter.sum)
     print('| done training in {:.1f} seconds'.format(train_meter.sum))
 
 
-def train(args, trainer, task, epoch_itr):
+def train(args, trainer, task, epoch_itr, uploader, validator=None):
     """Train the model for one epoch."""
     # Update parameters every N batches
     update_freq = args.update_freq[epoch_itr.epoch - 1] \
@@ -197,14 +228,18 @@ def train(args, trainer, task, epoch_itr):
             trainer.get_meter('wps').reset()
 
         num_updates = trainer.get_num_updates()
-        if args.save_interval_updates > 0 and num_updates % args.save_interval_updates == 0 and num_updates > 0:
+        if validator is not None:
+            apply_sari_results(args, trainer, epoch_itr, uploader, validator.poll())
+        if args.save_interval_updates > 0 and num_updates % args.save_interval_updates == 0 and num_updates > 0 \
+                and validator is not None:
+            submit_sari_validation(args, trainer, epoch_itr, validator, uploader)
+        elif args.save_interval_updates > 0 and num_updates % args.save_interval_updates == 0 and num_updates > 0:
             valid_losses = sari_validate(args, trainer, task, epoch_itr, [first_valid])
             sari = -valid_losses[0]
             if sari > 35:
-                save_checkpoint(args, trainer, epoch_itr, valid_losses[0])
-                # MLFlow: Log checkpoints
-                mlflow.log_artifact(args.save_dir + '/checkpoint_best.pt')
-                mlflow.log_artifact(args.save_dir + '/checkpoint_last.pt')
+                # MLFlow: Log checkpoints, uploaded in the background
+                for checkpoint_path in save_checkpoint(args, trainer, epoch_itr, valid_losses[0]):
+                    uploader.submit(checkpoint_path)
         if getattr(trainer, 'early_stopping', False):
             break
 
@@ -373,6 +408,15 @@ def sari_validate(args, trainer, task, epoch_itr, subsets):
                      for i in range(8)]
     scores = get_all_scores(read_lines(complex_filepath), read_lines(pred_filepath), [read_lines(ref_filepath) for ref_filepath in ref_filepaths])
 
+    log_sari_scores(scores)
+    print(f'num_updates={trainer.get_num_updates()}')
+    print(f'ts_scores={scores}')
+    sari = scores['SARI']
+    update_best_sari(args, trainer, sari)
+    return [-sari]
+
+
+def log_sari_scores(scores, step=None):
     # MLFlow: Log scores
     try: 
         mlflow.log_metrics({
@@ -386,14 +430,13 @@ def sari_validate(args, trainer, task, epoch_itr, subsets):
             'additions_proportion': scores['Additions proportion'],
             'deletions_proportion': scores['Deletions proportion'],
             'lexical_complexity': scores['Lexical complexity score']
-        })
+        }, step=step)
     except Exception as e:
         print(f"Error logging metrics to MLFlow: {e}")
         print(scores)
 
-    print(f'num_updates={trainer.get_num_updates()}')
-    print(f'ts_scores={scores}')
-    sari = scores['SARI']
+
+def update_best_sari(args, trainer, sari):
     if not hasattr(trainer, 'best_sari'):
         trainer.best_sari = 0
     if not hasattr(trainer, 'n_validations_since_best'):
@@ -423,7 +466,6 @@ def sari_validate(args, trainer, task, epoch_itr, subsets):
         #     # Remove the checkpoint directory as we got nothing interesting
         #     shutil.rmtree(args.save_dir)
         #     # TODO: Abort
-    return [-sari]
 
 
 def get_valid_stats(trainer):
@@ -448,9 +490,14 @@ def get_perplexity(loss):
         return float('inf')
 
 
-def save_checkpoint(args, trainer, epoch_itr, val_loss):
+def save_checkpoint(args, trainer, epoch_itr, val_loss, snapshot_path=None):
+    '''Returns the paths of the checkpoints that were written
+
+    With snapshot_path (see access.fairseq.async_validation), the validated state is older than the current one: only
+    checkpoint_best.pt is linked to it, checkpoint_last.pt was linked when it was saved (see submit_sari_validation()).
+    '''
     if args.no_save or not distributed_utils.is_master(args):
-        return
+        return []
     epoch = epoch_itr.epoch
     end_of_epoch = epoch_itr.end_of_epoch()
     updates = trainer.get_num_updates()
@@ -460,7 +507,13 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss):
             val_loss is not None and
             (not hasattr(save_checkpoint, 'best') or val_loss < save_checkpoint.best)
     )
-    checkpoint_conds['checkpoint_last.pt'] = True  # keep this last so that it's a symlink
+    # The last keep_interval_updates of these are averaged by access.fairseq.checkpoints.create_slim_checkpoint(),
+    # asynchronous validations keep theirs when the snapshot is taken (see submit_sari_validation())
+    checkpoint_conds['checkpoint_{}_{}.pt'.format(epoch, updates)] = (
+            snapshot_path is None and not end_of_epoch and args.keep_interval_updates > 0 and
+            args.save_interval_updates > 0 and updates % args.save_interval_updates == 0
+    )
+    checkpoint_conds['checkpoint_last.pt'] = snapshot_path is None  # keep this last so that it's a symlink
 
     prev_best = getattr(save_checkpoint, 'best', val_loss)
     if val_loss is not None:
@@ -472,11 +525,21 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss):
     if hasattr(save_checkpoint, 'best'):
         extra_state.update({'best': save_checkpoint.best})
 
-    checkpoints = [os.path.join(args.save_dir, fn) for fn, cond in checkpoint_conds.items() if cond]
-    if len(checkpoints) > 0:
-        for cp in checkpoints:
-            trainer.save_checkpoint(cp, extra_state)
-
+    written_paths = [os.path.join(args.save_dir, fn) for fn, cond in checkpoint_conds.items() if cond]
+    linked_paths = written_paths
+    if len(written_paths) > 0 and snapshot_path is None:
+        # The state is serialized once, the other names are hardlinks to the same file
+        snapshot_path = f'{written_paths[0]}.tmp'
+        trainer.save_checkpoint(snapshot_path, extra_state)
+        os.replace(snapshot_path, written_paths[0])
+        snapshot_path, linked_paths = written_paths[0], written_paths[1:]
+    for cp in linked_paths:
+        replace_with_link(snapshot_path, cp)
+    remove_old_checkpoints(args, end_of_epoch)
+    return written_paths
+
+
+def remove_old_checkpoints(args, end_of_epoch):
     if not end_of_epoch and args.keep_interval_updates > 0:
         # remove old checkpoints; checkpoints are sorted in descending order
         checkpoints = utils.checkpoint_paths(args.save_dir, pattern=r'checkpoint_\d+_(\d+)\.pt')
@@ -492,6 +555,61 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss):
                 os.remove(old_chk)
 
 
+def replace_with_link(source_path, target_path):
+    '''Checkpoints are always replaced and never written in place, which would also modify their hardlinks'''
+    tmp_target_path = f'{target_path}.tmp'
+    if os.path.lexists(tmp_target_path):
+        os.remove(tmp_target_path)
+    try:
+        os.link(source_path, tmp_target_path)
+    except OSError:
+        # e.g. filesystems without hardlinks
+        shutil.copyfile(source_path, tmp_target_path)
+    os.replace(tmp_target_path, target_path)
+
+
+def submit_sari_validation(args, trainer, epoch_itr, validator, uploader):
+    '''Asynchronous counterpart of sari_validate() followed by save_checkpoint()
+
+    Returns the validation losses of the validations that finished meanwhile, None if there is none.
+    '''
+    num_updates = trainer.get_num_updates()
+    snapshot_path = validator.get_snapshot_path(num_updates)
+    extra_state = {'train_iterator': epoch_itr.state_dict(), 'val_loss': None}
+    if hasattr(save_checkpoint, 'best'):
+        extra_state['best'] = save_checkpoint.best
+    tmp_snapshot_path = f'{snapshot_path}.tmp'
+    trainer.save_checkpoint(tmp_snapshot_path, extra_state)
+    os.replace(tmp_snapshot_path, snapshot_path)
+    if distributed_utils.is_master(args) and not args.no_save:
+        # The snapshot is the latest state, the result of its validation only decides on checkpoint_best.pt
+        replace_with_link(snapshot_path, os.path.join(args.save_dir, 'checkpoint_last.pt'))
+        if args.keep_interval_updates > 0:
+            # Kept whatever its SARI (not known yet), to be averaged as those of save_checkpoint()
+            replace_with_link(snapshot_path,
+                              os.path.join(args.save_dir, f'checkpoint_{epoch_itr.epoch}_{num_updates}.pt'))
+            remove_old_checkpoints(args, epoch_itr.end_of_epoch())
+    return apply_sari_results(args, trainer, epoch_itr, uploader, validator.submit(num_updates, snapshot_path))
+
+
+def apply_sari_results(args, trainer, epoch_itr, uploader, results):
+    '''Results of the asynchronous validations, in the order they were submitted'''
+    valid_losses = None
+    for num_updates, snapshot_path, scores in results:
+        print(f'num_updates={num_updates} (asynchronous validation)')
+        print(f'ts_scores={scores}')
+        log_sari_scores(scores, step=num_updates)
+        sari = scores['SARI']
+        update_best_sari(args, trainer, sari)
+        if sari > 35:
+            # MLFlow: Log checkpoints, uploaded in the background
+            for checkpoint_path in save_checkpoint(args, trainer, epoch_itr, -sari, snapshot_path=snapshot_path):
+                uploader.submit(checkpoint_path)
+        remove_snapshot(snapshot_path)
+        valid_losses = [-sari]
+    return valid_losses
+
+
 def load_checkpoint(args, trainer, epoch_itr):
     """Load a checkpoint and replay dataloader to match."""
     os.makedirs(args.save_dir, exist_ok=True)
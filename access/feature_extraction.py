@@ -11,13 +11,25 @@ import Levenshtein
 import numpy as np
 
 from access.resources.paths import FASTTEXT_EMBEDDINGS_PATH
-from access.resources.prepare import prepare_fasttext_embeddings
 from access.text import (to_words, remove_punctuation_tokens, remove_stopwords, spacy_process)
 from access.utils.helpers import yield_lines
 
+# Set with set_word2rank() to serve ranks from another mapping (e.g. a model bundle) than the fasttext embeddings
+_word2rank = None
+
+
+def set_word2rank(word2rank):
+    global _word2rank
+    _word2rank = word2rank
+    get_word2rank.cache_clear()
+
 
 @lru_cache(maxsize=1)
 def get_word2rank(vocab_size=np.inf):
+    if _word2rank is not None:
+        return _word2rank
+    # Imported here, access.resources.prepare pulls in the training dependencies
+    from access.resources.prepare import prepare_fasttext_embeddings
     prepare_fasttext_embeddings()
     # TODO: Decrease vocab size or load from smaller file
     word2rank = {}
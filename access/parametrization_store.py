@@ -0,0 +1,117 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from functools import lru_cache
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import time
+'''Persistent history of the parametrization search trials of an experiment
+
+Trials are keyed by the hash of the checkpoint content and by the instrumentation kwargs (and evaluated subset, see the
+multi-fidelity search). Scores are stored rather than the combined loss so that trials can be reused with other
+metrics_coefs. A killed search finds its completed trials when restarted, and the best points of other checkpoints
+(e.g. the parent of a fine-tuned model) can seed a new search.
+'''
+
+PARAMETRIZATION_STORE_NAME = 'parametrization_trials.sqlite'
+
+
+def get_parametrization_store_path(exp_dir):
+    return Path(exp_dir) / PARAMETRIZATION_STORE_NAME
+
+
+@lru_cache(maxsize=8)
+def _get_checkpoint_hash(checkpoint_path, size, mtime_ns):
+    sha1 = hashlib.sha1()
+    with open(checkpoint_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**24), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_checkpoint_hash(checkpoint_path):
+    '''Content hash, stable across copies and moves of the checkpoint, computed once per process'''
+    checkpoint_path = Path(checkpoint_path).resolve()
+    stat = checkpoint_path.stat()
+    return _get_checkpoint_hash(str(checkpoint_path), stat.st_size, stat.st_mtime_ns)
+
+
+def get_trial_key(instru_kwargs, indexes=None):
+    trial_description = {'instru_kwargs': instru_kwargs, 'indexes': list(indexes) if indexes is not None else None}
+    return hashlib.md5(json.dumps(trial_description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ParametrizationStore:
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared with child processes, each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.db_path), timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS trials (model_key TEXT, trial_key TEXT, '
+                                     'instru_kwargs TEXT, n_items INTEGER, scores TEXT, created REAL, '
+                                     'PRIMARY KEY (model_key, trial_key)) WITHOUT ROWID')
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, model_key, instru_kwargs, indexes=None):
+        row = self.connection.execute('SELECT scores FROM trials WHERE model_key = ? AND trial_key = ?',
+                                      [model_key, get_trial_key(instru_kwargs, indexes)]).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, model_key, instru_kwargs, scores, indexes=None):
+        # Each trial is committed right away, this is what makes a killed search resumable
+        n_items = len(indexes) if indexes is not None else None
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)', [
+                model_key,
+                get_trial_key(instru_kwargs, indexes),
+                json.dumps(instru_kwargs, sort_keys=True, default=str),
+                n_items,
+                json.dumps(scores, default=float),
+                time.time(),
+            ])
+
+    def get_model_keys(self):
+        '''Most recently evaluated first'''
+        query = 'SELECT model_key FROM trials GROUP BY model_key ORDER BY MAX(created) DESC'
+        return [model_key for model_key, in self.connection.execute(query).fetchall()]
+
+    def get_full_trials(self, model_key):
+        '''[(instru_kwargs, scores), ...] of the trials evaluated on the full set'''
+        query = 'SELECT instru_kwargs, scores FROM trials WHERE model_key = ? AND n_items IS NULL'
+        return [(json.loads(instru_kwargs), json.loads(scores))
+                for instru_kwargs, scores in self.connection.execute(query, [model_key]).fetchall()]
+
+
+def get_best_points(stores, get_loss, n_points, exclude_model_key=None):
+    '''Best instru_kwargs evaluated on the full set across stores, for checkpoints other than exclude_model_key'''
+    points = []
+    for store in stores:
+        if not store.db_path.exists():
+            continue
+        for model_key in store.get_model_keys():
+            if model_key == exclude_model_key:
+                continue
+            points.extend(
+                (get_loss(scores), instru_kwargs) for instru_kwargs, scores in store.get_full_trials(model_key))
+    best_points = []
+    for _, instru_kwargs in sorted(points, key=lambda point: point[0]):
+        if instru_kwargs not in best_points:
+            best_points.append(instru_kwargs)
+        if len(best_points) == n_points:
+            break
+    return best_points
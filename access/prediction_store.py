@@ -0,0 +1,143 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from access.resources.paths import PREDICTION_STORE_PATH
+from access.utils.metrics import PREDICTION_STORE_LOOKUPS
+'''Persistent line-level store of model predictions
+
+Predictions are keyed by the model (checkpoint identity and generation kwargs) and by the hash of each encoded source
+line. Encoded lines carry the control tokens and sentencepiece pieces, i.e. they identify the preprocessors that
+produced them, so a line seen with the same settings in an earlier run or search trial is never decoded again.
+Only the predictions of the max_models most recently used models are kept (each validation checkpoint is a new model).
+'''
+
+# Generation kwargs that do not change the predictions
+RUNTIME_KWARGS = ['batch_size', 'num_threads', 'num_interop_threads']
+SQLITE_MAX_VARIABLES = 900
+MAX_MODELS = 32
+logger = logging.getLogger(__name__)
+
+
+def get_checkpoint_identity(checkpoint_path):
+    checkpoint_path = Path(checkpoint_path).resolve()
+    stat = checkpoint_path.stat()
+    return [str(checkpoint_path), stat.st_size, stat.st_mtime_ns]
+
+
+def get_model_key(checkpoint_paths, generate_kwargs):
+    generate_kwargs = {key: value for key, value in generate_kwargs.items() if key not in RUNTIME_KWARGS}
+    model_description = {
+        'checkpoints': [get_checkpoint_identity(checkpoint_path) for checkpoint_path in checkpoint_paths],
+        'generate_kwargs': generate_kwargs,
+    }
+    return hashlib.md5(json.dumps(model_description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_line(line):
+    return hashlib.sha1(line.encode()).hexdigest()
+
+
+class PredictionStore:
+    def __init__(self, db_path=PREDICTION_STORE_PATH, max_models=MAX_MODELS):
+        self.db_path = Path(db_path)
+        self.max_models = max_models
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared with other threads (e.g. API requests) nor with child processes,
+        # each thread of each process opens its own
+        local = self._local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            local.connection = sqlite3.connect(str(self.db_path), timeout=60)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('CREATE TABLE IF NOT EXISTS predictions (model_key TEXT, line_hash TEXT, '
+                                     'prediction TEXT, PRIMARY KEY (model_key, line_hash)) WITHOUT ROWID')
+            local.connection.execute('CREATE TABLE IF NOT EXISTS models (model_key TEXT PRIMARY KEY, last_used REAL)')
+            local.pid = os.getpid()
+        return local.connection
+
+    def touch(self, model_key):
+        '''Mark model_key as used, returns True if it is a new model'''
+        with self.connection:
+            is_new_model = self.connection.execute('UPDATE models SET last_used = ? WHERE model_key = ?',
+                                                   [time.time(), model_key]).rowcount == 0
+            if is_new_model:
+                self.connection.execute('INSERT OR REPLACE INTO models VALUES (?, ?)', [model_key, time.time()])
+        return is_new_model
+
+    def prune(self):
+        '''Delete the predictions of all but the max_models most recently used models'''
+        kept_models_query = 'SELECT model_key FROM models ORDER BY last_used DESC LIMIT ?'
+        with self.connection:
+            n_deleted = self.connection.execute(f'DELETE FROM predictions WHERE model_key NOT IN ({kept_models_query})',
+                                                [self.max_models]).rowcount
+            self.connection.execute(f'DELETE FROM models WHERE model_key NOT IN ({kept_models_query})',
+                                    [self.max_models])
+        if n_deleted > 0:
+            logger.info(f'Pruned {n_deleted} predictions from {self.db_path}')
+
+    def get(self, model_key, line_hashes):
+        line_hashes = list(line_hashes)
+        predictions = {}
+        for i in range(0, len(line_hashes), SQLITE_MAX_VARIABLES):
+            chunk = line_hashes[i:i + SQLITE_MAX_VARIABLES]
+            query = (f'SELECT line_hash, prediction FROM predictions '
+                     f'WHERE model_key = ? AND line_hash IN ({", ".join("?" * len(chunk))})')
+            predictions.update(self.connection.execute(query, [model_key] + chunk).fetchall())
+        return predictions
+
+    def put(self, model_key, line_hashes, predictions):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                        [(model_key, line_hash, prediction)
+                                         for line_hash, prediction in zip(line_hashes, predictions)])
+        # Pruning scans the table, it only runs when a new model shows up
+        if self.touch(model_key):
+            self.prune()
+
+
+def memoize_predictions(generate_lines, get_model_key, store=None):
+    '''Wrap generate_lines(lines) -> predictions so that only lines missing from the store are decoded
+
+    get_model_key() is called at each call, before looking up the store and again after decoding: predictions are not
+    stored if the model (e.g. the inference checkpoint) changed in between.
+    '''
+    if store is None:
+        store = PredictionStore()
+
+    def memoized_generate_lines(lines):
+        model_key = get_model_key()
+        line_hashes = [hash_line(line) for line in lines]
+        predictions = store.get(model_key, set(line_hashes))
+        # Identical lines are decoded only once
+        missing_lines = {line_hash: line for line_hash, line in zip(line_hashes, lines) if line_hash not in predictions}
+        logger.debug(f'prediction_store_hits={len(lines) - len(missing_lines)} misses={len(missing_lines)}')
+        PREDICTION_STORE_LOOKUPS.inc(len(lines) - len(missing_lines), result='hit')
+        PREDICTION_STORE_LOOKUPS.inc(len(missing_lines), result='miss')
+        if len(missing_lines) > 0:
+            missing_predictions = generate_lines(list(missing_lines.values()))
+            if get_model_key() == model_key:
+                store.put(model_key, missing_lines.keys(), missing_predictions)
+            else:
+                logger.warning('The model changed while decoding, predictions are not stored')
+            predictions.update(zip(missing_lines.keys(), missing_predictions))
+        else:
+            store.touch(model_key)
+        return [predictions[line_hash] for line_hash in line_hashes]
+
+    return memoized_generate_lines
@@ -10,9 +10,6 @@ import multiprocessing
 import random
 import re
 
-from joblib import Parallel, delayed
-import torch
-
 from access.text import to_words
 from access.utils.helpers import (open_files, yield_lines, yield_lines_in_parallel, get_temp_filepath, delete_files,
                                   get_temp_filepaths)
@@ -28,25 +25,47 @@ def apply_line_method_to_file(line_method, input_filepath):
     return output_filepath
 
 
-def replace_lrb_rrb(text):
-    text = re.sub(r'-lrb-', '(', text, flags=re.IGNORECASE)
-    text = re.sub(r'-rrb-', ')', text, flags=re.IGNORECASE)
-    text = re.sub(r'-lsb-', '[', text, flags=re.IGNORECASE)
-    text = re.sub(r'-rsb-', ']', text, flags=re.IGNORECASE)
-    text = re.sub(r'-lcb-', '{', text, flags=re.IGNORECASE)
-    text = re.sub(r'-rcb-', '}', text, flags=re.IGNORECASE)
+LRB_RRB_PATTERNS = [(re.compile(pattern, flags=re.IGNORECASE), replacement) for pattern, replacement in [
+    (r'-lrb-', '('),
+    (r'-rrb-', ')'),
+    (r'-lsb-', '['),
+    (r'-rsb-', ']'),
+    (r'-lcb-', '{'),
+    (r'-rcb-', '}'),
+]]
+# TODO: Very basic
+TO_LRB_RRB_PATTERNS = [
+    (re.compile(r'((^| ))\( '), r'\1-lrb- '),
+    (re.compile(r' \)((^| ))'), r' -rrb-\1'),
+]
+
+
+def compose_line_methods(*line_methods):
+    '''Chain line methods (str -> str) into one, e.g. to normalize predictions in memory'''
+    def composed_line_method(line):
+        for line_method in line_methods:
+            line = line_method(line)
+        return line
+
+    return composed_line_method
+
+
+def replace_patterns(text, patterns):
+    for pattern, replacement in patterns:
+        text = pattern.sub(replacement, text)
     return text
 
 
+def replace_lrb_rrb(text):
+    return replace_patterns(text, LRB_RRB_PATTERNS)
+
+
 def replace_lrb_rrb_file(filepath):
     return apply_line_method_to_file(replace_lrb_rrb, filepath)
 
 
 def to_lrb_rrb(text):
-    # TODO: Very basic
-    text = re.sub(r'((^| ))\( ', r'\1-lrb- ', text)
-    text = re.sub(r' \)((^| ))', r' -rrb-\1', text)
-    return text
+    return replace_patterns(text, TO_LRB_RRB_PATTERNS)
 
 
 def replace_back_quotes(text):
@@ -65,8 +84,12 @@ def to_lrb_rrb_file(input_filepath):
     return apply_line_method_to_file(to_lrb_rrb, input_filepath)
 
 
+def lowercase(text):
+    return text.lower()
+
+
 def lowercase_file(filepath):
-    return apply_line_method_to_file(lambda line: line.lower(), filepath)
+    return apply_line_method_to_file(lowercase, filepath)
 
 
 def concatenate_files(input_filepaths, output_filepath):
@@ -112,6 +135,7 @@ def get_real_n_jobs(n_jobs):
 def get_parallel_file_pair_preprocessor(file_pair_preprocessor, n_jobs):
     if n_jobs == 1:
         return file_pair_preprocessor
+    from joblib import Parallel, delayed
     n_jobs = get_real_n_jobs(n_jobs)
 
     @wraps(file_pair_preprocessor)
@@ -140,12 +164,14 @@ def get_parallel_file_pair_preprocessor(file_pair_preprocessor, n_jobs):
 
 
 def word_shuffle(words, max_swap=3):
+    import torch
     noise = torch.rand(len(words)).mul_(max_swap)
     permutation = torch.arange(len(words)).float().add_(noise).sort()[1]
     return [words[i] for i in permutation]
 
 
 def word_dropout(words, dropout_prob=0.1):
+    import torch
     keep = torch.rand(len(words))
     dropped_out_words = [word for i, word in enumerate(words) if keep[i] > dropout_prob]
     if len(dropped_out_words) == 0:
@@ -154,6 +180,7 @@ def word_dropout(words, dropout_prob=0.1):
 
 
 def word_blank(words, blank_prob=0.1):
+    import torch
     keep = torch.rand(len(words))
     return [word if keep[i] > blank_prob else '<BLANK>' for i, word in enumerate(words)]
 
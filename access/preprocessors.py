@@ -9,22 +9,19 @@ from abc import ABC
 from functools import wraps, lru_cache
 import hashlib
 from pathlib import Path
-import dill as pickle
 import re
 import shutil
 
-from nevergrad.instrumentation import var
 import numpy as np
-import sentencepiece as spm
 
-from access.feature_extraction import (get_lexical_complexity_score, get_levenshtein_similarity,
-                                       get_dependency_tree_depth)
 from access.resources.paths import VARIOUS_DIR, get_data_filepath
 from access.utils.helpers import (write_lines_in_parallel, yield_lines_in_parallel, add_dicts, get_default_args,
-                                  get_temp_filepath, safe_division, count_lines)
+                                  get_temp_filepath, temp_filepaths, safe_division, count_lines)
 
 SPECIAL_TOKEN_REGEX = r'<[a-zA-Z\-_\d\.]+>'
 PREPROCESSORS_REGISTRY = {}
+# dill, nevergrad, sentencepiece and the feature extractors (fasttext ranks, spaCy) are imported where they are used so
+# that the inference path only loads the dependencies of the configured preprocessors
 
 
 def get_preprocessor_by_name(preprocessor_name):
@@ -64,6 +61,7 @@ def store_args(constructor):
 
 
 def dump_preprocessors(preprocessors, dir_path):
+    import dill as pickle
     with open(Path(dir_path) / 'preprocessors.pickle', 'wb') as f:
         pickle.dump(preprocessors, f)
 
@@ -72,6 +70,7 @@ def load_preprocessors(dir_path):
     path = Path(dir_path) / 'preprocessors.pickle'
     if not path.exists():
         return None
+    import dill as pickle
     with open(path, 'rb') as f:
         return pickle.load(f)
 
@@ -120,22 +119,27 @@ class AbstractPreprocessor(ABC):
         return complex_sentence, simple_sentence
 
     def encode_file(self, input_filepath, output_filepath, encoder_filepath=None):
-        if encoder_filepath is None:
-            # We will use an empty temporary file which will yield None for each line
-            encoder_filepath = get_temp_filepath(create=True)
-        with open(output_filepath, 'w') as f:
-            for input_line, encoder_line in yield_lines_in_parallel([input_filepath, encoder_filepath], strict=False):
-                f.write(self.encode_sentence(input_line, encoder_line) + '\n')
+        with temp_filepaths(1) as (empty_filepath, ):
+            if encoder_filepath is None:
+                # We will use an empty temporary file which will yield None for each line
+                encoder_filepath = empty_filepath
+                encoder_filepath.touch()
+            with open(output_filepath, 'w') as f:
+                for input_line, encoder_line in yield_lines_in_parallel([input_filepath, encoder_filepath],
+                                                                        strict=False):
+                    f.write(self.encode_sentence(input_line, encoder_line) + '\n')
 
     def decode_file(self, input_filepath, output_filepath, encoder_filepath=None):
-        if encoder_filepath is None:
-            # We will use an empty temporary file which will yield None for each line
-            encoder_filepath = get_temp_filepath(create=True)
-        with open(output_filepath, 'w') as f:
-            for encoder_sentence, input_sentence in yield_lines_in_parallel([encoder_filepath, input_filepath],
-                                                                            strict=False):
-                decoded_sentence = self.decode_sentence(input_sentence, encoder_sentence=encoder_sentence)
-                f.write(decoded_sentence + '\n')
+        with temp_filepaths(1) as (empty_filepath, ):
+            if encoder_filepath is None:
+                # We will use an empty temporary file which will yield None for each line
+                encoder_filepath = empty_filepath
+                encoder_filepath.touch()
+            with open(output_filepath, 'w') as f:
+                for encoder_sentence, input_sentence in yield_lines_in_parallel([encoder_filepath, input_filepath],
+                                                                                strict=False):
+                    decoded_sentence = self.decode_sentence(input_sentence, encoder_sentence=encoder_sentence)
+                    f.write(decoded_sentence + '\n')
 
     def encode_file_pair(self, complex_filepath, simple_filepath, output_complex_filepath, output_simple_filepath):
         '''Jointly encode a complex file and a simple file (can be aligned or not)'''
@@ -176,18 +180,18 @@ class ComposedPreprocessor(AbstractPreprocessor):
         return sentence
 
     def encode_file(self, input_filepath, output_filepath, encoder_filepath=None):
-        for preprocessor in self.preprocessors:
-            intermediary_output_filepath = get_temp_filepath()
-            preprocessor.encode_file(input_filepath, intermediary_output_filepath, encoder_filepath)
-            input_filepath = intermediary_output_filepath
-        shutil.copyfile(input_filepath, output_filepath)
+        with temp_filepaths(len(self.preprocessors)) as intermediary_output_filepaths:
+            for preprocessor, intermediary_output_filepath in zip(self.preprocessors, intermediary_output_filepaths):
+                preprocessor.encode_file(input_filepath, intermediary_output_filepath, encoder_filepath)
+                input_filepath = intermediary_output_filepath
+            shutil.copyfile(input_filepath, output_filepath)
 
     def decode_file(self, input_filepath, output_filepath, encoder_filepath=None):
-        for preprocessor in self.preprocessors:
-            intermediary_output_filepath = get_temp_filepath()
-            preprocessor.decode_file(input_filepath, intermediary_output_filepath, encoder_filepath)
-            input_filepath = intermediary_output_filepath
-        shutil.copyfile(input_filepath, output_filepath)
+        with temp_filepaths(len(self.preprocessors)) as intermediary_output_filepaths:
+            for preprocessor, intermediary_output_filepath in zip(self.preprocessors, intermediary_output_filepaths):
+                preprocessor.decode_file(input_filepath, intermediary_output_filepath, encoder_filepath)
+                input_filepath = intermediary_output_filepath
+            shutil.copyfile(input_filepath, output_filepath)
 
     def encode_file_pair(self, complex_filepath, simple_filepath, output_complex_filepath, output_simple_filepath):
         for preprocessor in self.preprocessors:
@@ -253,9 +257,11 @@ class LevenshteinPreprocessor(FeaturePreprocessor):
                          noise_std)
 
     def get_nevergrad_variables(self):
+        from nevergrad.instrumentation import var
         return {'target_ratio': var.OrderedDiscrete(np.arange(0.4, 1 + 1e-6, self.bucket_size))}
 
     def get_feature_value(self, complex_sentence, simple_sentence):
+        from access.feature_extraction import get_levenshtein_similarity
         return get_levenshtein_similarity(complex_sentence, simple_sentence)
 
     def get_target_feature_value(self, complex_sentence):
@@ -271,6 +277,7 @@ class RatioPreprocessor(FeaturePreprocessor):
                          noise_std)
 
     def get_nevergrad_variables(self):
+        from nevergrad.instrumentation import var
         return {'target_ratio': var.OrderedDiscrete(np.arange(0.4, 1.4 + 1e-6, self.bucket_size))}
 
     def get_feature_value(self, complex_sentence, simple_sentence):
@@ -289,12 +296,14 @@ class LengthRatioPreprocessor(RatioPreprocessor):
 class WordRankRatioPreprocessor(RatioPreprocessor):
     @store_args
     def __init__(self, *args, **kwargs):
+        from access.feature_extraction import get_lexical_complexity_score
         super().__init__(get_lexical_complexity_score, *args, **kwargs)
 
 
 class DependencyTreeDepthRatioPreprocessor(RatioPreprocessor):
     @store_args
     def __init__(self, *args, **kwargs):
+        from access.feature_extraction import get_dependency_tree_depth
         super().__init__(get_dependency_tree_depth, *args, **kwargs)
 
 
@@ -319,10 +328,19 @@ class SentencePiecePreprocessor(AbstractPreprocessor):
         > pickle.dumps(spm.SentencePieceProcessor())
         ----> TypeError: can't pickle SwigPyObject objects
         '''
+        import sentencepiece as spm
         sp = spm.SentencePieceProcessor()
-        sp.Load(str(self.sentencepiece_model_path))
+        if getattr(self, 'sentencepiece_model_proto', None) is not None:
+            sp.LoadFromSerializedProto(self.sentencepiece_model_proto)
+        else:
+            sp.Load(str(self.sentencepiece_model_path))
         return sp
 
+    def load_serialized_model(self, sentencepiece_model_proto):
+        '''Use an in-memory model (e.g. from a model bundle) instead of sentencepiece_model_path'''
+        self.sentencepiece_model_proto = bytes(sentencepiece_model_proto)
+        type(self).sp.fget.cache_clear()
+
     def get_hash_string(self):
         return f'{self.__class__.__name__}(vocab_size={self.vocab_size})'
 
@@ -339,6 +357,7 @@ class SentencePiecePreprocessor(AbstractPreprocessor):
         max_lines = 10**6
         if sum([count_lines(filepath) for filepath in self.input_filepaths]) > max_lines:
             args_str += f' --input_sentence_size={max_lines} --shuffle_input_sentence=true'
+        import sentencepiece as spm
         spm.SentencePieceTrainer.Train(args_str)
 
     def fit(self, complex_filepath, simple_filepath):
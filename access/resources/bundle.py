@@ -0,0 +1,259 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+import time
+
+import numpy as np
+'''Single file model bundle for serving without downloads
+
+A bundle packs everything the inference path needs: the slim checkpoint, the fairseq dictionaries, the pickled
+preprocessors, their sentencepiece models and a compact word2rank index. Layout:
+    MAGIC | manifest length (uint64) | manifest (json) | sections, each aligned on SECTION_ALIGNMENT bytes
+The manifest lists the offset, size and sha256 of each section. The bundle is memory-mapped: word2rank lookups and
+sentencepiece models are served from the mapping directly. fairseq loads checkpoints and dictionaries by path, these
+are written once to a serving directory keyed by the bundle id (a plain local copy, no network and no archive).
+'''
+
+MAGIC = b'ACCSBDL1'
+SECTION_ALIGNMENT = 4096
+MODEL_BUNDLE_ENV_VAR = 'ACCESS_MODEL_BUNDLE'
+CHECKPOINT_SECTION = 'checkpoints/checkpoint_slim.pt'
+DICT_SECTIONS = ['dict.complex.txt', 'dict.simple.txt']
+PREPROCESSORS_SECTION = 'preprocessors.pickle'
+WORD2RANK_SECTIONS = ['word2rank/words', 'word2rank/offsets', 'word2rank/ranks']
+
+
+def get_sentencepiece_section(vocab_size):
+    return f'sentencepiece/{vocab_size}.model'
+
+
+def align(offset):
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+# Word2rank index
+def build_word2rank_sections(word2rank):
+    '''Words sorted by their utf-8 bytes, concatenated, with their offsets and ranks as numpy arrays'''
+    items = sorted((word.encode('utf-8'), rank) for word, rank in word2rank.items())
+    offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(word) for word, _ in items], dtype=np.uint64)
+    ranks = np.array([rank for _, rank in items], dtype=np.uint32)
+    return dict(zip(WORD2RANK_SECTIONS, [b''.join(word for word, _ in items), offsets.tobytes(), ranks.tobytes()]))
+
+
+class Word2RankIndex:
+    '''Read-only word -> rank mapping over the bundle sections, behaves like the dict of get_word2rank()
+
+    Lookups are binary searches in the memory-mapped sorted words, nothing is loaded upfront. Word frequencies are
+    very skewed, so resolved lookups are cached.
+    '''
+    def __init__(self, words, offsets, ranks, cache_size=10**6):
+        self.words = words
+        self.offsets = np.frombuffer(offsets, dtype=np.uint64)
+        self.ranks = np.frombuffer(ranks, dtype=np.uint32)
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def get_word(self, i):
+        return bytes(self.words[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def find(self, word):
+        encoded_word = word.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_word(middle) < encoded_word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.get_word(low) == encoded_word:
+            return int(self.ranks[low])
+        return None
+
+    def get(self, word, default=None):
+        if word not in self.cache:
+            rank = self.find(word)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[word] = rank
+        rank = self.cache[word]
+        return default if rank is None else rank
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        rank = self.get(word)
+        if rank is None:
+            raise KeyError(word)
+        return rank
+
+
+# Building
+def get_bundle_sections(exp_dir, preprocessors, word2rank=None):
+    '''{section_name: bytes or filepath}'''
+    import dill as pickle
+    from access.fairseq.checkpoints import get_inference_checkpoint_path
+    exp_dir = Path(exp_dir)
+    sections = {CHECKPOINT_SECTION: get_inference_checkpoint_path(exp_dir)}
+    for dict_section in DICT_SECTIONS:
+        sections[dict_section] = exp_dir / dict_section
+    sections[PREPROCESSORS_SECTION] = pickle.dumps(preprocessors)
+    for preprocessor in preprocessors:
+        if hasattr(preprocessor, 'sentencepiece_model_path'):
+            sections[get_sentencepiece_section(preprocessor.vocab_size)] = preprocessor.sentencepiece_model_path
+    if word2rank is not None:
+        sections.update(build_word2rank_sections(word2rank))
+    return sections
+
+
+def iterate_section_chunks(section, chunk_size=2**24):
+    if isinstance(section, bytes):
+        yield section
+        return
+    with open(section, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def get_section_size(section):
+    return len(section) if isinstance(section, bytes) else Path(section).stat().st_size
+
+
+def get_sha256(section):
+    sha256 = hashlib.sha256()
+    for chunk in iterate_section_chunks(section):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_bundle(sections, output_path, metadata=None):
+    '''Sections are bytes or paths of files to copy, the bundle is written atomically'''
+    manifest = {'version': 1, 'created_ns': int(time.time() * 10**9), 'metadata': metadata or {}, 'sections': {}}
+    # Offsets depend on the manifest length, which depends on the offsets: reserve room for them with a first pass
+    manifest['sections'] = {name: {'offset': 0, 'size': get_section_size(section), 'sha256': get_sha256(section)}
+                            for name, section in sections.items()}
+    header_size = len(MAGIC) + 8 + len(json.dumps(manifest).encode()) + 32 * len(sections)
+    offset = align(header_size)
+    for name in sections:
+        manifest['sections'][name]['offset'] = offset
+        offset = align(offset + manifest['sections'][name]['size'])
+    encoded_manifest = json.dumps(manifest).encode()
+    assert len(MAGIC) + 8 + len(encoded_manifest) <= align(header_size)
+    tmp_output_path = f'{output_path}.tmp'
+    with open(tmp_output_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(encoded_manifest)) + encoded_manifest)
+        for name, section in sections.items():
+            f.seek(manifest['sections'][name]['offset'])
+            for chunk in iterate_section_chunks(section):
+                f.write(chunk)
+        f.truncate(offset)
+    os.replace(tmp_output_path, output_path)
+    return manifest
+
+
+def build_bundle(exp_dir, preprocessors, output_path, include_word2rank=True, word2rank_vocab_size=None):
+    '''Bundle the model of exp_dir with the preprocessors used to serve it
+
+    The word2rank index is built from the fasttext embeddings (as get_word2rank()) when include_word2rank is True.
+    '''
+    word2rank = None
+    if include_word2rank:
+        from access.feature_extraction import get_word2rank
+        word2rank = get_word2rank(word2rank_vocab_size if word2rank_vocab_size is not None else np.inf)
+    sections = get_bundle_sections(exp_dir, preprocessors, word2rank=word2rank)
+    metadata = {'exp_dir': str(exp_dir), 'preprocessors': repr(preprocessors)}
+    return write_bundle(sections, output_path, metadata=metadata)
+
+
+# Loading
+class ModelBundle:
+    def __init__(self, bundle_path, verify=True):
+        self.bundle_path = Path(bundle_path)
+        with open(self.bundle_path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.mmap[:len(MAGIC)] == MAGIC, f'{bundle_path} is not a model bundle'
+        manifest_size, = struct.unpack('<Q', self.mmap[len(MAGIC):len(MAGIC) + 8])
+        encoded_manifest = self.mmap[len(MAGIC) + 8:len(MAGIC) + 8 + manifest_size]
+        self.manifest = json.loads(encoded_manifest.decode())
+        self.bundle_id = hashlib.sha256(encoded_manifest).hexdigest()[:16]
+        if verify:
+            self.verify()
+
+    def __contains__(self, name):
+        return name in self.manifest['sections']
+
+    def get_section(self, name):
+        '''Zero-copy view on the mapped section'''
+        section = self.manifest['sections'][name]
+        return memoryview(self.mmap)[section['offset']:section['offset'] + section['size']]
+
+    def verify(self):
+        for name, section in self.manifest['sections'].items():
+            sha256 = hashlib.sha256(self.get_section(name)).hexdigest()
+            assert sha256 == section['sha256'], f'Checksum mismatch for section {name} of {self.bundle_path}'
+
+    def get_word2rank(self):
+        if not all(name in self for name in WORD2RANK_SECTIONS):
+            return None
+        return Word2RankIndex(*[self.get_section(name) for name in WORD2RANK_SECTIONS])
+
+    def get_preprocessors(self):
+        '''Preprocessors are unpickled (no fitting or sentencepiece training), sentencepiece models come from the bundle'''
+        import dill as pickle
+        preprocessors = pickle.loads(self.get_section(PREPROCESSORS_SECTION))
+        for preprocessor in preprocessors:
+            if hasattr(preprocessor, 'sentencepiece_model_path'):
+                preprocessor.load_serialized_model(self.get_section(get_sentencepiece_section(preprocessor.vocab_size)))
+        return preprocessors
+
+    def get_serving_dir(self, root_dir=None):
+        '''Checkpoint and dictionaries as files for fairseq, written once per bundle'''
+        if root_dir is None:
+            root_dir = Path(tempfile.gettempdir()) / 'access_bundles'
+        serving_dir = Path(root_dir) / self.bundle_id
+        for name in [CHECKPOINT_SECTION] + DICT_SECTIONS:
+            path = serving_dir / name
+            if path.exists() and path.stat().st_size == self.manifest['sections'][name]['size']:
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.get_section(name))
+            # Same mtime in every container so that the prediction store keys of the checkpoint match
+            os.utime(tmp_path, ns=(self.manifest['created_ns'], self.manifest['created_ns']))
+            os.replace(tmp_path, path)
+        return serving_dir
+
+
+def get_bundle_path():
+    '''Bundle configured for serving through the ACCESS_MODEL_BUNDLE environment variable, if any'''
+    bundle_path = os.environ.get(MODEL_BUNDLE_ENV_VAR)
+    return Path(bundle_path) if bundle_path else None
+
+
+def load_bundle_simplifier(bundle_path, verify=True, serving_root_dir=None, **kwargs):
+    '''Sentences simplifier served from a bundle, kwargs are passed to get_fairseq_sentences_simplifier()'''
+    from access.feature_extraction import set_word2rank
+    from access.simplifiers import get_fairseq_sentences_simplifier
+    bundle = ModelBundle(bundle_path, verify=verify)
+    word2rank = bundle.get_word2rank()
+    if word2rank is not None:
+        set_word2rank(word2rank)
+    return get_fairseq_sentences_simplifier(bundle.get_serving_dir(serving_root_dir),
+                                            preprocessors=bundle.get_preprocessors(),
+                                            **kwargs)
@@ -11,7 +11,9 @@ from pathlib import Path
 from access.preprocess import get_parallel_file_pair_preprocessor
 from access.preprocessors import dump_preprocessors, load_preprocessors
 from access.resources.paths import PHASES, get_dataset_dir, get_data_filepath, get_filepaths_dict
-from access.utils.helpers import count_lines, read_lines, create_directory_or_skip
+from access.utils.artifacts import build_artifact
+from access.utils.helpers import count_lines, read_lines
+from access.utils.profiling import profile_stage, get_profiler
 
 
 def yield_indexes_of_lines(filepath, lines):
@@ -39,11 +41,12 @@ def get_preprocessed_dataset_name(dataset, preprocessor):
 
 def create_preprocessed_dataset_one_preprocessor(dataset, preprocessor, n_jobs):
     new_dataset = get_preprocessed_dataset_name(dataset, preprocessor)
-    with create_directory_or_skip(get_dataset_dir(new_dataset)):
+
+    def build(new_dataset_dir):
         print(f'Creating preprocessed dataset with {preprocessor}: {dataset} -> {new_dataset}')
-        new_dataset_dir = get_dataset_dir(new_dataset)
         filepaths_dict = get_filepaths_dict(dataset)
-        new_filepaths_dict = get_filepaths_dict(new_dataset)
+        new_filepaths_dict = {key: new_dataset_dir / filepath.name
+                              for key, filepath in get_filepaths_dict(new_dataset).items()}
         for phase in PHASES:
             if not filepaths_dict[phase, 'complex'].exists() or not filepaths_dict[phase, 'complex'].exists():
                 continue
@@ -51,8 +54,11 @@ def create_preprocessed_dataset_one_preprocessor(dataset, preprocessor, n_jobs):
                 preprocessor.encode_file_pair,
                 n_jobs=n_jobs,
             )
-            parallel_file_pair_preprocessor(filepaths_dict[phase, 'complex'], filepaths_dict[phase, 'simple'],
-                                            new_filepaths_dict[phase, 'complex'], new_filepaths_dict[phase, 'simple'])
+            n_lines = count_lines(filepaths_dict[phase, 'complex']) if get_profiler() is not None else None
+            with profile_stage(f'encode_{preprocessor.prefix}_{phase}', n_lines=n_lines):
+                parallel_file_pair_preprocessor(filepaths_dict[phase, 'complex'], filepaths_dict[phase, 'simple'],
+                                                new_filepaths_dict[phase, 'complex'],
+                                                new_filepaths_dict[phase, 'simple'])
             previous_preprocessors = load_preprocessors(get_dataset_dir(dataset))
         if previous_preprocessors is not None:
             preprocessors = previous_preprocessors + [preprocessor]
@@ -62,12 +68,15 @@ def create_preprocessed_dataset_one_preprocessor(dataset, preprocessor, n_jobs):
         with open(new_dataset_dir / 'original_dataset', 'w') as f:
             f.write(dataset + '\n')
 
+    build_artifact(get_dataset_dir(new_dataset), build)
     return new_dataset
 
 
 def create_preprocessed_dataset(dataset, preprocessors, n_jobs=1):
     for preprocessor in preprocessors:
         # Fit preprocessor on input dataset
-        preprocessor.fit(get_data_filepath(dataset, 'train', 'complex'), get_data_filepath(dataset, 'train', 'simple'))
+        with profile_stage(f'fit_{preprocessor.prefix}'):
+            preprocessor.fit(get_data_filepath(dataset, 'train', 'complex'),
+                             get_data_filepath(dataset, 'train', 'simple'))
         dataset = create_preprocessed_dataset_one_preprocessor(dataset, preprocessor, n_jobs)
     return dataset
@@ -16,6 +16,7 @@ VARIOUS_DIR = RESOURCES_DIR / 'various'
 FASTTEXT_EMBEDDINGS_PATH = VARIOUS_DIR / 'fasttext-vectors/wiki.en.vec'
 MODELS_DIR = RESOURCES_DIR / 'models'
 BEST_MODEL_DIR = MODELS_DIR / 'best_model'
+PREDICTION_STORE_PATH = RESOURCES_DIR / 'caches/predictions.sqlite'
 
 LANGUAGES = ['complex', 'simple']
 PHASES = ['train', 'valid', 'test']
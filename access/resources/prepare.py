@@ -14,8 +14,8 @@ import tempfile
 import numpy as np
 
 from access.text import word_tokenize
-from access.utils.helpers import (yield_lines_in_parallel, write_lines_in_parallel, create_directory_or_skip,
-                                  lock_directory)
+from access.utils.artifacts import build_artifact
+from access.utils.helpers import yield_lines_in_parallel, write_lines_in_parallel, lock_directory
 from access.preprocess import replace_lrb_rrb, replace_lrb_rrb_file, normalize_quotes
 from access.resources.utils import download_and_extract, add_newline_at_end_of_file, git_clone
 from access.resources.paths import (FASTTEXT_EMBEDDINGS_PATH, get_dataset_dir, get_data_filepath, PHASES, MODELS_DIR,
@@ -24,7 +24,8 @@ from access.resources.paths import (FASTTEXT_EMBEDDINGS_PATH, get_dataset_dir, g
 
 def prepare_wikilarge():
     dataset = 'wikilarge'
-    with create_directory_or_skip(get_dataset_dir(dataset)):
+
+    def build(dataset_dir):
         url = 'https://github.com/louismartin/dress-data/raw/master/data-simplification.tar.bz2'
         extracted_path = download_and_extract(url)[0]
         # Only rename files and put them in local directory architecture
@@ -34,16 +35,19 @@ def prepare_wikilarge():
                 globs = glob(old_path_glob)
                 assert len(globs) == 1
                 old_path = globs[0]
-                new_path = get_data_filepath(dataset, phase, new_language_name)
+                new_path = dataset_dir / get_data_filepath(dataset, phase, new_language_name).name
                 shutil.copyfile(old_path, new_path)
                 shutil.move(replace_lrb_rrb_file(new_path), new_path)
                 add_newline_at_end_of_file(new_path)
+
+    build_artifact(get_dataset_dir(dataset), build)
     return dataset
 
 
 def prepare_turkcorpus_lower():
     dataset = 'turkcorpus_lower'
-    with create_directory_or_skip(get_dataset_dir(dataset)):
+
+    def build(dataset_dir):
         url = 'https://github.com/cocoxu/simplification.git'
         output_dir = Path(tempfile.mkdtemp())
         git_clone(url, output_dir)
@@ -55,23 +59,26 @@ def prepare_turkcorpus_lower():
         for (old_phase, new_phase) in [('test', 'test'), ('tune', 'valid')]:
             for (old_language_name, new_language_name) in [('norm', 'complex'), ('simp', 'simple')]:
                 old_path = turkcorpus_lower_dir / f'{old_phase}.8turkers.tok.{old_language_name}'
-                new_path = get_data_filepath('turkcorpus_lower', new_phase, new_language_name)
+                new_path = dataset_dir / get_data_filepath(dataset, new_phase, new_language_name).name
                 shutil.copyfile(old_path, new_path)
                 add_newline_at_end_of_file(new_path)
                 shutil.move(replace_lrb_rrb_file(new_path), new_path)
             for i in range(8):
                 old_path = turkcorpus_lower_dir / f'{old_phase}.8turkers.tok.turk.{i}'
-                new_path = get_data_filepath('turkcorpus_lower', new_phase, 'simple.turk', i=i)
+                new_path = dataset_dir / get_data_filepath(dataset, new_phase, 'simple.turk', i=i).name
                 shutil.copyfile(old_path, new_path)
                 add_newline_at_end_of_file(new_path)
                 shutil.move(replace_lrb_rrb_file(new_path), new_path)
         print('Done.')
+
+    build_artifact(get_dataset_dir(dataset), build)
     return dataset
 
 
 def prepare_turkcorpus():
     dataset = 'turkcorpus'
-    with create_directory_or_skip(get_dataset_dir(dataset)):
+
+    def build(dataset_dir):
         # Import here to avoid circular imports
         from access.feature_extraction import get_levenshtein_similarity
         prepare_turkcorpus_lower()
@@ -87,8 +94,10 @@ def prepare_turkcorpus():
             # (2) replace lrb and rrb, tokenize
             # (3) Turk sentences are shuffled for each sample so need to realign them with turkcorpus lower
             tsv_filepath = turkcorpus_truecased_dir / f'{old_phase}.8turkers.organized.tsv'
-            output_complex_filepath = get_data_filepath(dataset, new_phase, 'complex')
-            output_ref_filepaths = [get_data_filepath(dataset, new_phase, 'simple.turk', i) for i in range(8)]
+            output_complex_filepath = dataset_dir / get_data_filepath(dataset, new_phase, 'complex').name
+            output_ref_filepaths = [
+                dataset_dir / get_data_filepath(dataset, new_phase, 'simple.turk', i).name for i in range(8)
+            ]
             # These files will be used to reorder the shuffled ref sentences
             ordered_ref_filepaths = [
                 get_data_filepath('turkcorpus_lower', new_phase, 'simple.turk', i) for i in range(8)
@@ -115,28 +124,36 @@ def prepare_turkcorpus():
                     assert len(shuffled_ref_sentences) == 0
                     assert len(reordered_sentences) == 8
                     files.write([complex_sentence] + reordered_sentences)
+
+    build_artifact(get_dataset_dir(dataset), build)
     return dataset
 
 
 def prepare_fasttext_embeddings():
-    FASTTEXT_EMBEDDINGS_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with lock_directory(FASTTEXT_EMBEDDINGS_PATH.parent):
-        if FASTTEXT_EMBEDDINGS_PATH.exists():
-            return
+    def build(embeddings_path):
         url = 'https://dl.fbaipublicfiles.com/fasttext/vectors-crawl/cc.en.300.vec.gz'
         extracted_path = download_and_extract(url)[0]
-        shutil.move(extracted_path, FASTTEXT_EMBEDDINGS_PATH)
+        shutil.move(extracted_path, embeddings_path)
+
+    build_artifact(FASTTEXT_EMBEDDINGS_PATH, build, is_directory=False)
 
 
 def prepare_models():
-    MODELS_DIR.mkdir(parents=True, exist_ok=True)
-    if not BEST_MODEL_DIR.exists():
-        url = 'http://dl.fbaipublicfiles.com/access/best_model.tar.gz'
-        extracted_path = download_and_extract(url)[0]
-        shutil.move(extracted_path, BEST_MODEL_DIR)
-    all_parameters_model_dir = MODELS_DIR / 'all_parameters_model'
-    if not all_parameters_model_dir.exists():
-        url = 'http://dl.fbaipublicfiles.com/access/all_parameters_model.tar.gz'
-        extracted_path = download_and_extract(url)[0]
-        shutil.move(extracted_path, all_parameters_model_dir)
+    def download_model(url):
+        def build(model_dir):
+            extracted_path = download_and_extract(url)[0]
+            shutil.move(extracted_path, model_dir)
+
+        return build
+
+    build_artifact(BEST_MODEL_DIR, download_model('http://dl.fbaipublicfiles.com/access/best_model.tar.gz'),
+                   is_directory=False)
+    # Imported here to avoid loading torch and fairseq when preparing datasets only
+    from access.fairseq.checkpoints import create_slim_checkpoint, SLIM_CHECKPOINT_NAME
+    with lock_directory(BEST_MODEL_DIR):
+        if not (BEST_MODEL_DIR / 'checkpoints' / SLIM_CHECKPOINT_NAME).exists():
+            create_slim_checkpoint(BEST_MODEL_DIR)
+    build_artifact(MODELS_DIR / 'all_parameters_model',
+                   download_model('http://dl.fbaipublicfiles.com/access/all_parameters_model.tar.gz'),
+                   is_directory=False)
     return BEST_MODEL_DIR
@@ -17,9 +17,6 @@ import time
 from urllib.request import urlretrieve
 import zipfile
 
-import git
-from tqdm import tqdm
-
 
 def reporthook(count, block_size, total_size):
     # Download progress bar
@@ -124,6 +121,7 @@ def ungzip(compressed_path, output_dir):
 def unbz2(compressed_path, output_dir):
     extract_filename = os.path.basename(compressed_path).replace('.bz2', '')
     extract_path = os.path.join(output_dir, extract_filename)
+    from tqdm import tqdm
     with bz2.BZ2File(compressed_path, 'rb') as compressed_file, open(extract_path, 'wb') as extract_file:
         for data in tqdm(iter(lambda: compressed_file.read(1024 * 1024), b'')):
             extract_file.write(data)
@@ -142,6 +140,7 @@ def add_newline_at_end_of_file(file_path):
 def git_clone(url, output_dir, overwrite=True):
     if Path(output_dir).exists():
         shutil.rmtree(output_dir)
+    import git  # GitPython is slow to import and only needed to download some datasets
     git.Repo.clone_from(url, output_dir)
 
 
@@ -0,0 +1,147 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from itertools import islice
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+
+from access.preprocess import concatenate_files, get_real_n_jobs
+from access.utils.helpers import count_lines, yield_chunks
+'''Simplify large corpora with several processes, each one working on a contiguous range of lines (a shard)
+
+Every worker loads its own model and is pinned to its own CPU cores. Progress is checkpointed after each chunk so a
+crashed run resumes where each shard stopped.
+'''
+
+
+def get_shard_ranges(n_lines, n_shards):
+    shard_size = max(-(-n_lines // n_shards), 1)  # Ceil division
+    return [(start, min(start + shard_size, n_lines)) for start in range(0, n_lines, shard_size)]
+
+
+def get_shard_filepaths(work_dir, shard_id):
+    work_dir = Path(work_dir)
+    return work_dir / f'shard_{shard_id:04d}.pred', work_dir / f'shard_{shard_id:04d}.progress'
+
+
+def read_progress(progress_filepath):
+    if not Path(progress_filepath).exists():
+        return 0
+    with open(progress_filepath, 'r') as f:
+        return json.load(f)['n_lines_done']
+
+
+def write_progress(progress_filepath, n_lines_done):
+    tmp_filepath = f'{progress_filepath}.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump({'n_lines_done': n_lines_done}, f)
+    os.replace(tmp_filepath, progress_filepath)
+
+
+def truncate_to_lines(filepath, n_lines):
+    '''Drop lines written after the last checkpoint'''
+    if not Path(filepath).exists():
+        return
+    with open(filepath, 'r+') as f:
+        for _ in range(n_lines):
+            f.readline()
+        f.truncate(f.tell())
+
+
+def get_cpu_sets(n_workers):
+    cpus = sorted(os.sched_getaffinity(0))
+    n_cpus_per_worker = max(len(cpus) // n_workers, 1)
+    cpu_sets = [cpus[i * n_cpus_per_worker:(i + 1) * n_cpus_per_worker] for i in range(n_workers)]
+    # More workers than cores: share cores in a round robin fashion
+    return [cpu_set or [cpus[i % len(cpus)]] for i, cpu_set in enumerate(cpu_sets)]
+
+
+def load_or_create_shard_ranges(complex_filepath, work_dir, n_shards):
+    '''Shard ranges are saved in the work_dir so that a resumed run uses the same ones'''
+    shards_filepath = Path(work_dir) / 'shards.json'
+    if shards_filepath.exists():
+        with open(shards_filepath, 'r') as f:
+            return [tuple(shard_range) for shard_range in json.load(f)]
+    shard_ranges = get_shard_ranges(count_lines(complex_filepath), n_shards)
+    with open(shards_filepath, 'w') as f:
+        json.dump(shard_ranges, f)
+    return shard_ranges
+
+
+def simplify_shard(complex_filepath, work_dir, shard_id, start, end, cpus, exp_dir, preprocessors_kwargs,
+                   generate_kwargs, chunk_size, tokenize):
+    # Imports are done in the worker process which loads its own model
+    import torch
+    from access.preprocessors import get_preprocessors
+    from access.simplifiers import get_fairseq_sentences_simplifier
+    from access.text import word_tokenize
+    from access.utils.helpers import mute
+
+    os.sched_setaffinity(0, cpus)
+    # Intra-op threads match the cores of the worker, inter-op parallelism would oversubscribe them
+    torch.set_num_threads(len(cpus))
+    pred_filepath, progress_filepath = get_shard_filepaths(work_dir, shard_id)
+    n_lines_done = read_progress(progress_filepath)
+    if start + n_lines_done >= end:
+        return 0
+    truncate_to_lines(pred_filepath, n_lines_done)
+    with mute():
+        simplifier = get_fairseq_sentences_simplifier(exp_dir,
+                                                      preprocessors=get_preprocessors(preprocessors_kwargs),
+                                                      **generate_kwargs)
+    start_time = time.time()
+    n_lines_before = n_lines_done
+    with open(complex_filepath, 'r') as input_file, open(pred_filepath, 'a') as output_file:
+        lines = (line.rstrip('\n') for line in islice(input_file, start + n_lines_done, end))
+        for chunk in yield_chunks(lines, chunk_size):
+            if tokenize:
+                chunk = [word_tokenize(line) for line in chunk]
+            with mute():
+                predictions = simplifier(chunk)
+            for prediction in predictions:
+                output_file.write(prediction + '\n')
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            n_lines_done += len(chunk)
+            write_progress(progress_filepath, n_lines_done)
+    n_lines = n_lines_done - n_lines_before
+    print(f'shard={shard_id} cpus={cpus} sentences_per_second={n_lines / (time.time() - start_time):.2f}')
+    return n_lines
+
+
+def simplify_corpus(complex_filepath,
+                    output_pred_filepath,
+                    exp_dir,
+                    preprocessors_kwargs,
+                    work_dir,
+                    n_workers=-1,
+                    chunk_size=1000,
+                    tokenize=True,
+                    **generate_kwargs):
+    '''Sharded multi-process counterpart of a simplifier, calling it again with the same work_dir resumes the run'''
+    n_workers = get_real_n_jobs(n_workers)
+    Path(work_dir).mkdir(parents=True, exist_ok=True)
+    shard_ranges = load_or_create_shard_ranges(complex_filepath, work_dir, n_workers)
+    cpu_sets = get_cpu_sets(len(shard_ranges))
+    tasks = [(complex_filepath, work_dir, shard_id, start, end, cpus, exp_dir, preprocessors_kwargs, generate_kwargs,
+              chunk_size, tokenize) for shard_id, ((start, end), cpus) in enumerate(zip(shard_ranges, cpu_sets))]
+    start_time = time.time()
+    if len(tasks) == 0:
+        concatenate_files([], output_pred_filepath)
+        return 0
+    # Spawn instead of fork so that each worker initializes its own torch thread pool
+    with multiprocessing.get_context('spawn').Pool(len(tasks)) as pool:
+        n_lines = sum(pool.starmap(simplify_shard, tasks))
+    duration = time.time() - start_time
+    print(f'n_workers={len(tasks)} n_lines={n_lines} sentences_per_second={n_lines / duration:.2f}')
+    # Shards are contiguous line ranges, merging them in order gives back the input order
+    concatenate_files([get_shard_filepaths(work_dir, shard_id)[0] for shard_id in range(len(tasks))],
+                      output_pred_filepath)
+    return n_lines / duration
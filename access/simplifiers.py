@@ -5,45 +5,35 @@
 # LICENSE file in the root directory of this source tree.
 #
 
-from functools import wraps
-from pathlib import Path
-import shutil
-import tempfile
+from functools import lru_cache, wraps
 
-from imohash import hashfile
-
-from access.fairseq.base import fairseq_generate
+from access.fairseq.checkpoints import get_inference_checkpoint_path
+from access.prediction_store import get_model_key, memoize_predictions
 from access.preprocessors import ComposedPreprocessor, load_preprocessors
-from access.utils.helpers import count_lines
+from access.utils.helpers import read_lines, write_lines, temp_filepaths
+from access.utils.metrics import STAGE_SECONDS
 
 
-def memoize_simplifier(simplifier):
-    memo = {}
+def get_fairseq_simplifier(exp_dir, reload_preprocessors=False, use_prediction_store=True, **kwargs):
+    '''Method factory, predictions are memoized per line in the prediction store (see access.prediction_store)'''
+    def generate_lines(lines):
+        from access.fairseq.base import fairseq_generate
+        with temp_filepaths(2) as (complex_filepath, pred_filepath):
+            write_lines(lines, complex_filepath)
+            fairseq_generate(complex_filepath, pred_filepath, exp_dir, **kwargs)
+            return read_lines(pred_filepath)
+
+    # Sampled predictions are not deterministic, there is no point in storing them
+    if use_prediction_store and not kwargs.get('sampling', False):
+        # fairseq_generate() resolves the inference checkpoint at each call, so does the key
+        generate_lines = memoize_predictions(
+            generate_lines, lambda: get_model_key([get_inference_checkpoint_path(exp_dir)], kwargs))
 
-    @wraps(simplifier)
-    def wrapped(complex_filepath, pred_filepath):
-        complex_filehash = hashfile(complex_filepath, hexdigest=True)
-        previous_pred_filepath = memo.get(complex_filehash)
-        if previous_pred_filepath is not None and Path(previous_pred_filepath).exists():
-            assert count_lines(complex_filepath) == count_lines(previous_pred_filepath)
-            # Reuse previous prediction
-            shutil.copyfile(previous_pred_filepath, pred_filepath)
-        else:
-            simplifier(complex_filepath, pred_filepath)
-        # Save prediction
-        memo[complex_filehash] = pred_filepath
-
-    return wrapped
-
-
-def get_fairseq_simplifier(exp_dir, reload_preprocessors=False, **kwargs):
-    '''Method factory'''
-    @memoize_simplifier
     def fairseq_simplifier(complex_filepath, output_pred_filepath):
         # Trailing spaces for markdown formatting
         print('simplifier_type="fairseq_simplifier"  ')
         print(f'exp_dir="{exp_dir}"  ')
-        fairseq_generate(complex_filepath, output_pred_filepath, exp_dir, **kwargs)
+        write_lines(generate_lines(read_lines(complex_filepath)), output_pred_filepath)
 
     preprocessors = None
     if reload_preprocessors:
@@ -56,17 +46,73 @@ def get_fairseq_simplifier(exp_dir, reload_preprocessors=False, **kwargs):
 def get_preprocessed_simplifier(simplifier, preprocessors):
     composed_preprocessor = ComposedPreprocessor(preprocessors)
 
-    @memoize_simplifier
     @wraps(simplifier)
     def preprocessed_simplifier(complex_filepath, output_pred_filepath):
         print(f'preprocessors={preprocessors}')
-        preprocessed_complex_filepath = tempfile.mkstemp()[1]
-        composed_preprocessor.encode_file(complex_filepath, preprocessed_complex_filepath)
-        preprocessed_output_pred_filepath = tempfile.mkstemp()[1]
-        simplifier(preprocessed_complex_filepath, preprocessed_output_pred_filepath)
-        composed_preprocessor.decode_file(preprocessed_output_pred_filepath,
-                                          output_pred_filepath,
-                                          encoder_filepath=complex_filepath)
+        with temp_filepaths(2) as (preprocessed_complex_filepath, preprocessed_output_pred_filepath):
+            composed_preprocessor.encode_file(complex_filepath, preprocessed_complex_filepath)
+            simplifier(preprocessed_complex_filepath, preprocessed_output_pred_filepath)
+            composed_preprocessor.decode_file(preprocessed_output_pred_filepath,
+                                              output_pred_filepath,
+                                              encoder_filepath=complex_filepath)
 
     preprocessed_simplifier.__name__ = f'{preprocessed_simplifier.__name__}_{composed_preprocessor.get_suffix()}'
     return preprocessed_simplifier
+
+
+def get_fairseq_sentences_simplifier(exp_dir, preprocessors=None, use_prediction_store=True, **kwargs):
+    '''Method factory for in-process simplification of lists of sentences
+
+    The model is loaded once, the returned method has signature: sentences_simplifier(complex_sentences) -> predictions
+    use_prediction_store=False always decodes, e.g. to measure decoding speed
+    '''
+    generate_kwargs = {key: value for key, value in kwargs.items() if key != 'checkpoint_paths'}
+    loaded_model_keys = []
+
+    def get_current_model_key():
+        # Once loaded, the model keeps decoding with the checkpoints it was loaded from
+        if len(loaded_model_keys) > 0:
+            return loaded_model_keys[0]
+        checkpoint_paths = kwargs.get('checkpoint_paths') or [get_inference_checkpoint_path(exp_dir)]
+        return get_model_key(checkpoint_paths, generate_kwargs)
+
+    @lru_cache(maxsize=1)
+    def get_generate_sentences():
+        # The model (and fairseq) is only loaded if some sentences are missing from the prediction store
+        from access.fairseq.base import load_fairseq_generator
+        checkpoint_paths = kwargs.get('checkpoint_paths') or [get_inference_checkpoint_path(exp_dir)]
+        loaded_model_keys.append(get_model_key(checkpoint_paths, generate_kwargs))
+        return load_fairseq_generator(exp_dir, checkpoint_paths=checkpoint_paths, **generate_kwargs)
+
+    def generate_sentences(sentences):
+        return get_generate_sentences()(sentences)
+
+    if use_prediction_store and not kwargs.get('sampling', False):
+        generate_sentences = memoize_predictions(generate_sentences, get_current_model_key)
+    composed_preprocessor = ComposedPreprocessor(preprocessors)
+
+    def sentences_simplifier(complex_sentences):
+        # Same as composed_preprocessor.encode_sentence() and decode_sentence(), timed per preprocessor
+        encoded_sentences = complex_sentences
+        for preprocessor in composed_preprocessor.preprocessors:
+            with STAGE_SECONDS.time(stage=f'encode_{preprocessor.prefix.lower()}'):
+                encoded_sentences = [preprocessor.encode_sentence(sentence) for sentence in encoded_sentences]
+        predictions = generate_sentences(encoded_sentences)
+        for preprocessor in composed_preprocessor.preprocessors:
+            with STAGE_SECONDS.time(stage=f'decode_{preprocessor.prefix.lower()}'):
+                predictions = [
+                    preprocessor.decode_sentence(prediction, encoder_sentence=complex_sentence)
+                    for prediction, complex_sentence in zip(predictions, complex_sentences)
+                ]
+        return predictions
+
+    return sentences_simplifier
+
+
+def get_file_simplifier(sentences_simplifier):
+    '''Wrap a sentences simplifier into a simplifier working on files'''
+    @wraps(sentences_simplifier)
+    def file_simplifier(complex_filepath, output_pred_filepath):
+        write_lines(sentences_simplifier(read_lines(complex_filepath)), output_pred_filepath)
+
+    return file_simplifier
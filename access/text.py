@@ -9,18 +9,26 @@ from functools import lru_cache
 import re
 from string import punctuation
 
-from nltk.tokenize.nist import NISTTokenizer
-from nltk.corpus import stopwords as nltk_stopwords
-import spacy
+# nltk and spaCy are imported when first needed, they take seconds to import and most code paths only need one of them
 
-# TODO: #language_specific
-stopwords = set(nltk_stopwords.words('english'))
+
+@lru_cache(maxsize=1)
+def get_stopwords():
+    from nltk.corpus import stopwords as nltk_stopwords
+    # TODO: #language_specific
+    return frozenset(nltk_stopwords.words('english'))
+
+
+@lru_cache(maxsize=1)
+def get_nist_tokenizer():
+    from nltk.tokenize.nist import NISTTokenizer
+    # Building the tokenizer compiles its regexes, we only want to do it once
+    return NISTTokenizer()
 
 
 @lru_cache(maxsize=100)  # To speed up subsequent calls
 def word_tokenize(sentence):
-    tokenizer = NISTTokenizer()
-    sentence = ' '.join(tokenizer.tokenize(sentence))
+    sentence = ' '.join(get_nist_tokenizer().tokenize(sentence))
     # Rejoin special tokens that where tokenized by error: e.g. "<PERSON_1>" -> "< PERSON _ 1 >"
     for match in re.finditer(r'< (?:[A-Z]+ _ )+\d+ >', sentence):
         sentence = sentence.replace(match.group(), ''.join(match.group().split()))
@@ -46,11 +54,13 @@ def remove_punctuation_tokens(text):
 
 
 def remove_stopwords(text):
+    stopwords = get_stopwords()
     return ' '.join([w for w in to_words(text) if w.lower() not in stopwords])
 
 
 @lru_cache(maxsize=1)
 def get_spacy_model():
+    import spacy
     model = 'en_core_web_sm'
     if not spacy.util.is_package(model):
         spacy.cli.download(model)
@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+from access.utils.helpers import open_with_lock
+'''Build artifacts (datasets, downloads, preprocessed directories) once, atomically and safely across processes
+
+build_artifact(artifact_path, build) returns right away if the artifact exists. Otherwise it takes a lock next to the
+artifact, builds it in a temporary directory of the same filesystem and publishes it with a rename: readers see either
+nothing or the complete artifact, and an interrupted or failed build leaves nothing behind.
+'''
+
+
+def get_artifact_lockfile_path(artifact_path):
+    return artifact_path.parent / f'.{artifact_path.name}.lockfile'
+
+
+def get_build_dir_prefix(artifact_path):
+    return f'.{artifact_path.name}.building.'
+
+
+def is_built(artifact_path):
+    if not artifact_path.exists():
+        return False
+    if artifact_path.is_dir() and {path.name for path in artifact_path.iterdir()} <= {'.lockfile'}:
+        # Left empty by an interrupted build of a previous version that created the directory in place
+        return False
+    return True
+
+
+def remove_stale_build_dirs(artifact_path):
+    '''Leftovers of builds killed before they could clean up, only called while holding the artifact lock'''
+    for build_dir in artifact_path.parent.glob(f'{get_build_dir_prefix(artifact_path)}*'):
+        print(f'Removing stale build directory {build_dir}')
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def build_artifact(artifact_path, build, is_directory=True):
+    '''Return artifact_path, after calling build(build_path) to create it if it does not exist yet
+
+    build_path is a temporary path with the same name as the artifact, created as an empty directory when is_directory.
+    Concurrent builders wait for the lock and return the artifact built by the first one.
+    '''
+    artifact_path = Path(artifact_path)
+    if is_built(artifact_path):
+        return artifact_path
+    artifact_path.parent.mkdir(parents=True, exist_ok=True)
+    with open_with_lock(get_artifact_lockfile_path(artifact_path), 'w'):
+        if is_built(artifact_path):
+            return artifact_path
+        if artifact_path.exists():
+            print(f'Removing empty directory {artifact_path}')
+            shutil.rmtree(artifact_path)
+        remove_stale_build_dirs(artifact_path)
+        build_dir = Path(tempfile.mkdtemp(prefix=get_build_dir_prefix(artifact_path), dir=artifact_path.parent))
+        try:
+            build_path = build_dir / artifact_path.name
+            if is_directory:
+                build_path.mkdir()
+            print(f'Creating {artifact_path}...')
+            build(build_path)
+            assert build_path.exists(), f'Building {artifact_path} did not create {build_path}'
+            os.replace(build_path, artifact_path)
+        except BaseException:
+            print(f'Error: Rolling back creation of {artifact_path}')
+            raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    return artifact_path
@@ -0,0 +1,125 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import time
+
+import numpy as np
+'''Timing harness for benchmarks, with JSON results that can be compared against a stored baseline'''
+
+DEFAULT_MAX_SLOWDOWN = 0.2
+
+
+class SkipBenchmark(Exception):
+    '''Raised by a benchmark setup when a resource it needs is not available offline'''
+
+
+def time_function(func, n_repeats=5, setup=None):
+    '''Durations of n_repeats calls of func(), setup() is called before each call and is not timed'''
+    durations = []
+    for _ in range(n_repeats):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def summarize_durations(durations, n_items=None):
+    summary = {
+        'n_repeats': len(durations),
+        'min_seconds': min(durations),
+        'median_seconds': float(np.median(durations)),
+        'max_seconds': max(durations),
+    }
+    if n_items is not None:
+        summary['n_items'] = n_items
+        summary['items_per_second'] = n_items / summary['median_seconds']
+    return summary
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_metadata(**kwargs):
+    return {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        **kwargs,
+    }
+
+
+def run_benchmarks(benchmarks, n_repeats=5, pattern=None):
+    '''benchmarks: {name: get_benchmark}, get_benchmark() returns (func, setup, n_items) or raises SkipBenchmark'''
+    results = {}
+    skipped = {}
+    for name, get_benchmark in benchmarks.items():
+        if pattern is not None and pattern not in name:
+            continue
+        try:
+            func, setup, n_items = get_benchmark()
+        except SkipBenchmark as e:
+            print(f'{name}: skipped ({e})')
+            skipped[name] = str(e)
+            continue
+        results[name] = summarize_durations(time_function(func, n_repeats=n_repeats, setup=setup), n_items)
+        print(f'{name}: median={results[name]["median_seconds"]:.4f}s' +
+              (f' items_per_second={results[name]["items_per_second"]:.1f}' if n_items is not None else ''))
+    return results, skipped
+
+
+def write_results(results, skipped, output_path, **metadata):
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({'metadata': get_metadata(**metadata), 'benchmarks': results, 'skipped': skipped}, f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)['benchmarks']
+
+
+def get_median_seconds_per_item(result):
+    return result['median_seconds'] / result.get('n_items', 1)
+
+
+def compare_to_baseline(results, baseline_results, max_slowdown=DEFAULT_MAX_SLOWDOWN):
+    '''Benchmarks whose median duration per item grew by more than max_slowdown (0.2 = 20%) are regressions
+
+    Durations are compared per item so that runs with a different amount of data remain comparable.
+    Returns {name: relative_change} for all benchmarks present in both, and the list of regressions.
+    '''
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline_results:
+            continue
+        baseline_seconds = get_median_seconds_per_item(baseline_results[name])
+        changes[name] = get_median_seconds_per_item(result) / baseline_seconds - 1
+        if changes[name] > max_slowdown:
+            regressions.append(name)
+    return changes, regressions
+
+
+def print_comparison(changes, regressions):
+    for name, change in sorted(changes.items()):
+        print(f'{name}: {change:+.1%}{" REGRESSION" if name in regressions else ""}')
@@ -5,15 +5,16 @@
 # LICENSE file in the root directory of this source tree.
 #
 
-from contextlib import contextmanager, AbstractContextManager
+from contextlib import contextmanager
 from fcntl import flock, LOCK_EX, LOCK_UN
 import inspect
 import io
 from itertools import zip_longest
+import os
 from pathlib import Path
-import shutil
 import sys
 import tempfile
+import threading
 
 import numpy as np
 
@@ -85,6 +86,17 @@ def read_lines(filepath, n_lines=float('inf'), prop=1):
     return list(yield_lines(filepath, n_lines, prop))
 
 
+def yield_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
 def count_lines(filepath):
     n_lines = 0
     with Path(filepath).open() as f:
@@ -152,6 +164,42 @@ def mute(mute_stdout=True, mute_stderr=True):
         sys.stderr = save_stderr
 
 
+class ThreadMutableStream:
+    '''Forward to the wrapped stream, except the writes of the threads that muted it'''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, message):
+        if getattr(self.local, 'muted', False):
+            return len(message)
+        return self.stream.write(message)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_thread_mutable_stdout_lock = threading.Lock()
+
+
+@contextmanager
+def mute_thread():
+    '''Mute stdout for the current thread only, unlike mute() it is safe in a threaded server
+
+    sys.stdout is wrapped once and never swapped back, other threads keep printing to the original stream.
+    '''
+    with _thread_mutable_stdout_lock:
+        if not isinstance(sys.stdout, ThreadMutableStream):
+            sys.stdout = ThreadMutableStream(sys.stdout)
+        stdout = sys.stdout
+    was_muted = getattr(stdout.local, 'muted', False)
+    stdout.local.muted = True
+    try:
+        yield
+    finally:
+        stdout.local.muted = was_muted
+
+
 @contextmanager
 def log_stdout(filepath, mute_stdout=False):
     '''Context manager to write both to stdout and to a file'''
@@ -195,63 +243,10 @@ def get_allowed_kwargs(func, *args, **kwargs):
     return {k: v for k, v in kwargs.items() if k in allowed_kwargs}
 
 
-class SkipWithBlock(Exception):
-    pass
-
-
-class create_directory_or_skip(AbstractContextManager):
-    '''Context manager for creating a new directory (with rollback and skipping with block if exists)
-
-    In order to skip the execution of the with block if the dataset already exists, this context manager uses deep
-    magic from https://stackoverflow.com/questions/12594148/skipping-execution-of-with-block
-    '''
-    def __init__(self, dir_path, overwrite=False):
-        self.dir_path = Path(dir_path)
-        self.overwrite = overwrite
-
-    def __enter__(self):
-        if self.dir_path.exists():
-            self.directory_lock = lock_directory(self.dir_path)
-            self.directory_lock.__enter__()
-            files_in_directory = list(self.dir_path.iterdir())
-            if set(files_in_directory) in [set([]), set([self.dir_path / '.lockfile'])]:
-                # TODO: Quick hack to remove empty directories
-                self.directory_lock.__exit__(None, None, None)
-                print(f'Removing empty directory {self.dir_path}')
-                shutil.rmtree(self.dir_path)
-            else:
-                # Deep magic hack to skip the execution of the code inside the with block
-                # We set the trace to a dummy function
-                sys.settrace(lambda *args, **keys: None)
-                # Get the calling frame (sys._getframe(0) is the current frame)
-                frame = sys._getframe(1)
-                # Set the calling frame's trace to the one that raises the special exception
-                frame.f_trace = self.trace
-                return
-        print(f'Creating {self.dir_path}...')
-        self.dir_path.mkdir(parents=True, exist_ok=True)
-        self.directory_lock = lock_directory(self.dir_path)
-        self.directory_lock.__enter__()
-
-    def trace(self, frame, event, arg):
-        # This method is called when a new local scope is entered, i.e. right when the code in the with block begins
-        # The exception will therefore be caught by the __exit__()
-        raise SkipWithBlock()
-
-    def __exit__(self, type, value, traceback):
-        self.directory_lock.__exit__(type, value, traceback)
-        if type is not None:
-            if issubclass(type, SkipWithBlock):
-                return True  # Suppress special SkipWithBlock exception
-            if issubclass(type, BaseException):
-                # Rollback
-                print(f'Error: Rolling back creation of directory {self.dir_path}')
-                shutil.rmtree(self.dir_path)
-                return False  # Reraise the exception
-
-
 def get_temp_filepath(create=False):
-    temp_filepath = Path(tempfile.mkstemp()[1])
+    fd, temp_filepath = tempfile.mkstemp()
+    os.close(fd)
+    temp_filepath = Path(temp_filepath)
     if not create:
         temp_filepath.unlink()
     return temp_filepath
@@ -261,6 +256,18 @@ def get_temp_filepaths(n_filepaths, create=False):
     return [get_temp_filepath(create=create) for _ in range(n_filepaths)]
 
 
+@contextmanager
+def temp_filepaths(n_filepaths):
+    '''Temporary filepaths (not created), the files are deleted on exit if they exist'''
+    filepaths = get_temp_filepaths(n_filepaths)
+    try:
+        yield filepaths
+    finally:
+        for filepath in filepaths:
+            if filepath.exists():
+                filepath.unlink()
+
+
 def delete_files(filepaths):
     for filepath in filepaths:
         filepath = Path(filepath)
@@ -0,0 +1,178 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import resource
+import threading
+import time
+'''In-process metrics (counters, gauges and histograms) rendered in the Prometheus text format
+
+Recording a value only takes a lock and a dict update, so instrumented code paths stay cheap when nobody scrapes them.
+'''
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, float('inf'))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        assert metric.name not in self.metrics, f'Metric {metric.name} is already registered'
+        self.metrics[metric.name] = metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics.values())
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped_labels = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                      for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped_labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def get_key(self, labels):
+        assert set(labels) == set(self.labelnames), f'{self.name} expects labels {self.labelnames}, got {labels}'
+        return tuple((labelname, labels[labelname]) for labelname in self.labelnames)
+
+    def get_samples(self):
+        '''[(suffix, labels, value)]'''
+        with self.lock:
+            return [('', key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for suffix, labels, value in self.get_samples():
+            lines.append(f'{self.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        '''The value is computed by function() when rendered'''
+        self.functions[self.get_key(labels)] = function
+
+    def get_samples(self):
+        return super().get_samples() + [('', key, function()) for key, function in self.functions.items()]
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        assert self.buckets[-1] == float('inf'), 'The last bucket must be +Inf'
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        bucket_index = bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0., 'count': 0}
+            state = self.values[key]
+            state['counts'][bucket_index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def get_samples(self):
+        samples = []
+        with self.lock:
+            for key, state in self.values.items():
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets, state['counts']):
+                    cumulative_count += count
+                    samples.append(('_bucket', key + (('le', format_value(upper_bound)), ), cumulative_count))
+                samples.append(('_sum', key, state['sum']))
+                samples.append(('_count', key, state['count']))
+        return samples
+
+
+def get_resident_memory_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of current resident memory, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render_metrics(registry=REGISTRY):
+    return registry.render()
+
+
+# Metrics shared by the simplification code paths and the serving API
+STAGE_SECONDS = Histogram('simplification_stage_seconds', 'Duration of each simplification stage', ['stage'])
+BATCH_SIZE = Histogram('simplification_batch_size', 'Number of sentences per model batch', buckets=SIZE_BUCKETS)
+QUEUE_DEPTH = Gauge('simplification_queue_depth', 'Requests waiting for the model')
+PREDICTION_STORE_LOOKUPS = Counter('prediction_store_lookups_total', 'Prediction store lookups per line', ['result'])
+MEMORY_BYTES = Gauge('process_memory_bytes', 'Model parameters and process resident memory', ['kind'])
+MEMORY_BYTES.set_function(get_resident_memory_bytes, kind='resident')
@@ -0,0 +1,229 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+from pathlib import Path
+import resource
+import sys
+import time
+
+from access.utils.metrics import get_resident_memory_bytes
+'''Opt-in profiling of dataset preprocessing and training startup
+
+Profiling is enabled with profiling(enabled=True) or with the ACCESS_PROFILING environment variable:
+ACCESS_PROFILING=1 records stage durations, throughputs, memory and cache statistics,
+ACCESS_PROFILING=cprofile (or pyinstrument if installed) additionally dumps a profile per stage.
+profile_stage() is a no-op when profiling is disabled so that instrumented code paths can always call it.
+Stages run in worker processes (e.g. with n_jobs > 1) only show up through the children memory peak.
+'''
+
+PROFILING_ENV_VAR = 'ACCESS_PROFILING'
+PROFILERS = ('cprofile', 'pyinstrument')
+REPORT_NAME = 'profiling.json'
+# lru_caches worth watching, looked up in sys.modules so that profiling does not import them
+CACHED_FUNCTIONS = {
+    'word2rank': ('access.feature_extraction', 'get_word2rank'),
+    'spacy_process': ('access.text', 'spacy_process'),
+    'word_tokenize': ('access.text', 'word_tokenize'),
+}
+
+_active_profiler = None
+
+
+def get_peak_memory_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def get_cache_infos():
+    cache_infos = {}
+    for name, (module_name, function_name) in CACHED_FUNCTIONS.items():
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        cache_info = getattr(module, function_name).cache_info()
+        cache_infos[name] = {'hits': cache_info.hits, 'misses': cache_info.misses}
+    return cache_infos
+
+
+def get_cache_stats(start_cache_infos, end_cache_infos):
+    cache_stats = {}
+    for name, end_cache_info in end_cache_infos.items():
+        start_cache_info = start_cache_infos.get(name, {'hits': 0, 'misses': 0})
+        hits = end_cache_info['hits'] - start_cache_info['hits']
+        misses = end_cache_info['misses'] - start_cache_info['misses']
+        if hits + misses == 0:
+            continue
+        cache_stats[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+    return cache_stats
+
+
+class Profiler:
+    def __init__(self, dump_dir=None, profiler=None):
+        assert profiler in PROFILERS + (None, ), f'Unknown profiler {profiler}, use one of {PROFILERS}'
+        if profiler is not None:
+            assert dump_dir is not None, 'Profile dumps require a dump_dir'
+        self.dump_dir = Path(dump_dir) if dump_dir is not None else None
+        self.profiler = profiler
+        self.stages = []
+        self.is_profiling = False  # Stage profilers cannot be nested, only the outermost stage is profiled
+        self.start_time = time.time()
+
+    def get_dump_path(self, name, extension):
+        self.dump_dir.mkdir(parents=True, exist_ok=True)
+        return self.dump_dir / f'{len(self.stages):02d}_{name}.{extension}'
+
+    @contextmanager
+    def run_stage_profiler(self, name):
+        if self.profiler is None or self.is_profiling:
+            yield
+            return
+        self.is_profiling = True
+        try:
+            if self.profiler == 'cprofile':
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(str(self.get_dump_path(name, 'prof')))
+            else:
+                from pyinstrument import Profiler as InstrumentProfiler
+                profile = InstrumentProfiler()
+                profile.start()
+                try:
+                    yield
+                finally:
+                    profile.stop()
+                    self.get_dump_path(name, 'html').write_text(profile.output_html())
+        finally:
+            self.is_profiling = False
+
+    @contextmanager
+    def stage(self, name, n_lines=None):
+        '''Stages are recorded in the order they end, nested stages first'''
+        start_cache_infos = get_cache_infos()
+        start_rss = get_resident_memory_bytes()
+        start_time = time.time()
+        try:
+            with self.run_stage_profiler(name):
+                yield
+        finally:
+            duration = time.time() - start_time
+            stage = {
+                'name': name,
+                'seconds': duration,
+                'start_rss_bytes': start_rss,
+                'end_rss_bytes': get_resident_memory_bytes(),
+                'peak_rss_bytes': get_peak_memory_bytes(),
+                'children_peak_rss_bytes': get_peak_memory_bytes(resource.RUSAGE_CHILDREN),
+                'caches': get_cache_stats(start_cache_infos, get_cache_infos()),
+            }
+            if n_lines is not None:
+                stage['n_lines'] = n_lines
+                stage['lines_per_second'] = n_lines / duration if duration > 0 else float('inf')
+            self.stages.append(stage)
+            print(f'profiling stage={name} seconds={duration:.2f}' +
+                  (f' lines_per_second={stage["lines_per_second"]:.1f}' if n_lines is not None else ''))
+
+    def get_report(self):
+        return {
+            'total_seconds': time.time() - self.start_time,
+            'peak_rss_bytes': get_peak_memory_bytes(),
+            'children_peak_rss_bytes': get_peak_memory_bytes(resource.RUSAGE_CHILDREN),
+            'stages': self.stages,
+        }
+
+    def get_metrics(self):
+        '''Flat metrics for MLflow, repeated stage names get a numeric suffix'''
+        metrics = {}
+        for stage in self.stages:
+            name = stage['name']
+            suffix = 1
+            while f'profiling.{name}.seconds' in metrics:
+                suffix += 1
+                name = f'{stage["name"]}_{suffix}'
+            metrics[f'profiling.{name}.seconds'] = stage['seconds']
+            metrics[f'profiling.{name}.peak_rss_mb'] = stage['peak_rss_bytes'] / 2**20
+            if 'lines_per_second' in stage:
+                metrics[f'profiling.{name}.lines_per_second'] = stage['lines_per_second']
+            for cache_name, cache_stats in stage['caches'].items():
+                metrics[f'profiling.{name}.{cache_name}_hit_rate'] = cache_stats['hit_rate']
+        return metrics
+
+    def write_report(self, report_path):
+        report_path = Path(report_path)
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_report_path = f'{report_path}.tmp'
+        with open(tmp_report_path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
+        os.replace(tmp_report_path, report_path)
+        return report_path
+
+
+def log_to_mlflow(profiler, report_path):
+    try:
+        import mlflow
+    except ImportError:
+        return
+    if mlflow.active_run() is None:
+        return
+    mlflow.log_metrics(profiler.get_metrics())
+    mlflow.log_artifact(str(report_path))
+
+
+def get_profiling_mode():
+    '''None (disabled), 'stages' or a profiler name, read from the environment'''
+    value = os.environ.get(PROFILING_ENV_VAR, '').strip().lower()
+    if value in ('', '0', 'false', 'no'):
+        return None
+    if value in PROFILERS:
+        return value
+    return 'stages'
+
+
+def get_profiler():
+    return _active_profiler
+
+
+@contextmanager
+def profile_stage(name, n_lines=None):
+    if _active_profiler is None:
+        yield
+        return
+    with _active_profiler.stage(name, n_lines=n_lines):
+        yield
+
+
+@contextmanager
+def profiling(exp_dir, enabled=None, profiler=None):
+    '''Profile the stages run in this context and write a JSON report in exp_dir
+
+    enabled and profiler default to the ACCESS_PROFILING environment variable.
+    '''
+    global _active_profiler
+    mode = get_profiling_mode()
+    if enabled is None:
+        enabled = mode is not None
+    if profiler is None and mode in PROFILERS:
+        profiler = mode
+    if not enabled or _active_profiler is not None:
+        yield _active_profiler
+        return
+    exp_dir = Path(exp_dir)
+    _active_profiler = Profiler(dump_dir=exp_dir / 'profiles', profiler=profiler)
+    try:
+        yield _active_profiler
+    finally:
+        profiler, _active_profiler = _active_profiler, None
+        report_path = profiler.write_report(exp_dir / REPORT_NAME)
+        print(f'Profiling report written to {report_path}')
+        log_to_mlflow(profiler, report_path)
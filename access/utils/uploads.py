@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+import traceback
+'''Upload artifacts (e.g. checkpoints) in a background thread so that training does not wait for the network
+
+Each upload works on a hardlinked snapshot of the file: the file can be replaced (with os.replace) by the next save
+while it is being uploaded. The queue is bounded, when uploads fall behind the producer waits instead of piling up
+snapshots on disk. Failures do not interrupt training, they are raised together by close().
+'''
+
+
+def snapshot_file(path, snapshot_dir):
+    '''Hardlink (or copy if the filesystem does not support it) path into snapshot_dir, keeping its name'''
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_path = snapshot_dir / Path(path).name
+    try:
+        os.link(path, snapshot_path)
+    except OSError:
+        shutil.copyfile(path, snapshot_path)
+    return snapshot_path
+
+
+def mlflow_upload(run_id):
+    '''Upload to the given run, the active run of mlflow is not reliably shared with other threads'''
+    from mlflow.tracking import MlflowClient
+    client = MlflowClient()
+
+    def upload(path):
+        client.log_artifact(run_id, str(path))
+
+    return upload
+
+
+class BackgroundUploader:
+    def __init__(self, upload, staging_dir, max_queue_size=2):
+        self.upload = upload
+        self.staging_dir = Path(staging_dir)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.errors = []
+        self.n_uploads = 0
+        self.thread = threading.Thread(target=self.run, name='BackgroundUploader', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            snapshot_path = self.queue.get()
+            if snapshot_path is None:
+                return
+            try:
+                self.upload(snapshot_path)
+            except Exception:
+                print(f'Error: Upload of {snapshot_path.name} failed, training goes on')
+                self.errors.append(f'{snapshot_path.name}: {traceback.format_exc()}')
+            finally:
+                shutil.rmtree(snapshot_path.parent, ignore_errors=True)
+
+    def submit(self, path):
+        '''Blocks only when max_queue_size uploads are already waiting'''
+        assert self.thread.is_alive(), 'The uploader is closed'
+        self.n_uploads += 1
+        self.queue.put(snapshot_file(path, self.staging_dir / str(self.n_uploads)))
+
+    def close(self, raise_errors=True):
+        '''Wait for the pending uploads, raise if any of them failed (only print them without raise_errors)'''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        if len(self.errors) > 0:
+            message = f'{len(self.errors)} uploads failed:\n' + '\n'.join(self.errors)
+            if raise_errors:
+                raise RuntimeError(message)
+            print(f'Error: {message}')
+
+
+class NoUploader:
+    '''Stand-in for BackgroundUploader when there is nowhere to upload, e.g. outside of an mlflow run'''
+    def submit(self, path):
+        pass
+
+    def close(self, raise_errors=True):
+        pass
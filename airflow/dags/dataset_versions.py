@@ -0,0 +1,365 @@
+"""Versioned dataset layout: an immutable base plus append-only delta shards
+
+    <dataset>/manifest.json
+    <dataset>/base/<dataset>.{train,valid,test}.{complex,simple}
+    <dataset>/deltas/<version>/<dataset>.train.{complex,simple}
+    <dataset>/index/<version>.npy
+
+The manifest records the line count and md5 of every shard. Version N of the dataset is the base followed by the N
+first deltas, only the train split is extended. The manifest is written last so a failed upload never shows up as a
+version. Each version can also carry a hash index of all its train pairs (see pair_index.py) so that new pairs are
+deduplicated without downloading the corpus.
+
+Shards are downloaded to a local cache that mirrors the bucket layout. A shard is only downloaded when no cached file
+has the md5 recorded in the manifest.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from pair_index import PairIndex, build_pair_index
+
+PHASES = ['train', 'valid', 'test']
+LANGUAGES = ['complex', 'simple']
+CACHE_DIR = '/tmp/dataset_cache'
+CACHE_INDEX_FILENAME = '.md5_index.json'
+DOWNLOAD_WORKERS = 8
+
+
+class LocalDatasetStore:
+    """Bucket stand-in backed by a local directory"""
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, name)
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def list_names(self, prefix):
+        names = []
+        for dir_path, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dir_path, filename), self.root_dir)
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def read_text(self, name):
+        with open(self._path(name), 'r') as f:
+            return f.read()
+
+    def write_text(self, name, text):
+        os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+        tmp_path = self._path(name) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, self._path(name))
+
+    def upload(self, local_path, name):
+        os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+        shutil.copyfile(local_path, self._path(name))
+
+    def download(self, name, local_path):
+        shutil.copyfile(self._path(name), local_path)
+
+    def copy(self, source_name, target_name):
+        self.upload(self._path(source_name), target_name)
+
+
+class GCSDatasetStore:
+    def __init__(self, bucket_name):
+        from google.cloud import storage
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def exists(self, name):
+        return self.bucket.blob(name).exists()
+
+    def list_names(self, prefix):
+        return sorted(blob.name for blob in self.bucket.list_blobs(prefix=prefix))
+
+    def read_text(self, name):
+        return self.bucket.blob(name).download_as_text()
+
+    def write_text(self, name, text):
+        self.bucket.blob(name).upload_from_string(text, content_type='application/json')
+
+    def upload(self, local_path, name):
+        self.bucket.blob(name).upload_from_filename(local_path)
+
+    def download(self, name, local_path):
+        self.bucket.blob(name).download_to_filename(local_path)
+
+    def copy(self, source_name, target_name):
+        # Server-side copy, nothing goes through the worker
+        self.bucket.copy_blob(self.bucket.blob(source_name), self.bucket, target_name)
+
+
+def get_dataset_store(bucket_name='ts-dataset'):
+    """Use a local directory instead of the bucket when DATASET_STORE_DIR is set (e.g. for tests)"""
+    store_dir = os.getenv('DATASET_STORE_DIR')
+    if store_dir:
+        return LocalDatasetStore(store_dir)
+    return GCSDatasetStore(bucket_name)
+
+
+def get_filename(dataset, phase, language):
+    return f'{dataset}.{phase}.{language}'
+
+
+def get_manifest_name(dataset):
+    return f'{dataset}/manifest.json'
+
+
+def get_file_entry(name, local_path):
+    """Line count and md5 computed in a single pass over the file"""
+    md5 = hashlib.md5()
+    lines = 0
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            lines += chunk.count(b'\n')
+    return {'name': name, 'lines': lines, 'md5': md5.hexdigest()}
+
+
+def new_version_name(dataset):
+    return f'{dataset}_{int(time.time())}'
+
+
+def load_manifest(store, dataset):
+    if not store.exists(get_manifest_name(dataset)):
+        return None
+    return json.loads(store.read_text(get_manifest_name(dataset)))
+
+
+def write_manifest(store, manifest):
+    store.write_text(get_manifest_name(manifest['dataset']), json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def bootstrap_manifest(store, dataset, work_dir='/tmp'):
+    """One-off migration of the latest legacy `<dataset>_<timestamp>/` prefix into the base of a new manifest"""
+    legacy_names = [name for name in store.list_names(f'{dataset}_') if '/' in name]
+    if not legacy_names:
+        raise ValueError(f"No datasets found for {dataset}.")
+    legacy_prefix = max(name.split('/')[0] for name in legacy_names)
+    logging.info(f"Bootstrapping {dataset} manifest from legacy prefix {legacy_prefix}")
+    files = {}
+    for phase in PHASES:
+        for language in LANGUAGES:
+            filename = get_filename(dataset, phase, language)
+            base_name = f'{dataset}/base/{filename}'
+            store.copy(f'{legacy_prefix}/{filename}', base_name)
+            local_path = os.path.join(work_dir, legacy_prefix, filename)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            store.download(base_name, local_path)
+            files[filename] = get_file_entry(base_name, local_path)
+            os.remove(local_path)
+    manifest = {'dataset': dataset, 'base': {'version': legacy_prefix, 'files': files}, 'deltas': []}
+    write_manifest(store, manifest)
+    return manifest
+
+
+def get_versions(manifest):
+    return [manifest['base']['version']] + [delta['version'] for delta in manifest['deltas']]
+
+
+def get_latest_version(manifest):
+    return get_versions(manifest)[-1]
+
+
+def get_shards(manifest, version=None):
+    """Shards making up a version, as {filename: [file_entry, ...]} in concatenation order"""
+    versions = get_versions(manifest)
+    if version is None:
+        version = versions[-1]
+    assert version in versions, f'Unknown version {version}, available versions: {versions}'
+    n_deltas = versions.index(version)
+    shards = {filename: [entry] for filename, entry in manifest['base']['files'].items()}
+    for delta in manifest['deltas'][:n_deltas]:
+        for filename, entry in delta['files'].items():
+            shards[filename].append(entry)
+    return shards
+
+
+def get_line_counts(manifest, version=None):
+    return {
+        filename: sum(entry['lines'] for entry in entries)
+        for filename, entries in get_shards(manifest, version).items()
+    }
+
+
+def get_index_entry(manifest, version=None):
+    versions = get_versions(manifest)
+    if version is None:
+        version = versions[-1]
+    if version == versions[0]:
+        return manifest['base'].get('index')
+    return manifest['deltas'][versions.index(version) - 1].get('index')
+
+
+def append_delta(store, manifest, local_train_files, version=None, local_index_path=None):
+    """Upload new train pairs as a delta shard and publish them as a new version
+
+    local_train_files maps each language to a local file holding the new lines. local_index_path optionally holds
+    the pair index of the whole new version.
+    """
+    dataset = manifest['dataset']
+    if version is None:
+        version = new_version_name(dataset)
+    files = {}
+    for language in LANGUAGES:
+        filename = get_filename(dataset, 'train', language)
+        name = f'{dataset}/deltas/{version}/{filename}'
+        files[filename] = get_file_entry(name, local_train_files[language])
+    line_counts = {entry['lines'] for entry in files.values()}
+    assert len(line_counts) == 1, f'Delta files are not aligned: {files}'
+    for language in LANGUAGES:
+        filename = get_filename(dataset, 'train', language)
+        store.upload(local_train_files[language], files[filename]['name'])
+        logging.info(f"Uploaded {local_train_files[language]} to {files[filename]['name']}")
+    delta = {'version': version, 'created_at': int(time.time()), 'files': files}
+    if local_index_path is not None:
+        delta['index'] = {'name': f'{dataset}/index/{version}.npy', 'md5': get_md5(local_index_path)}
+        store.upload(local_index_path, delta['index']['name'])
+        logging.info(f"Uploaded {local_index_path} to {delta['index']['name']}")
+    manifest['deltas'].append(delta)
+    write_manifest(store, manifest)
+    return version
+
+
+def get_md5(local_path):
+    md5 = hashlib.md5()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DatasetCache:
+    """Local copy of shards, validated against the md5 recorded in the manifest
+
+    Computed md5s are indexed by (size, mtime) so unchanged files are not rehashed on every run.
+    """
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, CACHE_INDEX_FILENAME)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+    def get_path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get_cached_md5(self, name):
+        path = self.get_path(name)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        indexed = self.index.get(name)
+        if indexed is not None and indexed['key'] == key:
+            return indexed['md5']
+        md5 = get_md5(path)
+        self.index[name] = {'key': key, 'md5': md5}
+        return md5
+
+    def is_cached(self, entry):
+        return self.get_cached_md5(entry['name']) == entry['md5']
+
+    def save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def download(self, store, entry):
+        path = self.get_path(entry['name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.download'
+        store.download(entry['name'], tmp_path)
+        md5 = get_md5(tmp_path)
+        if md5 != entry['md5']:
+            os.remove(tmp_path)
+            raise ValueError(f"Checksum mismatch for {entry['name']}: expected {entry['md5']}, got {md5}")
+        os.replace(tmp_path, path)
+        stat = os.stat(path)
+        return entry['name'], {'key': [stat.st_size, stat.st_mtime_ns], 'md5': md5}
+
+    def sync(self, store, entries, max_workers=DOWNLOAD_WORKERS):
+        """Make sure all entries are in the cache, missing or stale ones are downloaded concurrently"""
+        missing_entries = [entry for entry in entries if not self.is_cached(entry)]
+        logging.info(f"Dataset cache: {len(entries) - len(missing_entries)} hits, {len(missing_entries)} downloads")
+        if missing_entries:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for name, indexed in executor.map(lambda entry: self.download(store, entry), missing_entries):
+                    self.index[name] = indexed
+                    logging.info(f"Downloaded {name} to {self.get_path(name)}")
+        self.save_index()
+        return [self.get_path(entry['name']) for entry in entries]
+
+
+def sync_version(store, manifest, version=None, cache=None):
+    """Cache all shards of a version locally, returns {filename: [local shard path, ...]}"""
+    if cache is None:
+        cache = DatasetCache()
+    shards = get_shards(manifest, version)
+    cache.sync(store, [entry for entries in shards.values() for entry in entries])
+    return {filename: [cache.get_path(entry['name']) for entry in entries] for filename, entries in shards.items()}
+
+
+def materialize_version(store, manifest, output_dir, version=None, cache=None):
+    """Concatenate the cached shards of a version into plain dataset files in output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, shard_paths in sync_version(store, manifest, version, cache).items():
+        output_path = os.path.join(output_dir, filename)
+        with open(output_path, 'wb') as output_file:
+            for shard_path in shard_paths:
+                with open(shard_path, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, output_file)
+        logging.info(f"Materialized {output_path} from {len(shard_paths)} shards")
+    return output_dir
+
+
+def load_pair_index(store, manifest, index_path, version=None, cache=None):
+    """Writable copy at index_path of the pair index of a version
+
+    Versions published without an index get one built from their (cached) train shards.
+    """
+    if cache is None:
+        cache = DatasetCache()
+    entry = get_index_entry(manifest, version)
+    if entry is not None:
+        cached_path = cache.sync(store, [entry])[0]
+        return PairIndex.copy(cached_path, index_path)
+    logging.info(f"No pair index for version {version}, building it from the train shards")
+    shards = sync_version(store, manifest, version, cache)
+    dataset = manifest['dataset']
+    line_counts = get_line_counts(manifest, version)
+    index = build_pair_index(shards[get_filename(dataset, 'train', 'complex')],
+                             shards[get_filename(dataset, 'train', 'simple')],
+                             n_items=line_counts[get_filename(dataset, 'train', 'complex')])
+    index.save(index_path)
+    return PairIndex.load(index_path, writable=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Materialize a version of a dataset stored as base + deltas')
+    parser.add_argument('output_dir')
+    parser.add_argument('--dataset', default='wikilarge')
+    parser.add_argument('--version', default=None, help='Defaults to the latest version')
+    parser.add_argument('--bucket', default='ts-dataset')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+    store = get_dataset_store(args.bucket)
+    manifest = load_manifest(store, args.dataset)
+    assert manifest is not None, f'No manifest found for {args.dataset}'
+    materialize_version(store, manifest, args.output_dir, version=args.version, cache=DatasetCache(args.cache_dir))
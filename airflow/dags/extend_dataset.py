@@ -1,15 +1,17 @@
 import os
 import psycopg2
-from google.cloud import storage
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator, BranchPythonOperator
 from airflow.hooks.base import BaseHook
-from airflow.providers.google.cloud.hooks.gcs import GCSHook
+
+from dataset_versions import (get_dataset_store, load_manifest, bootstrap_manifest, get_latest_version,
+                              get_line_counts, append_delta, load_pair_index)
+from pair_index import hash_pair, hash_text, get_line_hashes
 
 from datetime import datetime, timedelta
 import logging
-import time
+import shutil
 
 default_args = {
     'owner': 'airflow',
@@ -29,30 +31,70 @@ dag = DAG(
     catchup=False,
 )
 
-def query_db(ti):
+BUCKET_NAME = 'ts-dataset'
+DATASET = 'wikilarge'
+STAGING_DIR = '/tmp/labelled'
+TURKCORPUS_NAMES = ['turkcorpus/turkcorpus.valid.complex', 'turkcorpus/turkcorpus.test.complex']
+FETCH_SIZE = 10000
+DELETE_BATCH_SIZE = 10000
+
+
+def get_staging_files(staging_dir):
+    return {
+        'complex': os.path.join(staging_dir, 'labelled.complex'),
+        'simple': os.path.join(staging_dir, 'labelled.simple'),
+        'ids': os.path.join(staging_dir, 'labelled.ids'),
+    }
+
+def get_delta_files(staging_dir):
+    return {
+        'complex': os.path.join(staging_dir, 'delta', f'{DATASET}.train.complex'),
+        'simple': os.path.join(staging_dir, 'delta', f'{DATASET}.train.simple'),
+    }
+
+def get_delta_index_path(staging_dir):
+    return os.path.join(staging_dir, 'delta', 'index.npy')
+
+def get_db_connection():
+    db_conn = BaseHook.get_connection("ts-db")
+
+    connection_str = f"dbname='{db_conn.schema}' user='{db_conn.login}' password='{db_conn.password}' host='{db_conn.host}' port='{db_conn.port}'"
+
+    return psycopg2.connect(connection_str, connect_timeout=30)
+
+def query_db(ti, ts_nodash, **kwargs):
+    """Stream labelled pairs to local staging files, only counts and path go through XCom"""
+    staging_dir = os.path.join(STAGING_DIR, ts_nodash)
+    os.makedirs(staging_dir, exist_ok=True)
+    staging_files = get_staging_files(staging_dir)
+
     conn = None
     cursor = None
     try:
         logging.info("Setting up database connection")
-        db_conn = BaseHook.get_connection("ts-db")
-    
-        connection_str = f"dbname='{db_conn.schema}' user='{db_conn.login}' password='{db_conn.password}' host='{db_conn.host}' port='{db_conn.port}'"
-
-        conn = psycopg2.connect(connection_str, connect_timeout=30)
-        cursor = conn.cursor()
+        conn = get_db_connection()
+        # Named cursors are server-side: rows are fetched in chunks of itersize instead of all at once
+        cursor = conn.cursor(name='labelled_data_stream')
+        cursor.itersize = FETCH_SIZE
         logging.info("Database connection established")
 
-        query = "SELECT id, original, simplified FROM labelled.data"
+        query = "SELECT id, original, simplified FROM labelled.data ORDER BY id"
         logging.info(f"Executing query: {query}")
         cursor.execute(query)
-        records = cursor.fetchall()
-        logging.info(f"Query executed successfully, fetched {len(records)} records.")
 
-        result = [{"id": record[0], "original": record[1], "simple": record[2]} for record in records]
-        ti.xcom_push(key='record_count', value=len(result))
-        ti.xcom_push(key='records', value=result)
-        
-        return result
+        record_count = 0
+        # The exported ids are staged too: exactly these rows are deleted once the dataset is uploaded
+        with open(staging_files['complex'], 'w') as complex_file, open(staging_files['simple'], 'w') as simple_file, \
+                open(staging_files['ids'], 'w') as ids_file:
+            for id_, original, simplified in cursor:
+                complex_file.write(original + '\n')
+                simple_file.write(simplified + '\n')
+                ids_file.write(f'{id_}\n')
+                record_count += 1
+        logging.info(f"Query executed successfully, streamed {record_count} records to {staging_dir}.")
+
+        ti.xcom_push(key='record_count', value=record_count)
+        ti.xcom_push(key='staging_dir', value=staging_dir)
 
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
@@ -64,116 +106,122 @@ def query_db(ti):
         if conn:
             conn.close()
         logging.info("Database connection closed")
-        
+
 
 def extract_latest_dataset(**kwargs):
+    """Resolve the latest dataset version from the manifest, nothing is downloaded"""
     try:
-        gcs_hook = GCSHook(gcp_conn_id='ts-storage')
-        bucket_name = 'ts-dataset'
-        prefix = 'wikilarge_'
-
-        logging.info("Connecting to GCS")
-        client = storage.Client()
-        bucket = client.get_bucket(bucket_name)
-        blobs = list(bucket.list_blobs(prefix=prefix))
-        
-        if not blobs:
-            raise ValueError("No datasets found in the bucket.")
-
-        latest_blob = max(blobs, key=lambda b: b.updated)
-        latest_prefix = latest_blob.name.split('/')[0]
-        logging.info(f"Latest prefix: {latest_prefix}")
-        
-        for blob in bucket.list_blobs(prefix=latest_prefix):
-            local_path = os.path.join('/tmp', blob.name)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            blob.download_to_filename(local_path)
-            logging.info(f"Downloaded {blob.name} to {local_path}")
-
-        return latest_prefix
+        store = get_dataset_store(BUCKET_NAME)
+        manifest = load_manifest(store, DATASET)
+        if manifest is None:
+            manifest = bootstrap_manifest(store, DATASET)
+        latest_version = get_latest_version(manifest)
+        logging.info(f"Latest version: {latest_version}")
+        return latest_version
     except Exception as e:
         logging.error(f"Failed to extract latest dataset: {e}")
         raise
 
+def get_eval_line_hashes(store, staging_dir):
+    """Hashes of turkcorpus valid/test complex sentences, which must never leak into the train set"""
+    eval_filepaths = []
+    for name in TURKCORPUS_NAMES:
+        if not store.exists(name):
+            logging.warning(f"{name} not found in the bucket, pairs leaking it will not be filtered")
+            continue
+        filepath = os.path.join(staging_dir, os.path.basename(name))
+        store.download(name, filepath)
+        eval_filepaths.append(filepath)
+    return get_line_hashes(eval_filepaths)
+
 def extend_dataset(**kwargs):
+    """Write the staged pairs as the next delta shard of the train split, without duplicates or eval leaks"""
     ti = kwargs['ti']
-    records = ti.xcom_pull(task_ids='query_db', key='records')
-    latest_prefix = ti.xcom_pull(task_ids='extract_latest_dataset')
-
-    dataset_files = {
-        'train_complex': f'/tmp/{latest_prefix}/wikilarge.train.complex',
-        'train_simple': f'/tmp/{latest_prefix}/wikilarge.train.simple',
-        'valid_complex': f'/tmp/{latest_prefix}/wikilarge.valid.complex',
-        'valid_simple': f'/tmp/{latest_prefix}/wikilarge.valid.simple',
-        'test_complex': f'/tmp/{latest_prefix}/wikilarge.test.complex',
-        'test_simple': f'/tmp/{latest_prefix}/wikilarge.test.simple',
-    }
-
-    def get_file_line_count(file_path):
-        with open(file_path, 'r') as f:
-            return sum(1 for _ in f)
-
-    logging.info("Dataset files BEFORE extending:")
-    for file_name, file_path in dataset_files.items():
-        line_count = get_file_line_count(file_path)
-        logging.info(f"{file_name}: {line_count} records")
-
-    with open(dataset_files['train_complex'], 'a') as complex_file, open(dataset_files['train_simple'], 'a') as simple_file:
-        for record in records:
-            complex_file.write(record['original'] + '\n')
-            simple_file.write(record['simple'] + '\n')
-
-    logging.info("\nDataset files AFTER extending:")
-    for file_name, file_path in dataset_files.items():
-        line_count = get_file_line_count(file_path)
+    staging_dir = ti.xcom_pull(task_ids='query_db', key='staging_dir')
+    staging_files = get_staging_files(staging_dir)
+    delta_files = get_delta_files(staging_dir)
+    latest_version = ti.xcom_pull(task_ids='extract_latest_dataset')
+    store = get_dataset_store(BUCKET_NAME)
+    manifest = load_manifest(store, DATASET)
+
+    logging.info(f"Dataset files BEFORE extending ({latest_version}):")
+    for file_name, line_count in get_line_counts(manifest, latest_version).items():
         logging.info(f"{file_name}: {line_count} records")
 
+    os.makedirs(os.path.dirname(delta_files['complex']), exist_ok=True)
+    # The index of the latest version is copied and extended with the new pairs to become the index of the new version
+    pair_index = load_pair_index(store, manifest, get_delta_index_path(staging_dir), latest_version)
+    eval_line_hashes = get_eval_line_hashes(store, staging_dir)
+    n_pairs = n_duplicates = n_leaks = 0
+    with open(staging_files['complex'], 'r') as staging_complex, open(staging_files['simple'], 'r') as staging_simple, \
+            open(delta_files['complex'], 'w') as delta_complex, open(delta_files['simple'], 'w') as delta_simple:
+        for complex_line, simple_line in zip(staging_complex, staging_simple):
+            if hash_text(complex_line.rstrip('\n')) in eval_line_hashes:
+                n_leaks += 1
+                continue
+            if not pair_index.add(hash_pair(complex_line, simple_line)):
+                n_duplicates += 1
+                continue
+            delta_complex.write(complex_line)
+            delta_simple.write(simple_line)
+            n_pairs += 1
+    pair_index.save(get_delta_index_path(staging_dir))
+    logging.info(f"New delta: {n_pairs} train pairs, dropped {n_duplicates} duplicates and {n_leaks} turkcorpus leaks")
+    ti.xcom_push(key='n_pairs', value=n_pairs)
+    ti.xcom_push(key='n_duplicates', value=n_duplicates)
+    ti.xcom_push(key='n_leaks', value=n_leaks)
 
 def upload_extended_dataset(**kwargs):
+    """Upload only the new delta shard and publish it in the manifest"""
     ti = kwargs['ti']
-    latest_prefix = ti.xcom_pull(task_ids='extract_latest_dataset')
-    new_prefix = f"wikilarge_{int(time.time())}"
-    dataset_files = {
-        'train_complex': f'/tmp/{latest_prefix}/wikilarge.train.complex',
-        'train_simple': f'/tmp/{latest_prefix}/wikilarge.train.simple',
-        'valid_complex': f'/tmp/{latest_prefix}/wikilarge.valid.complex',
-        'valid_simple': f'/tmp/{latest_prefix}/wikilarge.valid.simple',
-        'test_complex': f'/tmp/{latest_prefix}/wikilarge.test.complex',
-        'test_simple': f'/tmp/{latest_prefix}/wikilarge.test.simple',
-    }
-
-    client = storage.Client()
-    bucket = client.get_bucket('ts-dataset')
+    staging_dir = ti.xcom_pull(task_ids='query_db', key='staging_dir')
+    delta_files = get_delta_files(staging_dir)
+    store = get_dataset_store(BUCKET_NAME)
+    manifest = load_manifest(store, DATASET)
+    new_version = append_delta(store, manifest, delta_files, local_index_path=get_delta_index_path(staging_dir))
+
+    logging.info(f"Dataset files AFTER extending ({new_version}):")
+    for file_name, line_count in get_line_counts(manifest, new_version).items():
+        logging.info(f"{file_name}: {line_count} records")
 
-    for file_name, file_path in dataset_files.items():
-        blob = bucket.blob(f"{new_prefix}/{os.path.basename(file_path)}")
-        blob.upload_from_filename(file_path)
-        logging.info(f"Uploaded {file_path} to {blob.public_url}")
+    return new_version
 
-    return new_prefix
+def read_exported_ids(ids_filepath):
+    """Ids of the streamed rows, in chunks of DELETE_BATCH_SIZE"""
+    ids = []
+    with open(ids_filepath, 'r') as ids_file:
+        for line in ids_file:
+            ids.append(int(line))
+            if len(ids) == DELETE_BATCH_SIZE:
+                yield ids
+                ids = []
+    if ids:
+        yield ids
 
 def delete_processed_records(**kwargs):
     ti = kwargs['ti']
-    records = ti.xcom_pull(task_ids='query_db', key='records')
-    ids = [record['id'] for record in records]
+    staging_dir = ti.xcom_pull(task_ids='query_db', key='staging_dir')
+    staging_files = get_staging_files(staging_dir)
 
     conn = None
     cursor = None
     try:
         logging.info("Setting up database connection")
-        db_conn = BaseHook.get_connection("ts-db")
-    
-        connection_str = f"dbname='{db_conn.schema}' user='{db_conn.login}' password='{db_conn.password}' host='{db_conn.host}' port='{db_conn.port}'"
-
-        conn = psycopg2.connect(connection_str, connect_timeout=30)
+        conn = get_db_connection()
         cursor = conn.cursor()
         logging.info("Database connection established")
 
-        delete_query = f"DELETE FROM labelled.data WHERE id = ANY(%s)"
+        # Only the exported ids are deleted, not everything up to the highest one: a row with a lower id committed
+        # after the export snapshot was never exported and stays for the next run
+        delete_query = "DELETE FROM labelled.data WHERE id = ANY(%s)"
         logging.info(f"Executing query: {delete_query}")
-        cursor.execute(delete_query, (ids,))
+        n_deleted = 0
+        for ids in read_exported_ids(staging_files['ids']):
+            cursor.execute(delete_query, (ids,))
+            n_deleted += cursor.rowcount
+        # All chunks are deleted in a single transaction
         conn.commit()
-        logging.info(f"Deleted {cursor.rowcount} records from the database.")
+        logging.info(f"Deleted {n_deleted} records from the database.")
 
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
@@ -186,6 +234,8 @@ def delete_processed_records(**kwargs):
             conn.close()
         logging.info("Database connection closed")
 
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
 def check_records(**kwargs):
     ti = kwargs['ti']
     record_count = ti.xcom_pull(task_ids='query_db', key='record_count')
@@ -194,6 +244,12 @@ def check_records(**kwargs):
     else:
         return 'no_records'
 
+def no_records(**kwargs):
+    logging.info("No records found in the database.")
+    # The staging files are empty, nothing downstream removes them
+    staging_dir = kwargs['ti'].xcom_pull(task_ids='query_db', key='staging_dir')
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
 with dag:
     
     query_db_task = PythonOperator(
@@ -211,7 +267,8 @@ with dag:
 
     no_records_task = PythonOperator(
         task_id='no_records',
-        python_callable=lambda: logging.info("No records found in the database."),
+        python_callable=no_records,
+        provide_context=True,
     )
 
     extract_latest_dataset_task = PythonOperator(
@@ -0,0 +1,111 @@
+"""Compact on-disk hash set of (complex, simple) pairs
+
+The set is an open addressing table of 64-bit pair hashes (linear probing, 0 marks an empty slot) saved as a .npy
+file, so it can be memory-mapped instead of loaded and membership tests are O(1).
+"""
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+EMPTY = 0
+MAX_LOAD_FACTOR = 0.5
+MIN_CAPACITY = 1024
+
+
+def hash_text(text):
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    # 0 is reserved for empty slots
+    return int.from_bytes(digest, 'little') or 1
+
+
+def hash_pair(complex_sentence, simple_sentence):
+    return hash_text(complex_sentence.rstrip('\n') + '\t' + simple_sentence.rstrip('\n'))
+
+
+def get_capacity(n_items):
+    capacity = MIN_CAPACITY
+    while capacity * MAX_LOAD_FACTOR < n_items:
+        capacity *= 2
+    return capacity
+
+
+class PairIndex:
+    def __init__(self, table):
+        self.table = table
+        self.mask = len(table) - 1
+        self.n_items = int(np.count_nonzero(table))
+
+    @classmethod
+    def empty(cls, n_items=0):
+        return cls(np.zeros(get_capacity(n_items), dtype=np.uint64))
+
+    @classmethod
+    def load(cls, path, writable=False):
+        return cls(np.load(path, mmap_mode='r+' if writable else 'r'))
+
+    @classmethod
+    def copy(cls, source_path, target_path):
+        """Writable index backed by a copy of source_path, the source is left untouched"""
+        shutil.copyfile(source_path, target_path)
+        return cls.load(target_path, writable=True)
+
+    def save(self, path):
+        if isinstance(self.table, np.memmap) and self.table.filename == os.path.abspath(path):
+            self.table.flush()
+            return
+        with open(path, 'wb') as f:
+            np.save(f, np.asarray(self.table))
+
+    def _find_slot(self, pair_hash):
+        slot = pair_hash & self.mask
+        while True:
+            value = int(self.table[slot])
+            if value == EMPTY or value == pair_hash:
+                return slot, value == pair_hash
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, pair_hash):
+        return self._find_slot(pair_hash)[1]
+
+    def __len__(self):
+        return self.n_items
+
+    def _grow(self):
+        old_table = np.asarray(self.table)
+        self.table = np.zeros(len(old_table) * 2, dtype=np.uint64)
+        self.mask = len(self.table) - 1
+        self.n_items = 0
+        for pair_hash in old_table[old_table != EMPTY].tolist():
+            self.add(pair_hash)
+
+    def add(self, pair_hash):
+        """Returns False if the hash was already present"""
+        if (self.n_items + 1) > len(self.table) * MAX_LOAD_FACTOR:
+            # The grown table lives in memory, save() writes it back to disk
+            self._grow()
+        slot, found = self._find_slot(pair_hash)
+        if found:
+            return False
+        self.table[slot] = pair_hash
+        self.n_items += 1
+        return True
+
+
+def build_pair_index(complex_filepaths, simple_filepaths, n_items=0):
+    """Index all pairs of aligned shards"""
+    index = PairIndex.empty(n_items)
+    for complex_filepath, simple_filepath in zip(complex_filepaths, simple_filepaths):
+        with open(complex_filepath, 'r') as complex_file, open(simple_filepath, 'r') as simple_file:
+            for complex_line, simple_line in zip(complex_file, simple_file):
+                index.add(hash_pair(complex_line, simple_line))
+    return index
+
+
+def get_line_hashes(filepaths):
+    line_hashes = set()
+    for filepath in filepaths:
+        with open(filepath, 'r') as f:
+            line_hashes.update(hash_text(line.rstrip('\n')) for line in f)
+    return line_hashes
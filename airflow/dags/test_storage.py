@@ -1,12 +1,10 @@
 from datetime import datetime, timedelta
-import os
-import pandas as pd
 from airflow import DAG
 from airflow.operators.python import PythonOperator
-from airflow.providers.google.cloud.hooks.gcs import GCSHook
-from google.cloud import storage
 import logging
 
+from dataset_versions import get_dataset_store, load_manifest, get_latest_version, get_line_counts, sync_version
+
 # Define your arguments
 default_args = {
     'owner': 'airflow',
@@ -28,54 +26,32 @@ dag = DAG(
 
 def extract_latest_dataset(**kwargs):
     try:
-        gcs_hook = GCSHook(gcp_conn_id='ts-storage')
-        bucket_name = 'ts-dataset'
-        prefix = 'wikilarge_'
-
         logging.info("Connecting to GCS")
-        client = storage.Client()
-        bucket = client.get_bucket(bucket_name)
-        blobs = list(bucket.list_blobs(prefix=prefix))
-        
-        if not blobs:
+        store = get_dataset_store('ts-dataset')
+        # The latest version is resolved from the manifest, no need to list the bucket
+        manifest = load_manifest(store, 'wikilarge')
+        if manifest is None:
             raise ValueError("No datasets found in the bucket.")
 
-        latest_blob = max(blobs, key=lambda b: b.updated)
-        latest_prefix = latest_blob.name.split('/')[0]
-        logging.info(f"Latest prefix: {latest_prefix}")
-        
-        for blob in bucket.list_blobs(prefix=latest_prefix):
-            local_path = os.path.join('/tmp', blob.name)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            blob.download_to_filename(local_path)
-            logging.info(f"Downloaded {blob.name} to {local_path}")
+        latest_version = get_latest_version(manifest)
+        logging.info(f"Latest version: {latest_version}")
 
-        return latest_prefix
+        # Shards already present in the local cache with the right md5 are not downloaded again
+        sync_version(store, manifest, latest_version)
+
+        return latest_version
     except Exception as e:
         logging.error(f"Failed to extract latest dataset: {e}")
         raise
 
 def count_records(ti):
     try:
-        latest_prefix = ti.xcom_pull(task_ids='extract_latest_dataset')
-        logging.info(f"Pulled latest prefix: {latest_prefix}")
-
-        dataset_files = [
-            f'/tmp/{latest_prefix}/wikilarge.train.complex',
-            f'/tmp/{latest_prefix}/wikilarge.train.simple',
-            f'/tmp/{latest_prefix}/wikilarge.valid.complex',
-            f'/tmp/{latest_prefix}/wikilarge.valid.simple',
-            f'/tmp/{latest_prefix}/wikilarge.test.complex',
-            f'/tmp/{latest_prefix}/wikilarge.test.simple'
-        ]
+        latest_version = ti.xcom_pull(task_ids='extract_latest_dataset')
+        logging.info(f"Pulled latest version: {latest_version}")
 
-        for file_path in dataset_files:
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as file:
-                    lines = file.readlines()
-                    logging.info(f"{os.path.basename(file_path)}: {len(lines)} records")
-            else:
-                logging.warning(f"File not found: {file_path}")
+        manifest = load_manifest(get_dataset_store('ts-dataset'), 'wikilarge')
+        for filename, line_count in get_line_counts(manifest, latest_version).items():
+            logging.info(f"{filename}: {line_count} records")
     except Exception as e:
         logging.error(f"Failed to count records: {e}")
         raise
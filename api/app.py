@@ -2,6 +2,7 @@ import logging
 from flask import Flask
 from routes.annotate import annotate_bp
 from routes.simplify import simplify_bp
+from routes.metrics import metrics_bp
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -11,6 +12,7 @@ app.secret_key = 'your_secret_key'
 
 app.register_blueprint(annotate_bp)
 app.register_blueprint(simplify_bp)
+app.register_blueprint(metrics_bp)
 
 def main():
     app.run(host='0.0.0.0', port=3003) # run app in debug mode on port 3003
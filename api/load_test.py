@@ -0,0 +1,399 @@
+'''Load test the simplification and annotation endpoints
+
+By default the app is served in-process with a stub model and an in-memory fake of the Postgres tables, so that the
+serving layer (request handling, model lock, prediction store, leases) is measured without a GPU or a database. Use
+--url to target a running deployment instead (e.g. docker-compose with a local Postgres), or --real-model / --real-db
+to keep the real backends in-process.
+
+Examples:
+    PYTHONPATH=. python api/load_test.py --concurrency 8 --duration 30
+    PYTHONPATH=. python api/load_test.py --sweep 1,2,4,8,16,32 --endpoints simplify,api_simplify
+    python api/load_test.py --url http://localhost:3003 --rate 20 --sentences-file sentences.txt
+'''
+import argparse
+import atexit
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from http.cookiejar import CookieJar
+import json
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # The app imports its modules relative to api/
+
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_WORDS = ('the', 'a', 'city', 'government', 'announced', 'that', 'new', 'regulations', 'would', 'be',
+                   'implemented', 'in', 'order', 'to', 'reduce', 'traffic', 'congestion', 'during', 'peak', 'hours',
+                   'which', 'has', 'been', 'increasing', 'significantly', 'over', 'past', 'decade', 'residents',
+                   'however', 'expressed', 'concerns', 'about', 'impact', 'on', 'local', 'businesses', 'and')
+ENDPOINTS = ('simplify', 'api_simplify', 'annotate', 'annotate_batch')
+
+
+def get_synthetic_sentences(n_sentences, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(8, 40))) + ' .'
+            for _ in range(n_sentences)]
+
+
+def load_sentences(sentences_file=None, n_sentences=1000):
+    if sentences_file is None:
+        return get_synthetic_sentences(n_sentences)
+    with open(sentences_file, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# Fake backends
+def render_query(query):
+    '''Text of a psycopg2.sql query'''
+    from psycopg2 import sql
+    if isinstance(query, sql.Composed):
+        return ''.join(render_query(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return '.'.join(query.strings)
+    if isinstance(query, sql.SQL):
+        return query.string
+    return query
+
+
+class FakeDatabase:
+    '''In-memory unlabeled.data and labelled.data tables, understanding only the queries issued by the services'''
+    def __init__(self, latency=0.):
+        self.tables = {'unlabeled': {}, 'labelled': {}}
+        self.leases = {}  # leased_by and leased_until columns of unlabeled.data: {id: (annotator_id, leased_until)}
+        self.next_id = 1
+        self.latency = latency  # Simulated round trip per query
+        self.lock = threading.Lock()
+
+    def insert(self, schema, original, simplified):
+        with self.lock:
+            self.tables[schema][self.next_id] = (original, simplified)
+            self.next_id += 1
+
+    def connect(self):
+        connection = FakeConnection(self)
+        return connection, connection.cursor()
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, query, params=()):
+        time.sleep(self.database.latency)
+        query = ' '.join(render_query(query).split())
+        tables = self.database.tables
+        match = re.match(r'INSERT INTO (\w+)\.data \(original, simplified\) VALUES \(%s, %s\)$', query)
+        if match:
+            self.database.insert(match.group(1), *params)
+            return
+        with self.database.lock:
+            leases = self.database.leases
+            if re.match(r'ALTER TABLE unlabeled\.data ADD COLUMN IF NOT EXISTS', query):
+                pass
+            elif re.match(r'DELETE FROM unlabeled\.data WHERE id = %s$', query):
+                tables['unlabeled'].pop(int(params[0]), None)
+                leases.pop(int(params[0]), None)
+            elif re.match(r'UPDATE unlabeled\.data SET leased_by = NULL, leased_until = NULL WHERE leased_by = %s$',
+                          query):
+                for id_ in [id_ for id_, (owner, _) in leases.items() if owner == params[0]]:
+                    del leases[id_]
+            elif re.match(r'UPDATE unlabeled\.data SET leased_by = %s, leased_until = .* FOR UPDATE SKIP LOCKED\) '
+                          r'RETURNING id, original, simplified$', query):
+                annotator_id, lease_seconds, excluded_ids, limit = params
+                now = time.time()
+                ids = [id_ for id_ in sorted(tables['unlabeled'])
+                       if id_ not in set(excluded_ids) and (id_ not in leases or leases[id_][1] <= now)][:limit]
+                for id_ in ids:
+                    leases[id_] = (annotator_id, now + lease_seconds)
+                self.rows = [(id_, *tables['unlabeled'][id_]) for id_ in ids]
+            elif re.match(r'DELETE FROM unlabeled\.data WHERE id = ANY\(%s\) RETURNING id, original, simplified$',
+                          query):
+                self.rows = [(id_, *tables['unlabeled'].pop(id_)) for id_ in params[0] if id_ in tables['unlabeled']]
+                for id_, *_ in self.rows:
+                    leases.pop(id_, None)
+            else:
+                raise NotImplementedError(f'Query not supported by the fake database: {query}')
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+def fake_execute_values(cursor, query, rows):
+    match = re.match(r'INSERT INTO (\w+)\.data \(original, simplified\) VALUES %s$', query)
+    assert match is not None, f'Query not supported by the fake database: {query}'
+    for row in rows:
+        cursor.execute(f'INSERT INTO {match.group(1)}.data (original, simplified) VALUES (%s, %s)', row)
+
+
+def get_stub_simplifier(latency, latency_per_word, store):
+    '''Stands for the model: sleeps like a forward pass and drops every other word
+
+    As with the real model, sentences go through the prediction store and only the missing ones are decoded.
+    '''
+    from access.prediction_store import memoize_predictions
+
+    def generate_sentences(sentences):
+        time.sleep(latency + latency_per_word * sum(len(sentence.split()) for sentence in sentences))
+        return [' '.join(sentence.split()[::2]) for sentence in sentences]
+
+    return memoize_predictions(generate_sentences, lambda: 'stub_model', store=store)
+
+
+def install_fakes(real_model=False, real_db=False, model_latency=0.05, model_latency_per_word=0.002, db_latency=0.001,
+                  n_unlabeled_pairs=10000):
+    from access.prediction_store import PredictionStore
+    from services import annotation_service, db_service, simplification_service
+    if not real_model:
+        # A store of its own, the stub predictions must not end up in the real one
+        store_dir = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, store_dir, ignore_errors=True)
+        stub_simplifier = get_stub_simplifier(model_latency, model_latency_per_word,
+                                              PredictionStore(os.path.join(store_dir, 'predictions.db')))
+        simplification_service.get_simplifier = lambda: stub_simplifier
+    if not real_db:
+        database = FakeDatabase(latency=db_latency)
+        for sentence in get_synthetic_sentences(n_unlabeled_pairs, seed=1):
+            database.insert('unlabeled', sentence, ' '.join(sentence.split()[::2]))
+        db_service.connect = annotation_service.connect = database.connect
+        annotation_service.execute_values = fake_execute_values
+
+
+def start_local_server(port=0):
+    '''Serve the app in a background thread, returns the server and its url'''
+    from werkzeug.serving import make_server
+    from app import app
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+# Load generation
+class Client:
+    '''One simulated user with its own cookies (the annotation session), records the latency of each request'''
+    def __init__(self, base_url, stats, timeout=60):
+        self.base_url = base_url
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def request(self, endpoint, path, data=None, json_data=None, start_time=None):
+        '''start_time defaults to now, with an arrival rate it is the scheduled time so that queueing is counted'''
+        headers = {}
+        if json_data is not None:
+            data = json.dumps(json_data).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            data = urlencode(data).encode()
+        if start_time is None:
+            start_time = time.perf_counter()
+        body, ok = None, False
+        try:
+            with self.opener.open(Request(self.base_url + path, data=data, headers=headers),
+                                  timeout=self.timeout) as response:
+                body = response.read()
+                ok = response.status < 400
+        except (HTTPError, URLError, OSError) as e:
+            logger.debug(f'{endpoint} failed: {e}')
+        self.stats.record(endpoint, time.perf_counter() - start_time, ok)
+        return body if ok else None
+
+
+def run_scenario(client, endpoint, sentence, start_time=None):
+    if endpoint == 'simplify':
+        client.request(endpoint, '/', data={'complex_sentence': sentence}, start_time=start_time)
+    elif endpoint == 'api_simplify':
+        client.request(endpoint, '/api/simplify', json_data={'complex_sentence': sentence}, start_time=start_time)
+    elif endpoint == 'annotate':
+        client.request(endpoint, '/annotate', start_time=start_time)
+    elif endpoint == 'annotate_batch':
+        # Lease a batch and label it, as the annotation page does
+        body = client.request('annotate_batch_get', '/annotate/batch?size=20', start_time=start_time)
+        if body is None:
+            return
+        pairs = json.loads(body)['pairs']
+        annotations = [{'id': pair['id'], 'annotation': 'yes'} for pair in pairs]
+        client.request('annotate_batch_post', '/annotate/batch', json_data={'annotations': annotations})
+    else:
+        raise ValueError(f'Unknown endpoint {endpoint}, use one of {ENDPOINTS}')
+
+
+class LoadTestStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            if ok:
+                self.latencies[endpoint].append(latency)
+            else:
+                self.errors[endpoint] += 1
+
+    def get_report(self, duration):
+        report = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[endpoint]
+            n_requests = len(latencies) + self.errors[endpoint]
+            report[endpoint] = {
+                'n_requests': n_requests,
+                'throughput': len(latencies) / duration,
+                'error_rate': self.errors[endpoint] / n_requests,
+            }
+            if len(latencies) > 0:
+                for percentile in [50, 95, 99]:
+                    report[endpoint][f'p{percentile}'] = float(np.percentile(latencies, percentile))
+        return report
+
+
+def run_load_test(base_url, endpoints, sentences, concurrency, duration, rate=None, seed=0):
+    '''Closed loop (each user sends its next request when the previous one returns) or, with a rate in requests per
+    second, open loop with Poisson arrivals served by concurrency users
+    '''
+    stats = LoadTestStats()
+    rng = random.Random(seed)
+    local = threading.local()
+    end_time = time.perf_counter() + duration
+
+    def get_client():
+        if not hasattr(local, 'client'):
+            local.client = Client(base_url, stats)
+        return local.client
+
+    def closed_loop_user(user_id):
+        user_rng = random.Random(seed + user_id)
+        while time.perf_counter() < end_time:
+            run_scenario(get_client(), user_rng.choice(endpoints), user_rng.choice(sentences))
+
+    def open_loop_user(arrivals):
+        while True:
+            arrival = arrivals.get()
+            if arrival is None:
+                return
+            scheduled_time, endpoint, sentence = arrival
+            run_scenario(get_client(), endpoint, sentence, start_time=scheduled_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        if rate is None:
+            list(executor.map(closed_loop_user, range(concurrency)))
+        else:
+            arrivals = queue.Queue()
+            users = [executor.submit(open_loop_user, arrivals) for _ in range(concurrency)]
+            scheduled_time = start_time
+            while scheduled_time < end_time:
+                time.sleep(max(scheduled_time - time.perf_counter(), 0))
+                arrivals.put((scheduled_time, rng.choice(endpoints), rng.choice(sentences)))
+                scheduled_time += rng.expovariate(rate)
+            for _ in users:
+                arrivals.put(None)
+    # Requests still queued at the end are part of the run
+    return stats.get_report(time.perf_counter() - start_time)
+
+
+def print_report(report, header=''):
+    print(header)
+    for endpoint, endpoint_report in report.items():
+        latencies = ' '.join(f'{key}={endpoint_report[key] * 1000:.0f}ms' for key in ['p50', 'p95', 'p99']
+                             if key in endpoint_report)
+        print(f'  {endpoint}: requests={endpoint_report["n_requests"]} '
+              f'throughput={endpoint_report["throughput"]:.1f}/s error_rate={endpoint_report["error_rate"]:.1%} '
+              f'{latencies}')
+
+
+def get_total_throughput(report):
+    return sum(endpoint_report['throughput'] for endpoint_report in report.values())
+
+
+def find_saturation_point(sweep_reports, min_throughput_gain=0.1):
+    '''Lowest concurrency after which adding users increases throughput by less than min_throughput_gain'''
+    concurrencies = sorted(sweep_reports)
+    for previous_concurrency, concurrency in zip(concurrencies, concurrencies[1:]):
+        previous_throughput = get_total_throughput(sweep_reports[previous_concurrency])
+        if get_total_throughput(sweep_reports[concurrency]) < previous_throughput * (1 + min_throughput_gain):
+            return previous_concurrency
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the simplification and annotation endpoints')
+    parser.add_argument('--url', help='Target a running server instead of serving the app in-process')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help=f'Comma separated subset of {ENDPOINTS}')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of simultaneous users')
+    parser.add_argument('--sweep', help='Comma separated concurrencies to find the saturation point, e.g. 1,2,4,8')
+    parser.add_argument('--rate', type=float, help='Open loop arrival rate in requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per run')
+    parser.add_argument('--sentences-file', help='Recorded sentences, one per line (synthetic otherwise)')
+    parser.add_argument('--real-model', action='store_true', help='Load the real model instead of the stub')
+    parser.add_argument('--real-db', action='store_true', help='Use the Postgres database from the environment')
+    parser.add_argument('--model-latency', type=float, default=0.05, help='Seconds per stub model call')
+    parser.add_argument('--model-latency-per-word', type=float, default=0.002)
+    parser.add_argument('--db-latency', type=float, default=0.001, help='Seconds per fake database query')
+    parser.add_argument('--output', help='Write the reports to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    endpoints = args.endpoints.split(',')
+    sentences = load_sentences(args.sentences_file)
+    server = None
+    base_url = args.url
+    if base_url is None:
+        install_fakes(real_model=args.real_model, real_db=args.real_db, model_latency=args.model_latency,
+                      model_latency_per_word=args.model_latency_per_word, db_latency=args.db_latency)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server, base_url = start_local_server()
+    concurrencies = [int(value) for value in args.sweep.split(',')] if args.sweep else [args.concurrency]
+    reports = {}
+    try:
+        for concurrency in concurrencies:
+            # The services print on every request
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                reports[concurrency] = run_load_test(base_url, endpoints, sentences, concurrency, args.duration,
+                                                     rate=args.rate)
+            print_report(reports[concurrency], header=f'concurrency={concurrency}')
+    finally:
+        if server is not None:
+            server.shutdown()
+    if len(concurrencies) > 1:
+        saturation_point = find_saturation_point(reports)
+        print(f'saturation_concurrency={saturation_point}' if saturation_point is not None else
+              'No saturation within the sweep, try higher concurrencies')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({str(concurrency): report for concurrency, report in reports.items()}, f, indent=2)
@@ -1,15 +1,27 @@
-from flask import Blueprint, request, render_template, redirect, url_for, session
+import uuid
+
+from flask import Blueprint, request, render_template, redirect, url_for, session, jsonify
 
-from db.connect import query
 from services.db_service import write_sentence_pairs
-from services.annotation_service import delete_unlabeled_row
+from services.annotation_service import (delete_unlabeled_row, lease_unlabeled_pairs, release_leases,
+                                         submit_annotations)
 
 annotate_bp = Blueprint('annotate', __name__)
 
-@annotate_bp.route('/annotate', methods=['GET', 'POST'])
-def annotate():
+DEFAULT_BATCH_SIZE = 20
+MAX_BATCH_SIZE = 200
+
+
+def init_annotation_session():
     if 'skipped_ids' not in session:
         session['skipped_ids'] = []
+    if 'annotator_id' not in session:
+        session['annotator_id'] = uuid.uuid4().hex
+
+
+@annotate_bp.route('/annotate', methods=['GET', 'POST'])
+def annotate():
+    init_annotation_session()
 
     if request.method == 'POST':
         annotation = request.form.get('annotation')
@@ -19,27 +31,72 @@ def annotate():
         id_ = request.form['_id']
         original = request.form['original']
         simplified = request.form['simplified']
-        
+
         if annotation == 'yes' or annotation == 'no':
             pairs = [{'original': original, 'simple': simplified}] if annotation == 'yes' else [{'original': original, 'simple': request.form['rewrite']}]
             write_sentence_pairs(pairs, labeled=True)
             delete_unlabeled_row(id_)
         elif annotation == 'skip':
             session['skipped_ids'].append(str(id_))
-            session.modified = True  
-        
+            session.modified = True
+
         return redirect(url_for('annotate.annotate'))
 
-    unlabeled_data = query()
-    rendered_data = [pair for pair in unlabeled_data if str(pair['id']) not in session['skipped_ids']]
-    
+    # A fresh page load starts a new client-side queue, previously leased pairs are given back
+    release_leases(session['annotator_id'])
+    rendered_data = lease_unlabeled_pairs(session['annotator_id'], 1, session['skipped_ids'])
+
     if not rendered_data:
         return "No more data to annotate."
-    
+
     pair = rendered_data[0]
-    return render_template('annotate.html', original=pair['original'], simplified=pair['simplified'], id_=pair['id'])
+    return render_template('annotate.html', original=pair['original'], simplified=pair['simplified'], id_=pair['id'],
+                           batch_size=DEFAULT_BATCH_SIZE)
+
+
+@annotate_bp.route('/annotate/batch', methods=['GET'])
+def annotate_batch():
+    init_annotation_session()
+    n_pairs = min(request.args.get('size', DEFAULT_BATCH_SIZE, type=int), MAX_BATCH_SIZE)
+    pairs = lease_unlabeled_pairs(session['annotator_id'], n_pairs, session['skipped_ids'])
+    return jsonify({'pairs': pairs})
+
+
+@annotate_bp.route('/annotate/batch', methods=['POST'])
+def submit_annotate_batch():
+    init_annotation_session()
+    # sendBeacon() posts as text/plain, hence force=True
+    data = request.get_json(force=True, silent=True) or {}
+    annotations = data.get('annotations', []) if isinstance(data, dict) else None
+    if not isinstance(annotations, list):
+        return jsonify({"error": "Expected a list of annotations"}), 400
+    labelled, skipped = [], []
+    for annotation in annotations:
+        if not isinstance(annotation, dict):
+            return jsonify({"error": "Each annotation must be an object"}), 400
+        try:
+            annotation['id'] = int(annotation['id'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": f"Invalid pair id {annotation.get('id')!r}"}), 400
+        if annotation.get('annotation') == 'skip':
+            skipped.append(str(annotation['id']))
+        elif annotation.get('annotation') == 'yes':
+            labelled.append(annotation)
+        elif annotation.get('annotation') == 'no':
+            if not (annotation.get('rewrite') or '').strip():
+                return jsonify({"error": f"Empty rewrite for pair {annotation.get('id')}"}), 400
+            labelled.append(annotation)
+        else:
+            return jsonify({"error": f"Invalid annotation for pair {annotation.get('id')}"}), 400
+
+    n_labelled = submit_annotations(labelled) if labelled else 0
+    if skipped:
+        session['skipped_ids'].extend(skipped)
+        session.modified = True
+    return jsonify({'labelled': n_labelled, 'skipped': len(skipped)})
+
 
 @annotate_bp.route('/reset')
 def reset():
     session.pop('skipped_ids', None)
-    return redirect(url_for('annotate.annotate'))
\ No newline at end of file
+    return redirect(url_for('annotate.annotate'))
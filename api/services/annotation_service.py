@@ -1,5 +1,29 @@
+import threading
+
 from db.connect import connect, commit_and_close
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+LEASE_SECONDS = 10 * 60
+
+# Leases are stored with the rows so that every worker process of the server sees them
+_lease_columns_created = False
+_lease_columns_lock = threading.Lock()
+
+
+def ensure_lease_columns():
+    global _lease_columns_created
+    with _lease_columns_lock:
+        if _lease_columns_created:
+            return
+        conn, cur = connect()
+        try:
+            cur.execute("ALTER TABLE unlabeled.data ADD COLUMN IF NOT EXISTS leased_by TEXT, "
+                        "ADD COLUMN IF NOT EXISTS leased_until TIMESTAMPTZ")
+        finally:
+            commit_and_close(conn, cur)
+        _lease_columns_created = True
+
 
 def delete_unlabeled_row(id_):
     conn, cur = connect()
@@ -8,7 +32,7 @@ def delete_unlabeled_row(id_):
             "DELETE FROM unlabeled.data WHERE id = %s"
         )
         cur.execute(delete_query, (id_,))
-        
+
         commit_and_close(conn, cur)
         print(f"Row with id {id_} deleted successfully")
     except Exception as e:
@@ -16,4 +40,70 @@ def delete_unlabeled_row(id_):
         if conn:
             conn.rollback()
         commit_and_close(conn, cur)
-        raise
\ No newline at end of file
+        raise
+
+
+def release_leases(annotator_id):
+    ensure_lease_columns()
+    conn, cur = connect()
+    try:
+        release_query = sql.SQL(
+            "UPDATE unlabeled.data SET leased_by = NULL, leased_until = NULL WHERE leased_by = %s"
+        )
+        cur.execute(release_query, (annotator_id,))
+    finally:
+        commit_and_close(conn, cur)
+
+
+def lease_unlabeled_pairs(annotator_id, n_pairs, skipped_ids=()):
+    '''Hand out up to n_pairs unlabeled pairs that are neither skipped nor leased (to anyone) yet
+
+    Selecting and leasing happen in one statement, concurrent requests skip the rows being leased by each other.
+    '''
+    ensure_lease_columns()
+    conn, cur = connect()
+    try:
+        lease_query = sql.SQL(
+            "UPDATE unlabeled.data SET leased_by = %s, leased_until = now() + %s * interval '1 second' "
+            "WHERE id IN (SELECT id FROM unlabeled.data "
+            "WHERE NOT (id = ANY(%s)) AND (leased_until IS NULL OR leased_until <= now()) "
+            "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING id, original, simplified"
+        )
+        cur.execute(lease_query, (annotator_id, LEASE_SECONDS, [int(id_) for id_ in skipped_ids], n_pairs))
+        rows = sorted(cur.fetchall())
+    finally:
+        commit_and_close(conn, cur)
+    return [{'id': row[0], 'original': row[1], 'simplified': row[2]} for row in rows]
+
+
+def submit_annotations(annotations):
+    '''Label many pairs in a single transaction
+
+    Each annotation is a dict with an 'id', an 'annotation' ('yes' or 'no') and a 'rewrite' when the answer is 'no'.
+    Rows are moved from unlabeled.data to labelled.data atomically (with their leases), rows that were already labelled
+    are ignored.
+    '''
+    rewrites = {int(annotation['id']): annotation.get('rewrite') for annotation in annotations}
+    accepted_ids = {int(annotation['id']) for annotation in annotations if annotation['annotation'] == 'yes'}
+    conn, cur = connect()
+    try:
+        delete_query = sql.SQL(
+            "DELETE FROM unlabeled.data WHERE id = ANY(%s) RETURNING id, original, simplified"
+        )
+        cur.execute(delete_query, (list(rewrites),))
+        labelled_pairs = [
+            (original.rstrip('\n'), (simplified if id_ in accepted_ids else rewrites[id_]).rstrip('\n'))
+            for id_, original, simplified in cur.fetchall()
+        ]
+        if labelled_pairs:
+            execute_values(cur, "INSERT INTO labelled.data (original, simplified) VALUES %s", labelled_pairs)
+        commit_and_close(conn, cur)
+        print(f"Labelled {len(labelled_pairs)} pairs in one transaction")
+    except Exception as e:
+        print(f"Error submitting {len(annotations)} annotations: {e}")
+        if conn:
+            conn.rollback()
+        commit_and_close(conn, cur)
+        raise
+    return len(labelled_pairs)
@@ -3,6 +3,7 @@ import json
 import time
 from psycopg2 import sql
 
+from access.utils.metrics import STAGE_SECONDS
 from db.connect import connect, commit_and_close
 from inference.utils.paths import INPUT_FILE, UNLABELED_DIR, LABELED_DIR
 
@@ -32,7 +33,8 @@ def write_sentence_pairs(sentence_pairs, labeled=False):
         pair['original'] = pair['original'].rstrip('\n')
 
     try:
-        insert_pairs(sentence_pairs, schema=schema)
+        with STAGE_SECONDS.time(stage='db_write'):
+            insert_pairs(sentence_pairs, schema=schema)
         print('Sentence pairs have been written to DB.')
     except Exception as e:
         print('Error inserting pairs:', e)
@@ -1,35 +1,58 @@
 import logging
-import subprocess
-import os
-import json
-import time
+import threading
+from functools import lru_cache
 
-from psycopg2 import sql
-from db.connect import connect, commit_and_close
-from inference.utils.paths import INPUT_FILE
+from access.preprocessors import get_preprocessors
+from access.resources.bundle import get_bundle_path, load_bundle_simplifier
+from access.resources.prepare import prepare_models
+from access.simplifiers import get_fairseq_sentences_simplifier
+from access.text import word_tokenize
+from access.utils.helpers import mute_thread
+from access.utils.metrics import STAGE_SECONDS, QUEUE_DEPTH
 
 logger = logging.getLogger(__name__)
 
-def simplify_sentence(complex_sentence):
-    logger.debug(f"Simplifying sentence: {complex_sentence}")
-    with open(INPUT_FILE, 'w') as infile:
-        infile.write(complex_sentence)
-
-    logger.debug(f"Running command: ['python', 'scripts/generate.py'] in {os.getcwd()}")
-
-    command = ['python', 'scripts/generate.py']
-    with open(INPUT_FILE, 'r') as infile:
-        result = subprocess.run(command, stdin=infile, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+RECOMMENDED_PREPROCESSORS_KWARGS = {
+    'LengthRatioPreprocessor': {'target_ratio': 0.95},
+    'LevenshteinPreprocessor': {'target_ratio': 0.75},
+    'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+    'SentencePiecePreprocessor': {'vocab_size': 10000},
+}
+
+# The model is loaded once in the API process and is not thread safe, requests wait for it in turn
+_model_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_simplifier():
+    bundle_path = get_bundle_path()
+    if bundle_path is not None:
+        # Everything is read from the bundle file, nothing is downloaded
+        logger.info(f"Loading simplification model from bundle {bundle_path}")
+        return load_bundle_simplifier(bundle_path, beam=8)
+    logger.info("Loading simplification model")
+    preprocessors = get_preprocessors(RECOMMENDED_PREPROCESSORS_KWARGS)
+    return get_fairseq_sentences_simplifier(prepare_models(), preprocessors=preprocessors, beam=8)
+
+
+def simplify_sentences(complex_sentences):
+    QUEUE_DEPTH.inc()
+    with _model_lock:
+        QUEUE_DEPTH.dec()
+        with STAGE_SECONDS.time(stage='request'):
+            with STAGE_SECONDS.time(stage='tokenize'):
+                tokenized_sentences = [word_tokenize(sentence) for sentence in complex_sentences]
+            # fairseq prints while decoding, the other request threads keep their output
+            with mute_thread():
+                return get_simplifier()(tokenized_sentences)
 
-    if result.returncode != 0:
-        logger.error(f"Subprocess returned an error: {result.returncode}")
-        logger.error(f"Subprocess stderr: {result.stderr}")
-        logger.error(f"Subprocess stdout: {result.stdout}")
 
-    simplified_sentence = result.stdout.strip()
+def simplify_sentence(complex_sentence):
+    logger.debug(f"Simplifying sentence: {complex_sentence}")
+    try:
+        simplified_sentence = simplify_sentences([complex_sentence])[0]
+    except Exception as e:
+        logger.error(f"Simplification failed: {e}", exc_info=True)
+        raise
     logger.debug(f"Simplified Sentence: {simplified_sentence}")
-
-    if os.path.exists(INPUT_FILE):
-        os.remove(INPUT_FILE)
-
-    return simplified_sentence
\ No newline at end of file
+    return simplified_sentence
@@ -0,0 +1,21 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+
+from access.fairseq.checkpoints import create_slim_checkpoint
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Average the last checkpoints of an experiment into a slim checkpoint '
+                                     '(weights only), loaded by default by the simplifiers')
+    parser.add_argument('exp_dir')
+    parser.add_argument('--n-checkpoints', type=int, default=1,
+                        help='Number of last checkpoints to average, 1 only slims checkpoint_best.pt')
+    parser.add_argument('--fp32', action='store_true', help='Keep fp32 weights instead of fp16')
+    args = parser.parse_args()
+    print(create_slim_checkpoint(args.exp_dir, n_checkpoints=args.n_checkpoints, fp16=not args.fp32))
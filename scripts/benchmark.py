@@ -0,0 +1,366 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+from functools import partial
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from access.resources.paths import FASTTEXT_EMBEDDINGS_PATH, VARIOUS_DIR, REPO_DIR
+from access.utils.benchmarking import (SkipBenchmark, run_benchmarks, write_results, load_results, compare_to_baseline,
+                                       print_comparison, DEFAULT_MAX_SLOWDOWN)
+from access.utils.helpers import read_lines, write_lines
+'''Benchmark the hot paths of the access package offline, on synthetic sentences
+
+Sentences are sampled from scripts/benchmark_vocabulary.txt, the most frequent whole words of the sentencepiece
+vocabulary, which is versioned with the script. Benchmarks that need resources which are not on disk (sentencepiece
+model, fasttext embeddings, spaCy model) are skipped instead of downloading them. Startup benchmarks time
+fresh interpreters and print the heavy modules imported by the inference path.
+Example: python scripts/benchmark.py --output benchmark.json --baseline baseline.json
+'''
+
+VOCABULARY_PATH = Path(__file__).resolve().parent / 'benchmark_vocabulary.txt'
+SENTENCEPIECE_MODEL_PATH = VARIOUS_DIR / 'sentencepiece_model/sentencepiece_model_10000.model'
+LENGTH_RATIO_TOKEN = '<LENGTHRATIO_0.95>'
+# Slow to import, the inference path should only load them when a configured preprocessor or the model needs them
+HEAVY_MODULES = ['torch', 'fairseq', 'nevergrad', 'dill', 'spacy', 'nltk', 'git', 'joblib', 'easse']
+STARTUP_SNIPPETS = {
+    'import_inference': 'import access.simplifiers, access.preprocessors, access.text, access.resources.prepare',
+    'recommended_preprocessors': '''
+from access.preprocessors import ComposedPreprocessor, get_preprocessors
+preprocessors = get_preprocessors({
+    'LengthRatioPreprocessor': {'target_ratio': 0.95},
+    'LevenshteinPreprocessor': {'target_ratio': 0.75},
+    'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+    'SentencePiecePreprocessor': {'vocab_size': 10000},
+})
+# The word rank preprocessor would load the fasttext embeddings (a resource, not an import)
+ComposedPreprocessor([p for p in preprocessors if p.prefix != 'WordRankRatio']).encode_sentence('A short sentence .')
+''',
+    'generate_help': 'import runpy, sys; sys.argv = ["generate.py", "--help"]; runpy.run_path("scripts/generate.py", '
+                     'run_name="__main__")',
+}
+
+
+def get_vocabulary():
+    '''Whole words of the sentencepiece vocabulary, roughly sorted by frequency'''
+    return read_lines(VOCABULARY_PATH)
+
+
+def get_synthetic_sentences(n_sentences, seed=0, min_length=5, max_length=40):
+    random.seed(seed)
+    vocabulary = get_vocabulary()
+    # Zipf-like word frequencies as in real text
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [
+        ' '.join(random.choices(vocabulary, weights=weights, k=random.randint(min_length, max_length))) + ' .'
+        for _ in range(n_sentences)
+    ]
+
+
+def get_synthetic_pairs(n_sentences, seed=0):
+    '''Simple sentences are the complex ones with a few words dropped'''
+    complex_sentences = get_synthetic_sentences(n_sentences, seed=seed)
+    random.seed(seed)
+    simple_sentences = [' '.join(word for word in sentence.split() if random.random() > 0.2)
+                        for sentence in complex_sentences]
+    return complex_sentences, simple_sentences
+
+
+def write_synthetic_file(dir_path, name, sentences):
+    filepath = Path(dir_path) / name
+    write_lines(sentences, filepath)
+    return filepath
+
+
+def require_fasttext_embeddings():
+    if not FASTTEXT_EMBEDDINGS_PATH.exists():
+        raise SkipBenchmark(f'{FASTTEXT_EMBEDDINGS_PATH} not found')
+
+
+def require_sentencepiece_model():
+    # The preprocessor would otherwise train it on wikilarge, which has to be downloaded
+    if not SENTENCEPIECE_MODEL_PATH.exists():
+        raise SkipBenchmark(f'{SENTENCEPIECE_MODEL_PATH} not found')
+
+
+def require_spacy_model():
+    import spacy
+    if not spacy.util.is_package('en_core_web_sm'):
+        raise SkipBenchmark('spaCy model en_core_web_sm is not installed')
+
+
+def clear_feature_caches():
+    '''Sentences are processed once in real runs, cached spaCy parses would hide the actual cost'''
+    from access.text import spacy_process, word_tokenize
+    spacy_process.cache_clear()
+    word_tokenize.cache_clear()
+
+
+def get_preprocessor(preprocessor_name):
+    from access.preprocessors import get_preprocessor_by_name
+    if preprocessor_name == 'WordRankRatioPreprocessor':
+        require_fasttext_embeddings()
+    if preprocessor_name == 'DependencyTreeDepthRatioPreprocessor':
+        require_spacy_model()
+    if preprocessor_name == 'SentencePiecePreprocessor':
+        return get_preprocessor_by_name(preprocessor_name)(vocab_size=10000)
+    return get_preprocessor_by_name(preprocessor_name)()
+
+
+def benchmark_encode_sentence_pair(preprocessor_name, n_sentences):
+    preprocessor = get_preprocessor(preprocessor_name)
+    complex_sentences, simple_sentences = get_synthetic_pairs(n_sentences)
+
+    def func():
+        for complex_sentence, simple_sentence in zip(complex_sentences, simple_sentences):
+            preprocessor.encode_sentence_pair(complex_sentence, simple_sentence)
+
+    func()  # Warm up lazily loaded resources (word2rank, spaCy model)
+    return func, clear_feature_caches, n_sentences
+
+
+def benchmark_composed_encode_file(work_dir, n_sentences):
+    from access.preprocessors import ComposedPreprocessor
+    preprocessor = ComposedPreprocessor([
+        get_preprocessor('LengthRatioPreprocessor'),
+        get_preprocessor('LevenshteinPreprocessor'),
+        get_preprocessor('SentencePiecePreprocessor'),
+    ])
+    input_filepath = write_synthetic_file(work_dir, 'composed.complex', get_synthetic_sentences(n_sentences))
+    output_filepath = Path(work_dir) / 'composed.encoded'
+    return partial(preprocessor.encode_file, input_filepath, output_filepath), None, n_sentences
+
+
+def benchmark_sentencepiece(n_sentences, decode=False):
+    require_sentencepiece_model()
+    preprocessor = get_preprocessor('SentencePiecePreprocessor')
+    sentences = [f'{LENGTH_RATIO_TOKEN} {sentence}' for sentence in get_synthetic_sentences(n_sentences)]
+    if decode:
+        sentences = [preprocessor.encode_sentence(sentence) for sentence in sentences]
+    method = preprocessor.decode_sentence if decode else preprocessor.encode_sentence
+
+    def func():
+        for sentence in sentences:
+            method(sentence)
+
+    func()
+    return func, None, n_sentences
+
+
+def benchmark_feature(feature_name, n_sentences):
+    from access import feature_extraction
+    if feature_name == 'get_lexical_complexity_score':
+        require_fasttext_embeddings()
+    if feature_name == 'get_dependency_tree_depth':
+        require_spacy_model()
+    feature_extractor = getattr(feature_extraction, feature_name)
+    sentences = get_synthetic_sentences(n_sentences)
+
+    def func():
+        for sentence in sentences:
+            feature_extractor(sentence)
+
+    func()
+    return func, clear_feature_caches, n_sentences
+
+
+def benchmark_yield_lines_in_parallel(work_dir, n_lines):
+    from access.utils.helpers import yield_lines_in_parallel
+    complex_sentences, simple_sentences = get_synthetic_pairs(n_lines)
+    filepaths = [write_synthetic_file(work_dir, 'parallel.complex', complex_sentences),
+                 write_synthetic_file(work_dir, 'parallel.simple', simple_sentences)]
+
+    def func():
+        for _ in yield_lines_in_parallel(filepaths):
+            pass
+
+    return func, None, n_lines
+
+
+def benchmark_count_lines(work_dir, n_lines):
+    from access.utils.helpers import count_lines
+    filepath = write_synthetic_file(work_dir, 'count.complex', get_synthetic_sentences(n_lines))
+    return partial(count_lines, filepath), None, n_lines
+
+
+def benchmark_has_lines_in_common(work_dir, n_lines):
+    from access.resources.datasets import has_lines_in_common
+    # Disjoint files: the worst case, every line of the largest file is looked up
+    filepath1 = write_synthetic_file(work_dir, 'common.train', get_synthetic_sentences(n_lines, seed=1))
+    filepath2 = write_synthetic_file(work_dir, 'common.valid', get_synthetic_sentences(n_lines // 10, seed=2))
+    return partial(has_lines_in_common, filepath1, filepath2), None, n_lines
+
+
+def create_tiny_transformer(exp_dir, words):
+    '''Randomly initialized 1 layer transformer saved as a fairseq checkpoint in exp_dir'''
+    from fairseq import options, tasks
+    from fairseq.data import Dictionary
+    import torch
+    dictionary = Dictionary()
+    for word in words:
+        dictionary.add_symbol(word)
+    for lang in ['complex', 'simple']:
+        dictionary.save(str(Path(exp_dir) / f'dict.{lang}.txt'))
+    args = options.parse_args_and_arch(options.get_training_parser(), [
+        str(exp_dir), '--source-lang', 'complex', '--target-lang', 'simple', '--arch', 'transformer',
+        '--encoder-layers', '1', '--decoder-layers', '1', '--encoder-embed-dim', '64', '--decoder-embed-dim', '64',
+        '--encoder-ffn-embed-dim', '128', '--decoder-ffn-embed-dim', '128', '--encoder-attention-heads', '2',
+        '--decoder-attention-heads', '2', '--cpu'
+    ])
+    torch.manual_seed(0)
+    model = tasks.setup_task(args).build_model(args)
+    checkpoint_path = Path(exp_dir) / 'checkpoints/checkpoint_best.pt'
+    checkpoint_path.parent.mkdir(parents=True)
+    torch.save({
+        'args': args,
+        'model': model.state_dict(),
+        'optimizer_history': [{
+            'criterion_name': 'LabelSmoothedCrossEntropyCriterion',
+            'optimizer_name': 'FairseqNAG',
+            'lr_scheduler_state': {'best': None},
+            'num_updates': 0,
+        }],
+        'last_optimizer_state': None,
+        'extra_state': {'train_iterator': {'epoch': 1, 'iterations_in_epoch': 0}},
+    }, checkpoint_path)
+
+
+def benchmark_generation(work_dir, n_sentences):
+    try:
+        from access.fairseq.base import load_fairseq_generator
+    except ImportError as e:
+        raise SkipBenchmark(f'fairseq is not installed ({e})')
+    from access.utils.helpers import mute
+    exp_dir = Path(work_dir) / 'tiny_transformer'
+    exp_dir.mkdir()
+    create_tiny_transformer(exp_dir, get_vocabulary()[:2000] + [LENGTH_RATIO_TOKEN])
+    with mute():
+        generate_sentences = load_fairseq_generator(exp_dir, beam=4, cpu=True, num_threads=1, max_len_slack=1.5)
+    sentences = [f'{LENGTH_RATIO_TOKEN} {sentence}' for sentence in get_synthetic_sentences(n_sentences)]
+    generate_sentences(sentences[:8])
+    return partial(generate_sentences, sentences), None, n_sentences
+
+
+def benchmark_calls_after_artifact_hit(work_dir, n_calls, legacy_trace=False):
+    '''Python calls made after skipping an already built artifact, as the rest of a training run does
+
+    legacy_trace reproduces the sys.settrace() hack formerly used to skip the build, which left a global trace function
+    installed for the rest of the process.
+    '''
+    from access.utils.artifacts import build_artifact
+    artifact_dir = build_artifact(Path(work_dir) / 'artifact', lambda build_path: (build_path / 'done').touch())
+
+    def add(a, b):
+        return a + b
+
+    def func():
+        build_artifact(artifact_dir, None)  # Cache hit, build is not called
+        if legacy_trace:
+            sys.settrace(lambda *args, **kwargs: None)
+        try:
+            total = 0
+            for i in range(n_calls):
+                total = add(total, i)
+        finally:
+            if legacy_trace:
+                sys.settrace(None)
+
+    return func, None, n_calls
+
+
+def run_python_snippet(snippet):
+    '''Run the snippet in a fresh interpreter, returns the heavy modules it imported'''
+    # Reported at exit so that snippets calling sys.exit() (e.g. argparse --help) are covered
+    report = ('import atexit, json, sys\n'
+              f'atexit.register(lambda: print(json.dumps([m for m in {HEAVY_MODULES} if m in sys.modules]), '
+              'file=sys.stderr))\n')
+    result = subprocess.run([sys.executable, '-c', report + snippet],
+                            cwd=str(REPO_DIR),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            env={**os.environ, 'PYTHONPATH': str(REPO_DIR)})
+    stderr_lines = result.stderr.strip().split('\n')
+    if result.returncode != 0:
+        raise RuntimeError(stderr_lines[-2] if len(stderr_lines) > 1 else result.stderr)
+    return json.loads(stderr_lines[-1])
+
+
+def benchmark_startup(snippet_name):
+    '''Cold start of a fresh interpreter, which dominates CLI and autoscaled serving usage'''
+    snippet = STARTUP_SNIPPETS[snippet_name]
+    try:
+        heavy_modules = run_python_snippet(snippet)
+    except RuntimeError as e:
+        # Most likely a dependency that is not installed
+        raise SkipBenchmark(str(e))
+    if len(heavy_modules) > 0:
+        print(f'startup.{snippet_name} imports {heavy_modules}')
+    return partial(run_python_snippet, snippet), None, None
+
+
+def get_benchmarks(work_dir, scale):
+    '''{name: get_benchmark}, scale multiplies the number of sentences of every benchmark'''
+    n_sentences = int(1000 * scale)
+    n_lines = int(100000 * scale)
+    benchmarks = {}
+    for preprocessor_name in [
+            'LengthRatioPreprocessor', 'LevenshteinPreprocessor', 'WordRankRatioPreprocessor',
+            'DependencyTreeDepthRatioPreprocessor'
+    ]:
+        benchmarks[f'encode_sentence_pair.{preprocessor_name}'] = partial(benchmark_encode_sentence_pair,
+                                                                          preprocessor_name, n_sentences)
+    benchmarks.update({
+        'ComposedPreprocessor.encode_file': partial(benchmark_composed_encode_file, work_dir, n_sentences),
+        'SentencePiecePreprocessor.encode_sentence': partial(benchmark_sentencepiece, n_sentences),
+        'SentencePiecePreprocessor.decode_sentence': partial(benchmark_sentencepiece, n_sentences, decode=True),
+        'get_lexical_complexity_score': partial(benchmark_feature, 'get_lexical_complexity_score', n_sentences),
+        'get_dependency_tree_depth': partial(benchmark_feature, 'get_dependency_tree_depth', n_sentences),
+        'yield_lines_in_parallel': partial(benchmark_yield_lines_in_parallel, work_dir, n_lines),
+        'count_lines': partial(benchmark_count_lines, work_dir, n_lines),
+        'has_lines_in_common': partial(benchmark_has_lines_in_common, work_dir, n_lines),
+        'artifacts.calls_after_skip': partial(benchmark_calls_after_artifact_hit, work_dir, n_lines * 10),
+        'artifacts.calls_after_settrace_skip': partial(benchmark_calls_after_artifact_hit, work_dir, n_lines * 10,
+                                                       legacy_trace=True),
+        'generate.tiny_transformer': partial(benchmark_generation, work_dir, max(n_sentences // 10, 1)),
+    })
+    for snippet_name in STARTUP_SNIPPETS:
+        benchmarks[f'startup.{snippet_name}'] = partial(benchmark_startup, snippet_name)
+    return benchmarks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the access package')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=DEFAULT_MAX_SLOWDOWN,
+                        help='Relative increase of the median duration reported as a regression')
+    parser.add_argument('--n-repeats', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1., help='Multiply the size of the synthetic data')
+    parser.add_argument('--filter', help='Only run benchmarks whose name contains this string')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp()
+    try:
+        results, skipped = run_benchmarks(get_benchmarks(work_dir, args.scale), n_repeats=args.n_repeats,
+                                          pattern=args.filter)
+    finally:
+        shutil.rmtree(work_dir)
+    if args.output is not None:
+        write_results(results, skipped, args.output, scale=args.scale, n_repeats=args.n_repeats)
+    if args.baseline is not None:
+        changes, regressions = compare_to_baseline(results, load_results(args.baseline), args.max_slowdown)
+        print_comparison(changes, regressions)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} benchmarks are more than {args.max_slowdown:.0%} slower than the baseline')
+            sys.exit(1)
@@ -0,0 +1,64 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+import random
+import sys
+import time
+
+from easse.cli import evaluate_system_output
+
+from access.evaluation.general import PARITY_TOLERANCE
+from access.evaluation.turkcorpus import TurkcorpusEvaluator
+from access.resources.paths import get_data_filepath
+from access.resources.prepare import prepare_turkcorpus
+from access.utils.helpers import get_temp_filepath, read_lines, write_lines
+'''Compare the cached turkcorpus evaluator with easse on simulated parametrization search trials'''
+
+
+def get_trial_predictions(complex_sentences, deletion_prob, seed):
+    '''Mimic the predictions of a parametrization by randomly deleting words of some sentences'''
+    random.seed(seed)
+    predictions = []
+    for sentence in complex_sentences:
+        words = sentence.split()
+        if random.random() < 0.5:
+            words = [word for word in words if random.random() > deletion_prob] or words
+        predictions.append(' '.join(words))
+    return predictions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cached turkcorpus evaluator against easse')
+    parser.add_argument('--budget', type=int, default=64, help='Number of simulated search trials')
+    parser.add_argument('--phase', default='valid')
+    args = parser.parse_args()
+    prepare_turkcorpus()
+    complex_sentences = read_lines(get_data_filepath('turkcorpus', args.phase, 'complex'))
+    trials = [get_trial_predictions(complex_sentences, deletion_prob=0.2, seed=seed) for seed in range(args.budget)]
+    start_time = time.time()
+    for predictions in trials:
+        pred_filepath = get_temp_filepath()
+        write_lines(predictions, pred_filepath)
+        evaluate_system_output(f'turkcorpus_{args.phase}_legacy', sys_sents_path=pred_filepath,
+                               metrics=['bleu', 'sari_legacy', 'fkgl'], quality_estimation=True)
+    easse_duration = time.time() - start_time
+    start_time = time.time()
+    evaluator = TurkcorpusEvaluator(args.phase)
+    for predictions in trials:
+        evaluator.evaluate(predictions)
+    evaluator_duration = time.time() - start_time
+    print(f'budget={args.budget} easse={easse_duration:.2f}s evaluator={evaluator_duration:.2f}s '
+          f'speedup={easse_duration / evaluator_duration:.1f}x')
+    max_differences = {metric: 0 for metric in ['bleu', 'sari_legacy', 'fkgl']}
+    for predictions in trials[:5]:
+        for metric, difference in evaluator.check_parity(predictions).items():
+            max_differences[metric] = max(max_differences[metric], abs(difference))
+    print('max_abs_difference', ' '.join(f'{metric}={value:.6f}' for metric, value in max_differences.items()))
+    if max(max_differences.values()) > PARITY_TOLERANCE:
+        print(f'Parity with easse is broken (tolerance {PARITY_TOLERANCE})')
+        sys.exit(1)
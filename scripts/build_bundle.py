@@ -0,0 +1,37 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+
+from access.preprocessors import get_preprocessors
+from access.resources.bundle import build_bundle
+from access.resources.prepare import prepare_models
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a model and its preprocessors into a single bundle file')
+    parser.add_argument('output_path')
+    parser.add_argument('--exp-dir', help='Experiment to bundle, defaults to the pretrained model')
+    parser.add_argument('--no-word2rank', action='store_true', help='Do not bundle the word2rank index')
+    parser.add_argument('--word2rank-vocab-size', type=int, help='Only bundle the most frequent words')
+    args = parser.parse_args()
+    exp_dir = args.exp_dir if args.exp_dir is not None else prepare_models()
+    recommended_preprocessors_kwargs = {
+        'LengthRatioPreprocessor': {'target_ratio': 0.95},
+        'LevenshteinPreprocessor': {'target_ratio': 0.75},
+        'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+        'SentencePiecePreprocessor': {'vocab_size': 10000},
+    }
+    preprocessors = get_preprocessors(recommended_preprocessors_kwargs)
+    manifest = build_bundle(exp_dir,
+                            preprocessors,
+                            args.output_path,
+                            include_word2rank=not args.no_word2rank,
+                            word2rank_vocab_size=args.word2rank_vocab_size)
+    for name, section in manifest['sections'].items():
+        print(f'{name}: {section["size"] / 2**20:.1f}MB')
+    print(f'Bundle written to {args.output_path}')
@@ -0,0 +1,50 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+
+from access.evaluation.general import evaluate_sentences_simplifier_on_turkcorpus
+from access.preprocessors import get_preprocessors
+from access.resources.prepare import prepare_turkcorpus, prepare_models
+from access.simplifiers import get_fairseq_sentences_simplifier
+from access.utils.helpers import mute
+'''Compare decode time and scores of length capped and adaptive beam decoding against default decoding'''
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the effect of decoding options on turkcorpus valid')
+    parser.add_argument('--exp-dir', help='Defaults to the pretrained model')
+    parser.add_argument('--beam', type=int, default=8)
+    parser.add_argument('--max-len-slack', type=float, default=1.5)
+    args = parser.parse_args()
+    prepare_turkcorpus()
+    exp_dir = args.exp_dir or prepare_models()
+    recommended_preprocessors_kwargs = {
+        'LengthRatioPreprocessor': {'target_ratio': 0.95},
+        'LevenshteinPreprocessor': {'target_ratio': 0.75},
+        'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+        'SentencePiecePreprocessor': {'vocab_size': 10000},
+    }
+    preprocessors = get_preprocessors(recommended_preprocessors_kwargs)
+    decoding_kwargs = {
+        'default': {},
+        'max_len': {'max_len_slack': args.max_len_slack},
+        'max_len+adaptive_beam': {'max_len_slack': args.max_len_slack, 'adaptive_beam': True},
+    }
+    results = {}
+    for name, kwargs in decoding_kwargs.items():
+        with mute():
+            simplifier = get_fairseq_sentences_simplifier(exp_dir,
+                                                          preprocessors=preprocessors,
+                                                          use_prediction_store=False,
+                                                          beam=args.beam,
+                                                          **kwargs)
+        results[name] = evaluate_sentences_simplifier_on_turkcorpus(simplifier, 'valid')
+        print(name, ' '.join(f'{key}={value:.2f}' for key, value in results[name].items()))
+    for name in list(decoding_kwargs)[1:]:
+        deltas = {key: results[name][key] - results['default'][key] for key in results['default']}
+        print(f'{name} delta', ' '.join(f'{key}={value:+.2f}' for key, value in deltas.items()))
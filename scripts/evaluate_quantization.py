@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+
+from access.evaluation.general import evaluate_sentences_simplifier_on_turkcorpus
+from access.preprocessors import get_preprocessors
+from access.resources.prepare import prepare_turkcorpus, prepare_models
+from access.simplifiers import get_fairseq_sentences_simplifier
+from access.utils.helpers import mute
+'''Compare the int8 quantized model against fp32 on turkcorpus valid, on CPU'''
+
+
+def evaluate_model(exp_dir, preprocessors, n_latency_sentences, **kwargs):
+    with mute():
+        simplifier = get_fairseq_sentences_simplifier(exp_dir, preprocessors=preprocessors, use_prediction_store=False,
+                                                      cpu=True, **kwargs)
+    return evaluate_sentences_simplifier_on_turkcorpus(simplifier, 'valid', n_latency_sentences=n_latency_sentences)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accept or reject the int8 quantized model on measured quality loss')
+    parser.add_argument('--exp-dir', help='Defaults to the pretrained model')
+    parser.add_argument('--beam', type=int, default=8)
+    parser.add_argument('--num-threads', type=int)
+    parser.add_argument('--num-interop-threads', type=int)
+    parser.add_argument('--n-latency-sentences', type=int, default=100, help='Sentences simplified one at a time')
+    parser.add_argument('--max-sari-drop', type=float, default=0.5)
+    parser.add_argument('--max-bleu-drop', type=float, default=1.)
+    args = parser.parse_args()
+    prepare_turkcorpus()
+    exp_dir = args.exp_dir or prepare_models()
+    recommended_preprocessors_kwargs = {
+        'LengthRatioPreprocessor': {'target_ratio': 0.95},
+        'LevenshteinPreprocessor': {'target_ratio': 0.75},
+        'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+        'SentencePiecePreprocessor': {'vocab_size': 10000},
+    }
+    preprocessors = get_preprocessors(recommended_preprocessors_kwargs)
+    kwargs = {'beam': args.beam, 'num_threads': args.num_threads, 'num_interop_threads': args.num_interop_threads}
+    results = {
+        'fp32': evaluate_model(exp_dir, preprocessors, args.n_latency_sentences, **kwargs),
+        'int8': evaluate_model(exp_dir, preprocessors, args.n_latency_sentences, quantize=True, **kwargs),
+    }
+    for name, model_results in results.items():
+        print(name, ' '.join(f'{key}={value:.2f}' for key, value in model_results.items()))
+    deltas = {key: results['int8'][key] - results['fp32'][key] for key in results['fp32']}
+    print('delta', ' '.join(f'{key}={value:+.2f}' for key, value in deltas.items()))
+    accepted = deltas['sari_legacy'] >= -args.max_sari_drop and deltas['bleu'] >= -args.max_bleu_drop
+    print(f'Quantized model {"accepted" if accepted else "rejected"}')
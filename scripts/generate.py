@@ -5,15 +5,16 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import argparse
 import fileinput
 import logging
 import sys
 
 from access.preprocessors import get_preprocessors
 from access.resources.prepare import prepare_models
-from access.simplifiers import get_fairseq_simplifier, get_preprocessed_simplifier
+from access.simplifiers import get_fairseq_sentences_simplifier
 from access.text import word_tokenize
-from access.utils.helpers import yield_lines, write_lines, get_temp_filepath, mute
+from access.utils.helpers import yield_chunks, mute
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,15 +22,17 @@ logger = logging.getLogger(__name__)
 
 def main():
     logger.debug("Starting generate.py script")
+    # Usage: python generate.py < my_file.complex
+    parser = argparse.ArgumentParser(description='Simplify sentences from stdin (or files) in a streaming fashion')
+    parser.add_argument('files', nargs='*', help='Input files, stdin is used if empty')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Number of lines simplified at once')
+    parser.add_argument('--max-len-slack', type=float,
+                        help='Cap prediction lengths using the length ratio target (e.g. 1.5)')
+    parser.add_argument('--adaptive-beam', action='store_true', help='Smaller beams for short sentences')
+    args = parser.parse_args()
 
     try:
-        # Usage: python generate.py < my_file.complex
-        # Read from stdin
-        source_filepath = get_temp_filepath()
-        logger.debug("Reading from stdin and tokenizing")
-        write_lines([word_tokenize(line) for line in fileinput.input()], source_filepath)
-        
-        # Load best model
+        # Load best model once, it is then reused for every chunk
         logger.debug("Preparing models")
         best_model_dir = prepare_models()
         recommended_preprocessors_kwargs = {
@@ -38,19 +41,24 @@ def main():
             'WordRankRatioPreprocessor': {'target_ratio': 0.75},
             'SentencePiecePreprocessor': {'vocab_size': 10000},
         }
-        preprocessors = get_preprocessors(recommended_preprocessors_kwargs)
-        simplifier = get_fairseq_simplifier(best_model_dir, beam=8)
-        simplifier = get_preprocessed_simplifier(simplifier, preprocessors=preprocessors)
-        
-        # Simplify
-        pred_filepath = get_temp_filepath()
-        with mute():
-            simplifier(source_filepath, pred_filepath)
-            
-        for line in yield_lines(pred_filepath):
-            print(line)
+        with mute(mute_stderr=False):
+            preprocessors = get_preprocessors(recommended_preprocessors_kwargs)
+            simplifier = get_fairseq_sentences_simplifier(best_model_dir,
+                                                          preprocessors=preprocessors,
+                                                          beam=8,
+                                                          max_len_slack=args.max_len_slack,
+                                                          adaptive_beam=args.adaptive_beam)
+
+        # Read, tokenize, simplify and write chunk by chunk so that memory stays constant
+        for chunk in yield_chunks(fileinput.input(args.files), args.chunk_size):
+            logger.debug(f"Simplifying chunk of {len(chunk)} lines")
+            with mute(mute_stderr=False):
+                predictions = simplifier([word_tokenize(line) for line in chunk])
+            for prediction in predictions:
+                print(prediction)
+            sys.stdout.flush()
     except Exception as e:
         logger.error(f"An error occurred: {e}", exc_info=True)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,30 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+import json
+
+from access.fairseq.main import select_ensemble_or_averaged_model
+from access.resources.prepare import prepare_turkcorpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ensemble the last checkpoints of an experiment, or replace the '
+                                     'ensemble by their average when it is almost as good on turkcorpus valid')
+    parser.add_argument('exp_dir')
+    parser.add_argument('--preprocessors-kwargs', type=json.loads, default={}, help='JSON dict')
+    parser.add_argument('--n-checkpoints', type=int, default=5)
+    parser.add_argument('--max-sari-drop', type=float, default=0.5)
+    parser.add_argument('--beam', type=int, default=8)
+    args = parser.parse_args()
+    prepare_turkcorpus()
+    checkpoint_paths = select_ensemble_or_averaged_model(args.exp_dir,
+                                                         args.preprocessors_kwargs,
+                                                         n_checkpoints=args.n_checkpoints,
+                                                         max_sari_drop=args.max_sari_drop,
+                                                         generate_kwargs={'beam': args.beam})
+    print(':'.join(str(path) for path in checkpoint_paths))
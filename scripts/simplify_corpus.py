@@ -0,0 +1,40 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+
+from access.resources.prepare import prepare_models
+from access.sharded_simplification import simplify_corpus
+
+
+if __name__ == '__main__':
+    # Usage: python scripts/simplify_corpus.py my_file.complex my_file.pred --work-dir my_file.shards --n-workers 16
+    parser = argparse.ArgumentParser(description='Simplify a large corpus with several processes')
+    parser.add_argument('complex_filepath')
+    parser.add_argument('output_pred_filepath')
+    parser.add_argument('--work-dir', required=True, help='Shard outputs and progress, rerun with it to resume')
+    parser.add_argument('--n-workers', type=int, default=-1)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--beam', type=int, default=8)
+    parser.add_argument('--no-tokenize', action='store_true', help='Input is already tokenized')
+    args = parser.parse_args()
+    best_model_dir = prepare_models()
+    recommended_preprocessors_kwargs = {
+        'LengthRatioPreprocessor': {'target_ratio': 0.95},
+        'LevenshteinPreprocessor': {'target_ratio': 0.75},
+        'WordRankRatioPreprocessor': {'target_ratio': 0.75},
+        'SentencePiecePreprocessor': {'vocab_size': 10000},
+    }
+    simplify_corpus(args.complex_filepath,
+                    args.output_pred_filepath,
+                    best_model_dir,
+                    recommended_preprocessors_kwargs,
+                    work_dir=args.work_dir,
+                    n_workers=args.n_workers,
+                    chunk_size=args.chunk_size,
+                    tokenize=not args.no_tokenize,
+                    beam=args.beam)
@@ -0,0 +1,66 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('fairseq')
+pytest.importorskip('mlflow')
+
+from access.fairseq.checkpoints import create_slim_checkpoint, load_checkpoint_state  # noqa: E402
+from access.fairseq.train import save_checkpoint  # noqa: E402
+
+
+class FakeEpochIterator:
+    epoch = 1
+
+    def end_of_epoch(self):
+        return False
+
+    def state_dict(self):
+        return {'epoch': self.epoch}
+
+
+class FakeTrainer:
+    '''The weights are the number of updates'''
+    num_updates = 0
+
+    def get_num_updates(self):
+        return self.num_updates
+
+    def save_checkpoint(self, filename, extra_state):
+        torch.save({
+            'model': {'weight': torch.full((2, ), float(self.num_updates))},
+            'optimizer_history': [{'optimizer': {}}],
+            'last_optimizer_state': {},
+            'extra_state': extra_state,
+        }, filename)
+
+
+def test_last_update_checkpoints_are_averaged(tmp_path):
+    save_dir = tmp_path / 'checkpoints'
+    save_dir.mkdir()
+    args = Namespace(no_save=False, distributed_rank=0, save_dir=str(save_dir), save_interval_updates=10,
+                     keep_interval_updates=3, keep_last_epochs=-1)
+    trainer = FakeTrainer()
+    if hasattr(save_checkpoint, 'best'):
+        del save_checkpoint.best
+    for num_updates, val_loss in [(10, -30.), (20, -40.), (30, -35.), (40, -36.)]:
+        trainer.num_updates = num_updates
+        written_paths = save_checkpoint(args, trainer, FakeEpochIterator(), val_loss)
+        assert str(save_dir / f'checkpoint_1_{num_updates}.pt') in written_paths
+    assert sorted(path.name for path in save_dir.iterdir()) == [
+        'checkpoint_1_20.pt', 'checkpoint_1_30.pt', 'checkpoint_1_40.pt', 'checkpoint_best.pt', 'checkpoint_last.pt'
+    ]
+    state = load_checkpoint_state(create_slim_checkpoint(tmp_path, n_checkpoints=3, fp16=False))
+    assert state['model']['weight'].tolist() == [30., 30.]
+    assert state['extra_state']['slim_checkpoint_sources'] == [
+        'checkpoint_1_40.pt', 'checkpoint_1_30.pt', 'checkpoint_1_20.pt'
+    ]
+    assert state['last_optimizer_state'] is None
@@ -0,0 +1,43 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import threading
+
+from access.prediction_store import PredictionStore, memoize_predictions
+
+
+def run_in_thread(target, *args):
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(target(*args))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert errors == []
+    return results[0]
+
+
+def test_store_is_shared_between_threads(tmp_path):
+    decoded_lines = []
+
+    def generate_lines(lines):
+        decoded_lines.extend(lines)
+        return [line.upper() for line in lines]
+
+    store = PredictionStore(tmp_path / 'predictions.db')
+    memoized_generate_lines = memoize_predictions(generate_lines, lambda: 'model', store=store)
+    # Each API request runs on a new thread
+    assert run_in_thread(memoized_generate_lines, ['a b', 'c']) == ['A B', 'C']
+    assert run_in_thread(memoized_generate_lines, ['c', 'd']) == ['C', 'D']
+    assert memoized_generate_lines(['a b', 'd']) == ['A B', 'D']
+    assert decoded_lines == ['a b', 'c', 'd']